@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Merges the per-SRR output files written by `process_sra_from_srr_list.py`
+and `process_sra_from_srr_id.py`, in either CSV or binary format (see
+`sample_output`), into a single HDF5 file:
+
+* 'rpkm_sparse': sparse matrix of RPKM values, one row per SRR ID; see
+  `sparse_matrix`
+* 'alignment_metadata': data frame of summary values, indexed by SRR ID,
+  with rows in the same order as the matrix
+
+Files are parsed in parallel, and every file's gene IDs are checked against
+the genes already in the matrix. Merging is incremental: running this again
+after more SRR IDs have finished only reads the new files.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hashlib import sha1
+import os
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from expression_store import ALIGNMENT_METADATA_KEY, SPARSE_RPKM_KEY
+from paths import OUTPUT_PATH
+from sample_output import (
+    BINARY_DIRECTORY_NAME,
+    BINARY_SUFFIX,
+    CSV_SUFFIX,
+    RPKM_DIRECTORY_NAME,
+    SUMMARY_DIRECTORY_NAME,
+    load_annotation,
+    read_binary_sample,
+    sample_rpkm,
+)
+from sparse_matrix import SparseMatrixReader, SparseMatrixWriter
+from utils import grouper, normalize_whitespace
+
+DEFAULT_OUTPUT_FILENAME = 'expr.hdf5'
+
+# Number of SRR IDs parsed before results are written to the output file,
+# which bounds memory use and the work lost if merging is interrupted
+BATCH_SIZE = 1024
+
+# Space reserved for SRR IDs in the alignment metadata table
+SRR_ID_MAX_LENGTH = 32
+
+class ParsedSrrOutput(NamedTuple):
+    srr_id: str
+    # Hash of gene IDs, in order; see `gene_id_hash`
+    gene_id_hash: str
+    rpkm: np.ndarray
+    summary: pd.Series
+
+def gene_id_hash(gene_ids: Iterable[str]) -> str:
+    return sha1('\n'.join(gene_ids).encode('utf-8')).hexdigest()
+
+def read_series_csv(path: Path) -> Tuple[List[str], List[str]]:
+    """
+    Reads a file written by `pd.Series.to_csv`, much faster than
+    `pd.read_csv` for many small files.
+
+    :return: 2-tuple: index labels and values, as strings
+    """
+    with open(path) as f:
+        # First line is the header
+        lines = f.read().splitlines()[1:]
+    if not lines:
+        raise ValueError(f'No data in {path}')
+    labels, values = zip(*(line.rsplit(',', 1) for line in lines))
+    return list(labels), list(values)
+
+@lru_cache(maxsize=None)
+def annotation_gene_ids(directory: Path, annotation_hash: str) -> Tuple[pd.Index, str]:
+    """
+    :return: 2-tuple: gene IDs of an annotation saved with binary sample
+        files, and their hash
+    """
+    gene_ids = load_annotation(directory, annotation_hash).index
+    return gene_ids, gene_id_hash(gene_ids)
+
+def parse_csv_srr_output(srr_id: str, rpkm_path: Path, summary_path: Path) -> ParsedSrrOutput:
+    gene_ids, rpkm_strings = read_series_csv(rpkm_path)
+    # NaN values are written as empty strings
+    rpkm = np.array([value or 'nan' for value in rpkm_strings], dtype=np.float64)
+
+    summary_labels, summary_strings = read_series_csv(summary_path)
+    summary = pd.Series([int(value) for value in summary_strings], index=summary_labels)
+
+    return ParsedSrrOutput(
+        srr_id=srr_id,
+        gene_id_hash=gene_id_hash(gene_ids),
+        rpkm=rpkm,
+        summary=summary,
+    )
+
+def parse_binary_srr_output(srr_id: str, path: Path) -> ParsedSrrOutput:
+    sample = read_binary_sample(path)
+    gene_length = load_annotation(path.parent, sample.annotation_hash)
+    _, hash_value = annotation_gene_ids(path.parent, sample.annotation_hash)
+    return ParsedSrrOutput(
+        srr_id=srr_id,
+        gene_id_hash=hash_value,
+        rpkm=sample_rpkm(sample, gene_length),
+        summary=sample.summary,
+    )
+
+def parse_srr_output(srr_id: str, output_format: str, output_path: Path) -> ParsedSrrOutput:
+    if output_format == 'binary':
+        return parse_binary_srr_output(
+            srr_id,
+            output_path / BINARY_DIRECTORY_NAME / f'{srr_id}{BINARY_SUFFIX}',
+        )
+    return parse_csv_srr_output(
+        srr_id,
+        output_path / RPKM_DIRECTORY_NAME / f'{srr_id}{CSV_SUFFIX}',
+        output_path / SUMMARY_DIRECTORY_NAME / f'{srr_id}{CSV_SUFFIX}',
+    )
+
+def read_srr_gene_ids(srr_id: str, output_format: str, output_path: Path) -> pd.Index:
+    if output_format == 'binary':
+        sample = read_binary_sample(output_path / BINARY_DIRECTORY_NAME / f'{srr_id}{BINARY_SUFFIX}')
+        gene_ids, _ = annotation_gene_ids(output_path / BINARY_DIRECTORY_NAME, sample.annotation_hash)
+        return gene_ids
+    gene_ids, _ = read_series_csv(output_path / RPKM_DIRECTORY_NAME / f'{srr_id}{CSV_SUFFIX}')
+    return pd.Index(gene_ids)
+
+def find_srr_outputs(output_path: Path) -> List[Tuple[str, str]]:
+    """
+    :return: Sorted list of 2-tuples: SRR ID and output format. CSV output
+        is only included if both the RPKM and summary files exist, since the
+        summary is written last. If an SRR ID has output in both formats,
+        the binary file is used.
+    """
+    srr_outputs = {}
+    summary_dir = output_path / SUMMARY_DIRECTORY_NAME
+    for rpkm_path in (output_path / RPKM_DIRECTORY_NAME).glob(f'*{CSV_SUFFIX}'):
+        if (summary_dir / rpkm_path.name).is_file():
+            srr_outputs[rpkm_path.stem] = 'csv'
+    for binary_path in (output_path / BINARY_DIRECTORY_NAME).glob(f'*{BINARY_SUFFIX}'):
+        srr_outputs[binary_path.stem] = 'binary'
+    return sorted(srr_outputs.items())
+
+class AggregateStore:
+    """
+    Output file of the aggregation. Each batch appends alignment metadata
+    first, then RPKM rows; a merged SRR ID is one with a complete row in the
+    RPKM matrix. If merging was interrupted, alignment metadata rows past
+    the end of the matrix are removed when the file is reopened.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.store = pd.HDFStore(path)
+        self.rpkm_path = f'/{SPARSE_RPKM_KEY}'
+        self.writer: Optional[SparseMatrixWriter] = None
+
+        self.gene_ids: Optional[pd.Index] = None
+        self.srr_ids: Set[str] = set()
+        if self.rpkm_path in self.store:
+            reader = SparseMatrixReader(self.h5_file, self.rpkm_path)
+            self.gene_ids = reader.column_names()
+            self.srr_ids = set(reader.row_names())
+            self.writer = SparseMatrixWriter(self.h5_file, self.rpkm_path, self.gene_ids)
+
+        if ALIGNMENT_METADATA_KEY in self.store:
+            metadata_rows = self.store.get_storer(ALIGNMENT_METADATA_KEY).nrows
+            if metadata_rows > len(self.srr_ids):
+                print(f'Removing {metadata_rows - len(self.srr_ids)} incomplete rows from {path}')
+                self.store.remove(ALIGNMENT_METADATA_KEY, start=len(self.srr_ids))
+
+    @property
+    def h5_file(self):
+        return self.store.root._v_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.store.close()
+
+    def set_gene_ids(self, gene_ids: pd.Index):
+        self.gene_ids = pd.Index(gene_ids)
+        self.writer = SparseMatrixWriter(self.h5_file, self.rpkm_path, self.gene_ids)
+
+    def append(self, outputs: List[ParsedSrrOutput]):
+        if not outputs:
+            return
+        alignment_metadata = pd.DataFrame(
+            [output.summary for output in outputs],
+            index=[output.srr_id for output in outputs],
+        )
+        self.store.append(
+            ALIGNMENT_METADATA_KEY,
+            alignment_metadata,
+            format='table',
+            min_itemsize={'index': SRR_ID_MAX_LENGTH},
+        )
+        for output in outputs:
+            indices = np.flatnonzero(output.rpkm != 0)
+            self.writer.append_sparse_row(output.srr_id, indices, output.rpkm[indices])
+            self.srr_ids.add(output.srr_id)
+        self.store.flush(fsync=True)
+
+def aggregate_srr_outputs(output_path: Path, output_file: Path, jobs: int):
+    with AggregateStore(output_file) as store:
+        srr_outputs = [
+            (srr_id, output_format)
+            for srr_id, output_format in find_srr_outputs(output_path)
+            if srr_id not in store.srr_ids
+        ]
+        print(f'Merging {len(srr_outputs)} new SRR IDs into {output_file} ({len(store.srr_ids)} already merged)')
+        if not srr_outputs:
+            return
+
+        if store.gene_ids is None:
+            store.set_gene_ids(read_srr_gene_ids(*srr_outputs[0], output_path))
+        expected_hash = gene_id_hash(store.gene_ids)
+
+        mismatched_srr_ids = []
+        failed_srr_ids = []
+        merged_count = 0
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for batch in grouper(srr_outputs, BATCH_SIZE):
+                batch = [srr_output for srr_output in batch if srr_output is not None]
+                futures = [
+                    executor.submit(parse_srr_output, srr_id, output_format, output_path)
+                    for srr_id, output_format in batch
+                ]
+                outputs = []
+                for (srr_id, _), future in zip(batch, futures):
+                    try:
+                        output = future.result()
+                    except (ValueError, OSError) as e:
+                        print(f'Skipping {srr_id}: {e}')
+                        failed_srr_ids.append(srr_id)
+                        continue
+                    if output.gene_id_hash != expected_hash:
+                        print(f'Skipping {srr_id}: genes do not match those in {output_file}')
+                        mismatched_srr_ids.append(srr_id)
+                        continue
+                    outputs.append(output)
+                store.append(outputs)
+                merged_count += len(outputs)
+                print(f'Merged {merged_count} of {len(srr_outputs)} SRR IDs')
+
+    if mismatched_srr_ids or failed_srr_ids:
+        print(
+            f'Skipped {len(mismatched_srr_ids)} SRR IDs with different genes and '
+            f'{len(failed_srr_ids)} SRR IDs with unreadable files'
+        )
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument(
+        '--output-path',
+        type=Path,
+        default=OUTPUT_PATH,
+        help=normalize_whitespace(
+            f"""
+            Directory containing '{RPKM_DIRECTORY_NAME}' and '{SUMMARY_DIRECTORY_NAME}'
+            subdirectories of per-SRR CSV files, and/or an '{BINARY_DIRECTORY_NAME}'
+            subdirectory of binary files. Defaults to {OUTPUT_PATH}.
+            """
+        ),
+    )
+    p.add_argument(
+        '--output-file',
+        type=Path,
+        help=normalize_whitespace(
+            f"""
+            HDF5 file to create, or to add new SRR IDs to. Defaults to
+            '{DEFAULT_OUTPUT_FILENAME}' in the output path.
+            """
+        ),
+    )
+    p.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of processes parsing files. Defaults to the number of cores.',
+    )
+    args = p.parse_args()
+
+    if args.output_file is None:
+        args.output_file = args.output_path / DEFAULT_OUTPUT_FILENAME
+
+    aggregate_srr_outputs(args.output_path, args.output_file, args.jobs)
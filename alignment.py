@@ -1,41 +1,40 @@
 #!/usr/bin/env python3
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 import shlex
-from subprocess import check_call, check_output
-from typing import List, Optional, Tuple
+from subprocess import PIPE, CalledProcessError, Popen, check_call
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
 
 from data_path_utils import append_to_filename
-import pandas as pd
 
-from map_reads_to_genes import map_reads_to_genes
+from compression import compression_suffix, fastq_base_name, start_decompression_fifo
+import count_cache
+from map_reads_to_genes import GeneCounts, map_reads_to_genes, map_sam_file_to_genes
+from named_pipes import ProducerGroup, create_fifos, kill_process_group
 from paths import *
+from pipeline import Stage
+import scratch
+from sra_conversion import FASTQ_CONVERT_COMMAND_TEMPLATE, active_converter, convert_sra_to_fastq, is_paired_sra
+import telemetry
 
-FASTQ_TEST_COMMAND_TEMPLATE = [
-    '{fastq_dump_command}',
-    '-X',
-    '1',
-    '-Z',
-    '--split-spot',
-    '{input_path}'
-]
-
-FASTQ_CONVERT_COMMAND_TEMPLATE = [
-    '{fastq_dump_command}',
-    '{input_path}',
-    '-O',
-    '{output_path}',
-]
+T = TypeVar('T')
 
 HISAT2_COMMAND_COMMON_PIECES = [
     '{hisat2_command}',
     '-x',
     '{reference_path}',
-    '-S',
-    '{output_path}',
     '-p',
     '{subprocesses}',
 ]
 
+# Omitted when streaming alignments; HISAT2 writes SAM to stdout by default
+HISAT2_SAM_OUTPUT_PIECES = [
+    '-S',
+    '{output_path}',
+]
+
 HISAT2_PAIRED_END_PIECES = [
     '-1',
     '{input_path_1}',
@@ -48,80 +47,78 @@ HISAT2_SINGLE_END_PIECES = [
     '{input_path}',
 ]
 
-def is_paired_sra(sra_path: Path) -> bool:
-    try:
-        fastq_command = [
-            piece.format(
-                fastq_dump_command=FASTQ_DUMP_PATH,
-                input_path=sra_path
-            )
-            for piece in FASTQ_TEST_COMMAND_TEMPLATE
-        ]
-        print('Running', ' '.join(fastq_command))
-        contents = check_output(fastq_command).decode('utf-8')
-    except Exception as e:
-        raise Exception(f"Error running fastq-dump on {sra_path}") from e
-    newline = '\n'
-    if contents.count(newline) == 4:
-        return False
-    elif contents.count(newline) == 8:
-        return True
-    else:
-        raise ValueError(f'Unexpected output from {FASTQ_DUMP_PATH.name} on {sra_path}:\n{contents!r}')
-
-def convert_sra_to_fastq(sra_path: Path, scratch_dir: Optional[Path]=None) -> List[Path]:
+def start_sra_to_fastq_fifo(sra_path: Path, fifo_dir: Path) -> Tuple[List[Path], ProducerGroup]:
     """
-    :param sra_path:
-    :param scratch_dir: Directory where the FASTQ file will be stored, with
-        the same name as the SRA file. If omitted, the FASTQ file will be
-        written to the same directory as the SRA file.
-    :return: A List of fastq Paths. Contains one Path if single-end,
-        two if paired-end.
-    """
-    if scratch_dir is None:
-        scratch_dir = sra_path.parent
+    Starts fastq-dump writing into named pipes in `fifo_dir`, instead of
+    writing FASTQ files to disk. The FIFOs have the same names as the files
+    that `convert_sra_to_fastq` would create, so fastq-dump opens them as
+    its output files.
 
+    :return: 2-tuple: list of FIFO paths (one if single-end, two if
+        paired-end), and the running fastq-dump process, to be supervised
+        while the FIFOs are read
+    """
     fastq_command = [
-            piece.format(
-                fastq_dump_command=FASTQ_DUMP_PATH,
-                input_path=sra_path,
-                output_path=scratch_dir,
-            )
-            for piece in FASTQ_CONVERT_COMMAND_TEMPLATE
+        piece.format(
+            fastq_dump_command=FASTQ_DUMP_PATH,
+            input_path=sra_path,
+            output_path=fifo_dir,
+        )
+        for piece in FASTQ_CONVERT_COMMAND_TEMPLATE
+    ]
+
+    fastq_filename = sra_path.with_suffix('.fastq').name
+    if is_paired_sra(sra_path):
+        fastq_command.append('--split-files')
+        fifo_filenames = [
+            append_to_filename(Path(fastq_filename), suffix).name
+            for suffix in ['_1', '_2']
         ]
+    else:
+        fifo_filenames = [fastq_filename]
 
-    paired_end = is_paired_sra(sra_path)
+    fifo_paths = create_fifos(fifo_dir, fifo_filenames)
+    producers = ProducerGroup(fifo_paths)
+    producers.start(fastq_command)
+    return fifo_paths, producers
 
-    if paired_end:
-        fastq_command.append('--split-files')
+def default_sam_path(fastq_paths: List[Path]) -> Path:
+    return fastq_paths[0].parent / f'{fastq_base_name(fastq_paths[0])}.sam'
 
-    print('Running', ' '.join(fastq_command))
-    check_call(fastq_command)
+def is_compressed(fastq_paths: List[Path]) -> bool:
+    return any(compression_suffix(path) for path in fastq_paths)
 
-    if paired_end:
-        fastq_path_1 = append_to_filename(scratch_dir / sra_path.with_suffix('.fastq').name, '_1')
-        fastq_path_2 = append_to_filename(scratch_dir / sra_path.with_suffix('.fastq').name, '_2')
-        fastq_paths = [fastq_path_1, fastq_path_2]
-    else:
-        fastq_paths = [scratch_dir / sra_path.with_suffix('.fastq').name]
+@contextmanager
+def decompressed_fastq(
+        fastq_paths: List[Path],
+        threads: int,
+) -> Iterator[Tuple[List[Path], ProducerGroup]]:
+    """
+    Streams compressed FASTQ files through named pipes, for the duration
+    of the `with` block.
 
-    return fastq_paths
+    :return: 2-tuple: paths to pass to HISAT2 instead of `fastq_paths`, and
+        the running decompression processes
+    """
+    with TemporaryDirectory(prefix='fastq_fifo_', dir=fastq_paths[0].parent) as fifo_dir:
+        fifo_paths, producers = start_decompression_fifo(fastq_paths, Path(fifo_dir), threads)
+        try:
+            yield fifo_paths, producers
+        except BaseException:
+            producers.kill()
+            raise
 
-def align_fastq_compute_expr(
+def build_hisat2_command(
         fastq_paths: List[Path],
         subprocesses: int,
-        sam_path: Optional[Path]=None,
+        sam_path: Optional[Path],
         hisat2_options: Optional[str]=None,
         reference_path: Optional[Path]=None,
-) -> Tuple[pd.Series, pd.Series]:
-    # Bail out early if no FASTQ files provided, so we can use the first
-    # to assign `sam_path` if necessary
-    if not fastq_paths:
-        raise ValueError('No FASTQ files provided')
-
-    if sam_path is None:
-        sam_path = fastq_paths[0].with_suffix('.sam')
-
+) -> List[str]:
+    """
+    :param sam_path: Where HISAT2 should save alignments. If None, HISAT2
+        writes SAM records to stdout.
+    """
     if reference_path is None:
         reference_path = REFERENCE_INDEX_PATH
 
@@ -129,11 +126,15 @@ def align_fastq_compute_expr(
         piece.format(
             hisat2_command=HISAT2_PATH,
             reference_path=reference_path,
-            output_path=sam_path,
             subprocesses=subprocesses,
         )
         for piece in HISAT2_COMMAND_COMMON_PIECES
     ]
+    if sam_path is not None:
+        hisat_command.extend(
+            piece.format(output_path=sam_path)
+            for piece in HISAT2_SAM_OUTPUT_PIECES
+        )
     if hisat2_options is not None:
         hisat_command.extend(shlex.split(hisat2_options))
 
@@ -157,14 +158,196 @@ def align_fastq_compute_expr(
         message_pieces.extend(f'\t{path}' for path in fastq_paths)
         raise ValueError('\n'.join(message_pieces))
 
+    return hisat_command
+
+def run_hisat2(hisat_command: List[str], producers: Optional[ProducerGroup]=None):
+    print('Running', ' '.join(hisat_command))
+    with telemetry.stage('align'):
+        if producers is None:
+            check_call(telemetry.instrument(hisat_command, 'hisat2'))
+            return
+
+        with Popen(telemetry.instrument(hisat_command, 'hisat2'), start_new_session=True) as hisat2:
+            producers.supervise(hisat2)
+        producers.finish(hisat2, hisat_command)
+
+def align_fastq(
+        fastq_paths: List[Path],
+        subprocesses: int,
+        sam_path: Optional[Path]=None,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        producers: Optional[ProducerGroup]=None,
+) -> Path:
+    """
+    Runs HISAT2 without quantifying expression, for callers that run
+    alignment and quantification as separate steps.
+
+    :param producers: Processes writing FASTQ data into `fastq_paths`, if
+        these are named pipes
+    :return: Path to SAM file
+    """
+    if not fastq_paths:
+        raise ValueError('No FASTQ files provided')
+
+    if sam_path is None:
+        sam_path = default_sam_path(fastq_paths)
+
+    if producers is None and is_compressed(fastq_paths):
+        with decompressed_fastq(fastq_paths, subprocesses) as (fifo_paths, producers):
+            return align_fastq(
+                fastq_paths=fifo_paths,
+                subprocesses=subprocesses,
+                sam_path=sam_path,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                producers=producers,
+            )
+
+    hisat_command = build_hisat2_command(
+        fastq_paths=fastq_paths,
+        subprocesses=subprocesses,
+        sam_path=sam_path,
+        hisat2_options=hisat2_options,
+        reference_path=reference_path,
+    )
+    run_hisat2(hisat_command, producers)
+    return sam_path
+
+def align_fastq_compute_expr(
+        fastq_paths: List[Path],
+        subprocesses: int,
+        sam_path: Optional[Path]=None,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        stream_alignment: bool=False,
+        producers: Optional[ProducerGroup]=None,
+        use_cache: bool=True,
+) -> GeneCounts:
+    """
+    :param fastq_paths: One or two FASTQ files, optionally compressed with
+        gzip or bzip2. Compressed files are decompressed into named pipes
+        as HISAT2 reads them.
+    :param stream_alignment: If True, read HISAT2 output from a pipe and
+        count reads as they are aligned, instead of writing a SAM file to
+        disk and reading it back afterward. `sam_path` is ignored in this
+        case.
+    :param producers: Processes writing FASTQ data into `fastq_paths`, if
+        these are named pipes. HISAT2 is killed if any of these fail, and
+        vice versa.
+    :param use_cache: Whether to look up and store the result in the
+        configured count cache (see `count_cache`), keyed by checksums of
+        `fastq_paths`. Named pipes are never looked up.
+    """
+    # Bail out early if no FASTQ files provided, so we can use the first
+    # to assign `sam_path` if necessary
+    if not fastq_paths:
+        raise ValueError('No FASTQ files provided')
+
+    cache = count_cache.current()
+    if use_cache and producers is None and cache is not None:
+        key = cache.key(cache.file_input(fastq_paths), hisat2_options, reference_path)
+        return cache.cached(
+            key,
+            partial(
+                align_fastq_compute_expr,
+                fastq_paths=fastq_paths,
+                subprocesses=subprocesses,
+                sam_path=sam_path,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                stream_alignment=stream_alignment,
+                use_cache=False,
+            ),
+        )
+
+    space = scratch.current()
+    if sam_path is None and not stream_alignment and space is not None:
+        with space.directory(scratch.estimate_sam_bytes(fastq_paths), 'sam_') as sam_dir:
+            return align_fastq_compute_expr(
+                fastq_paths=fastq_paths,
+                subprocesses=subprocesses,
+                sam_path=sam_dir / default_sam_path(fastq_paths).name,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                producers=producers,
+                use_cache=use_cache,
+            )
+
+    if sam_path is None:
+        sam_path = default_sam_path(fastq_paths)
+
+    if producers is None and is_compressed(fastq_paths):
+        with decompressed_fastq(fastq_paths, subprocesses) as (fifo_paths, producers):
+            return align_fastq_compute_expr(
+                fastq_paths=fifo_paths,
+                subprocesses=subprocesses,
+                sam_path=sam_path,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                stream_alignment=stream_alignment,
+                producers=producers,
+                use_cache=use_cache,
+            )
+
+    if stream_alignment:
+        hisat_command = build_hisat2_command(
+            fastq_paths=fastq_paths,
+            subprocesses=subprocesses,
+            sam_path=None,
+            hisat2_options=hisat2_options,
+            reference_path=reference_path,
+        )
+        return stream_alignment_compute_expr(hisat_command, producers)
+
     try:
-        print('Running', ' '.join(hisat_command))
-        check_call(hisat_command)
+        align_fastq(
+            fastq_paths=fastq_paths,
+            subprocesses=subprocesses,
+            sam_path=sam_path,
+            hisat2_options=hisat2_options,
+            reference_path=reference_path,
+            producers=producers,
+        )
         print('Computing RPKM from', sam_path)
-        rpkm, summary = map_reads_to_genes(sam_path)
+        with telemetry.stage('quantify'):
+            result = map_reads_to_genes(sam_path)
     finally:
-        sam_path.unlink()
-    return rpkm, summary
+        # HISAT2 may have failed before creating the file
+        if sam_path.is_file():
+            sam_path.unlink()
+    return result
+
+def stream_alignment_compute_expr(
+        hisat_command: List[str],
+        producers: Optional[ProducerGroup]=None,
+        quantify: Callable[[BinaryIO], T]=map_sam_file_to_genes,
+) -> T:
+    """
+    :param quantify: Called with HISAT2's output stream while HISAT2 is
+        running, e.g. `map_sam_file_to_genes`
+    :return: Return value of `quantify`
+    """
+    print('Running', ' '.join(hisat_command))
+    with telemetry.stage('align_and_quantify'):
+        with Popen(telemetry.instrument(hisat_command, 'hisat2'), stdout=PIPE, start_new_session=True) as hisat2:
+            if producers is not None:
+                producers.supervise(hisat2)
+            try:
+                print('Computing expression from HISAT2 output stream')
+                result = quantify(hisat2.stdout)
+            except BaseException:
+                # Don't leave HISAT2 blocked on a full pipe that nobody reads
+                kill_process_group(hisat2)
+                if producers is not None:
+                    producers.kill()
+                raise
+        # Leaving the `with` block waits for HISAT2 to exit
+        if producers is not None:
+            producers.finish(hisat2, hisat_command)
+    if hisat2.returncode:
+        raise CalledProcessError(hisat2.returncode, hisat_command)
+    return result
 
 def process_sra_file(
         sra_path: Path,
@@ -172,12 +355,201 @@ def process_sra_file(
         sam_path: Optional[Path]=None,
         hisat2_options: Optional[str] = None,
         reference_path: Optional[Path] = None,
-) -> Tuple[pd.Series, pd.Series]:
-    fastq_paths = convert_sra_to_fastq(sra_path)
+        stream_alignment: bool = False,
+        fastq_fifo: bool = False,
+        scratch_dir: Optional[Path] = None,
+        srr_id: Optional[str] = None,
+        use_cache: bool = True,
+) -> GeneCounts:
+    """
+    :param fastq_fifo: If True, stream fastq-dump output to HISAT2 through
+        named pipes instead of writing FASTQ files to disk
+    :param scratch_dir: Directory for FASTQ files and named pipes. If
+        omitted, one is allocated from the configured scratch space (see
+        `scratch`), or the directory of the SRA file is used.
+    :param srr_id: SRR ID the SRA file was downloaded for, which identifies
+        it in the count cache instead of a checksum of the file
+    :param use_cache: Whether to look up and store the result in the
+        configured count cache; see `count_cache`
+    """
+    cache = count_cache.current()
+    if use_cache and cache is not None:
+        if srr_id is None:
+            inputs = cache.file_input([sra_path])
+        else:
+            inputs = count_cache.srr_input(srr_id)
+        return cache.cached(
+            cache.key(inputs, hisat2_options, reference_path, active_converter(fastq_fifo)),
+            partial(
+                process_sra_file,
+                sra_path=sra_path,
+                subprocesses=subprocesses,
+                sam_path=sam_path,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                stream_alignment=stream_alignment,
+                fastq_fifo=fastq_fifo,
+                scratch_dir=scratch_dir,
+                use_cache=False,
+            ),
+        )
+
+    space = scratch.current()
+    if scratch_dir is None and space is not None:
+        # FASTQ and SAM files exist at the same time, until alignment finishes
+        estimated_bytes = scratch.estimate_sra_bytes(
+            sra_path,
+            fastq=not fastq_fifo,
+            sam=sam_path is None and not stream_alignment,
+        )
+        with space.directory(estimated_bytes, 'sra_') as scratch_dir:
+            return process_sra_file(
+                sra_path=sra_path,
+                subprocesses=subprocesses,
+                sam_path=sam_path or scratch_dir / sra_path.with_suffix('.sam').name,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                stream_alignment=stream_alignment,
+                fastq_fifo=fastq_fifo,
+                scratch_dir=scratch_dir,
+                use_cache=False,
+            )
+
+    if scratch_dir is None:
+        scratch_dir = sra_path.parent
+
+    if fastq_fifo:
+        with TemporaryDirectory(prefix='fastq_fifo_', dir=scratch_dir) as fifo_dir:
+            fastq_paths, producers = start_sra_to_fastq_fifo(sra_path, Path(fifo_dir))
+            if sam_path is None:
+                # Not in the FIFO directory, which is removed afterward
+                sam_path = sra_path.with_suffix('.sam')
+            try:
+                return align_fastq_compute_expr(
+                    fastq_paths=fastq_paths,
+                    subprocesses=subprocesses,
+                    sam_path=sam_path,
+                    hisat2_options=hisat2_options,
+                    reference_path=reference_path,
+                    stream_alignment=stream_alignment,
+                    producers=producers,
+                    use_cache=False,
+                )
+            except BaseException:
+                # e.g. if HISAT2 couldn't be started, fastq-dump would
+                # otherwise wait forever for a reader
+                producers.kill()
+                raise
+
+    fastq_paths = convert_sra_to_fastq(sra_path, scratch_dir)
     return align_fastq_compute_expr(
         fastq_paths=fastq_paths,
         subprocesses=subprocesses,
         sam_path=sam_path,
         hisat2_options=hisat2_options,
         reference_path=reference_path,
+        stream_alignment=stream_alignment,
+        use_cache=False,
     )
+
+def remove_files(paths: Iterable[Path], release: bool=True):
+    """
+    :param release: Whether to also release any scratch directories holding
+        these files; see `scratch`. Not if other files in these directories
+        are still needed.
+    """
+    paths = list(paths)
+    for path in paths:
+        if path.is_file():
+            path.unlink()
+    if release:
+        scratch.release_directories(paths)
+
+def sra_conversion_stage(remove_sra: bool=False) -> Stage:
+    """
+    :param remove_sra: Whether to delete each SRA file after converting it
+        to FASTQ, e.g. if it was downloaded by an earlier pipeline stage
+    """
+    def convert(sra_path: Path) -> List[Path]:
+        try:
+            space = scratch.current()
+            if space is None:
+                return convert_sra_to_fastq(sra_path)
+            # Also reserves space for the SAM file, which the align stage
+            # writes to the same directory. If that stage allocated its own,
+            # FASTQ files of later items could take all of the budget while
+            # it waits, and neither stage could continue.
+            scratch_dir = space.allocate(scratch.estimate_sra_bytes(sra_path), 'sra_')
+            try:
+                return convert_sra_to_fastq(sra_path, scratch_dir)
+            except BaseException:
+                space.release(scratch_dir)
+                raise
+        finally:
+            if remove_sra:
+                remove_files([sra_path])
+
+    return Stage('convert', convert, discard=remove_files)
+
+def alignment_stages(
+        subprocesses: int,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        align_workers: int=1,
+        remove_fastq: bool=False,
+) -> List[Stage]:
+    """
+    :param align_workers: Number of concurrent HISAT2 runs, each with
+        `subprocesses` threads
+    :param remove_fastq: Whether to delete FASTQ files after alignment, e.g.
+        if they were converted from SRA by an earlier pipeline stage
+    :return: Pipeline stages taking a list of FASTQ paths as input, and
+        producing a 2-tuple of (RPKM, summary)
+    """
+    def align(fastq_paths: List[Path]) -> Path:
+        space = scratch.current()
+        # Directory allocated by `sra_conversion_stage`, with room for the
+        # SAM file as well
+        fastq_dir = fastq_paths[0].parent
+        shared_dir = space is not None and fastq_dir in space.allocated
+        try:
+            if space is None:
+                return align_fastq(
+                    fastq_paths=fastq_paths,
+                    subprocesses=subprocesses,
+                    hisat2_options=hisat2_options,
+                    reference_path=reference_path,
+                )
+            if shared_dir:
+                sam_dir = fastq_dir
+            else:
+                sam_dir = space.allocate(scratch.estimate_sam_bytes(fastq_paths), 'sam_')
+            try:
+                return align_fastq(
+                    fastq_paths=fastq_paths,
+                    subprocesses=subprocesses,
+                    sam_path=sam_dir / default_sam_path(fastq_paths).name,
+                    hisat2_options=hisat2_options,
+                    reference_path=reference_path,
+                )
+            except BaseException:
+                space.release(sam_dir)
+                raise
+        finally:
+            if remove_fastq:
+                remove_files(fastq_paths, release=not shared_dir)
+
+    def quantify(sam_path: Path) -> GeneCounts:
+        try:
+            print('Computing RPKM from', sam_path)
+            with telemetry.stage('quantify'):
+                return map_reads_to_genes(sam_path)
+        finally:
+            remove_files([sam_path])
+
+    return [
+        Stage('align', align, workers=align_workers, discard=lambda sam_path: remove_files([sam_path])),
+        Stage('quantify', quantify),
+    ]
+
+del T
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Cell barcodes and UMIs (unique molecular identifiers) for droplet-style
+single-cell libraries, in which reads from many cells are sequenced together.
+
+Barcodes and UMIs are carried through alignment in read names, following the
+UMI-tools convention: '{read name}_{barcode}_{UMI}'. HISAT2 copies read
+names to the QNAME field of its output, so the barcode and UMI of each
+alignment are a fixed-width suffix of QNAME, which `SamChunkReader` can
+extract without creating per-read Python objects.
+
+Barcode and UMI sequences are packed into integers, at 2 bits per base, so
+tables of barcodes are plain NumPy integer arrays. Sequences containing
+anything other than A, C, G or T (e.g. N) are treated as invalid.
+
+If barcodes and UMIs are in a separate read, as with 10x Genomics libraries,
+they are appended to the names of the cDNA reads by awk as the reads are
+passed to HISAT2, after decompression by the same external programs used
+for compressed input to HISAT2 (see `compression`); see
+`start_barcode_tagging_fifo`.
+"""
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from compression import MAX_DECOMPRESSION_THREADS, compression_suffix, decompression_command, fastq_base_name
+from named_pipes import ProducerGroup, create_fifos
+from utils import normalize_whitespace
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+INVALID_BASE_CODE = 255
+BASE_CODES = np.full(256, INVALID_BASE_CODE, dtype=np.uint8)
+BASE_CODES[BASES] = np.arange(len(BASES))
+
+# Sequences are packed into uint64 values
+MAX_PACKED_LENGTH = 32
+
+TAG_SEPARATOR = '_'
+
+# Reads the barcode FASTQ file at `barcode_path` alongside the cDNA reads
+# on the main input, and appends `separator`, the barcode, and (if
+# `umi_length` is nonzero) `separator` and the UMI from the start of each
+# barcode read to the name of the cDNA read, without any '/1' or '/2' mate
+# suffix or comment. Fails if read names don't match, a barcode read is too
+# short, the files have different numbers of reads, or the cDNA file ends
+# with an incomplete record.
+TAG_READS_AWK_PROGRAM = r"""
+function fail(message) {
+    print message > "/dev/stderr"
+    failed = 1
+    exit 1
+}
+function read_name(header_line,    fields, read) {
+    split(header_line, fields)
+    read = substr(fields[1], 2)
+    sub(/\/[12]$/, "", read)
+    return read
+}
+function next_barcode_line(    line) {
+    if ((getline line < barcode_path) <= 0) {
+        fail("Barcode and cDNA FASTQ files have different numbers of reads")
+    }
+    return line
+}
+FNR % 4 == 1 {
+    name = read_name($0)
+    barcode_header_line = next_barcode_line()
+    tag_sequence = next_barcode_line()
+    next_barcode_line()
+    next_barcode_line()
+    if (read_name(barcode_header_line) != name) {
+        fail("Barcode read " barcode_header_line " does not match cDNA read " name)
+    }
+    if (length(tag_sequence) < barcode_length + umi_length) {
+        fail("Barcode read " name " is shorter than " (barcode_length + umi_length) " bases")
+    }
+    suffix = separator substr(tag_sequence, 1, barcode_length)
+    if (umi_length) {
+        suffix = suffix separator substr(tag_sequence, barcode_length + 1, umi_length)
+    }
+    print "@" name suffix
+    next
+}
+{ print }
+END {
+    if (failed) {
+        exit 1
+    }
+    if (FNR % 4) {
+        fail("Truncated FASTQ record at end of " FILENAME)
+    }
+    if ((getline line < barcode_path) > 0) {
+        fail("Barcode and cDNA FASTQ files have different numbers of reads")
+    }
+}
+"""
+
+class ReadTagLayout(NamedTuple):
+    barcode_length: int
+    # Zero if reads have no UMIs
+    umi_length: int = 0
+
+    @property
+    def suffix_length(self) -> int:
+        """
+        :return: Length of the read name suffix with the barcode and UMI,
+            including separators
+        """
+        length = len(TAG_SEPARATOR) + self.barcode_length
+        if self.umi_length:
+            length += len(TAG_SEPARATOR) + self.umi_length
+        return length
+
+    def validate(self):
+        for name, length in [('Barcode', self.barcode_length), ('UMI', self.umi_length)]:
+            if not 0 <= length <= MAX_PACKED_LENGTH:
+                raise ValueError(f'{name} length must be between 0 and {MAX_PACKED_LENGTH}, not {length}')
+        if not self.barcode_length:
+            raise ValueError('Barcode length must be positive')
+
+    def format_suffix(self, barcode: str, umi: str) -> str:
+        if self.umi_length:
+            return f'{TAG_SEPARATOR}{barcode}{TAG_SEPARATOR}{umi}'
+        return f'{TAG_SEPARATOR}{barcode}'
+
+    def parse_suffixes(self, suffixes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param suffixes: Last `suffix_length` bytes of each read name, as a
+            2-D uint8 array; see `SamChunk.qname_suffixes`
+        :return: 3-tuple: packed barcodes, packed UMIs (all zero if there
+            are no UMIs), and a boolean array of whether each read name has
+            a valid barcode and UMI
+        """
+        separator = ord(TAG_SEPARATOR)
+        barcode_start = len(TAG_SEPARATOR)
+        barcode_end = barcode_start + self.barcode_length
+        barcodes, valid = pack_sequences(suffixes[:, barcode_start:barcode_end])
+        valid &= suffixes[:, 0] == separator
+
+        if self.umi_length:
+            umis, valid_umis = pack_sequences(suffixes[:, barcode_end + len(TAG_SEPARATOR):])
+            valid &= valid_umis & (suffixes[:, barcode_end] == separator)
+        else:
+            umis = np.zeros(len(suffixes), dtype=np.uint64)
+        return barcodes, umis, valid
+
+def add_barcode_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--barcode-length',
+        type=int,
+        required=True,
+        help=normalize_whitespace(
+            f"""
+            Length of cell barcodes. Read names must end with
+            '{TAG_SEPARATOR}<barcode>', or '{TAG_SEPARATOR}<barcode>{TAG_SEPARATOR}<UMI>'
+            if --umi-length is given, unless barcodes are read from a separate read.
+            """
+        ),
+    )
+    p.add_argument(
+        '--umi-length',
+        type=int,
+        default=0,
+        help='Length of UMIs. Default: 0, for reads without UMIs.',
+    )
+
+def pack_sequences(chars: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param chars: 2-D uint8 array of ASCII bases, one sequence per row, of
+        at most `MAX_PACKED_LENGTH` bases
+    :return: 2-tuple: packed uint64 sequences, and boolean array of whether
+        each sequence contains only A, C, G and T
+    """
+    codes = BASE_CODES[chars]
+    valid = (codes != INVALID_BASE_CODE).all(axis=1)
+    packed = np.zeros(len(chars), dtype=np.uint64)
+    for column in range(chars.shape[1]):
+        packed = (packed << np.uint64(2)) | (codes[:, column] & 3).astype(np.uint64)
+    return packed, valid
+
+def unpack_sequences(packed: np.ndarray, length: int) -> List[str]:
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+    codes = (packed[:, np.newaxis] >> shifts) & np.uint64(3)
+    chars = np.ascontiguousarray(BASES[codes.astype(np.intp)])
+    return [sequence.decode('ascii') for sequence in chars.view(f'S{length}').reshape(-1)]
+
+def tag_reads_command(barcode_read_path: Path, cdna_path: Path, layout: ReadTagLayout) -> List[str]:
+    """
+    :return: awk command writing the reads in `cdna_path` to stdout, with
+        the barcode and UMI from the start of the corresponding read in
+        `barcode_read_path` appended to each read name
+    """
+    return [
+        'awk',
+        '-v',
+        f'barcode_path={barcode_read_path}',
+        '-v',
+        f'barcode_length={layout.barcode_length}',
+        '-v',
+        f'umi_length={layout.umi_length}',
+        '-v',
+        f'separator={TAG_SEPARATOR}',
+        TAG_READS_AWK_PROGRAM,
+        # Absolute paths can't be mistaken for awk variable assignments
+        str(cdna_path.absolute()),
+    ]
+
+def start_barcode_tagging_fifo(
+        barcode_read_path: Path,
+        cdna_path: Path,
+        fifo_dir: Path,
+        layout: ReadTagLayout,
+        threads: int=1,
+) -> Tuple[List[Path], ProducerGroup]:
+    """
+    Starts a process writing tagged cDNA reads into a named pipe in
+    `fifo_dir`. Compressed files are decompressed into further named pipes
+    in `fifo_dir`.
+
+    :param threads: Number of threads for each decompression process
+    :return: 2-tuple: list containing the FIFO path, to pass to HISAT2, and
+        the running processes, to be supervised while the FIFO is read
+    """
+    fifo_paths = create_fifos(fifo_dir, ['tagged.fastq'])
+    compressed_paths = [path for path in [barcode_read_path, cdna_path] if compression_suffix(path)]
+    decompression_fifo_paths = create_fifos(
+        fifo_dir,
+        (f'{i}_{fastq_base_name(path)}.fastq' for i, path in enumerate(compressed_paths)),
+    )
+    fifos_by_path = dict(zip(compressed_paths, decompression_fifo_paths))
+
+    producers = ProducerGroup(fifo_paths + decompression_fifo_paths)
+    decompression_threads = max(min(threads, MAX_DECOMPRESSION_THREADS), 1)
+    for path, fifo_path in fifos_by_path.items():
+        producers.start(decompression_command(path, decompression_threads), output_path=fifo_path)
+
+    command = tag_reads_command(
+        fifos_by_path.get(barcode_read_path, barcode_read_path),
+        fifos_by_path.get(cdna_path, cdna_path),
+        layout,
+    )
+    # Byte-oriented matching and output, which is much faster in a UTF-8 locale
+    env = {**os.environ, 'LC_ALL': 'C'}
+    producers.start(command, output_path=fifo_paths[0], name='tag_barcodes', env=env)
+    return fifo_paths, producers
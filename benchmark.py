@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of index building, index loading, quantification and output
+writing, on synthetic data, without network access or external programs.
+
+Synthetic CCDS tables and SAM files are generated in a temporary directory,
+with configurable numbers of genes, chromosomes and reads, single- or
+paired-end reads, and optionally spliced CIGAR strings. Timings are saved
+as JSON, and can be compared against an earlier results file to find
+regressions.
+
+Each faster quantification path is also checked against the reference
+implementation (one IntervalTree query per read) on the same reads; a
+mismatch is reported in the results and makes this script exit with an
+error.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+from pathlib import Path
+import pickle
+import platform
+import random
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+import numpy as np
+import pandas as pd
+
+from build_tree import build_tree_data, read_ccds
+from expression_store import ExpressionStore
+from fastq_batches import GROUP_TAG_SEPARATOR, group_tag_width, map_sam_file_to_groups
+from gene_index import GeneIndex
+from map_reads_to_genes import GeneCounts, map_sam_file_to_genes, map_sam_file_to_genes_interval_tree
+from sample_output import encode_sample, read_binary_sample, sample_rpkm, save_annotation, write_atomic
+from utils import normalize_whitespace
+
+T = TypeVar('T')
+
+DEFAULT_RESULTS_FILENAME = 'benchmark_results.json'
+
+CCDS_HEADER = [
+    '#chromosome',
+    'nc_accession',
+    'gene',
+    'gene_id',
+    'ccds_id',
+    'ccds_status',
+    'cds_strand',
+    'cds_from',
+    'cds_to',
+    'cds_locations',
+    'match_type',
+]
+
+# Genes are placed at random positions below this, and reads slightly past it
+CHROM_LENGTH = 100_000_000
+
+# Timings slower than the earlier results by more than this fraction are
+# reported as regressions
+DEFAULT_TOLERANCE = 0.2
+
+class BenchmarkConfig(NamedTuple):
+    genes: int
+    chromosomes: int
+    reads: int
+    paired: bool
+    spliced: bool
+    # Reads checked against the IntervalTree implementation, which is slow
+    reference_reads: int
+    # Samples written by the output benchmarks
+    samples: int
+    # Each benchmark is run this many times, and the fastest time is kept
+    repeat: int
+    seed: int
+
+def chrom_names(config: BenchmarkConfig) -> List[str]:
+    names = [str(i + 1) for i in range(config.chromosomes - 1)]
+    return names + ['X']
+
+def generate_ccds(path: Path, config: BenchmarkConfig):
+    """
+    Writes a table in the format of CCDS.current.txt. Some genes have
+    several isoforms, listed as separate rows, and some have no valid
+    interval list ('-'), as in the real data.
+    """
+    rng = random.Random(config.seed)
+    names = chrom_names(config)
+    with open(path, 'w') as f:
+        f.write('\t'.join(CCDS_HEADER) + '\n')
+        for i in range(config.genes):
+            chrom = rng.choice(names)
+            position = rng.randrange(1000, CHROM_LENGTH)
+            exons = []
+            for _ in range(rng.randint(1, 8)):
+                exon_length = rng.randint(50, 3000)
+                exons.append(f'{position}-{position + exon_length}')
+                position += exon_length + rng.randint(50, 20000)
+            isoforms = [exons]
+            if len(exons) > 2 and rng.random() < 0.2:
+                isoforms.append(exons[:-1])
+            if rng.random() < 0.01:
+                isoforms = [['-']]
+            for j, isoform in enumerate(isoforms):
+                locations = ', '.join(isoform)
+                fields = [
+                    chrom, 'NC_000000.0', f'Gene{i}', str(10000 + i), f'CCDS{i}.{j + 1}',
+                    'Public', rng.choice('+-'), '0', '0', f'[{locations}]', 'Identical',
+                ]
+                f.write('\t'.join(fields) + '\n')
+
+def random_cigar(rng: random.Random, read_length: int, spliced: bool) -> str:
+    if spliced and read_length > 20 and rng.random() < 0.3:
+        first = rng.randint(10, read_length - 10)
+        return f'{first}M{rng.randint(50, 5000)}N{read_length - first}M'
+    return f'{read_length}M'
+
+def generate_sam(path: Path, config: BenchmarkConfig, read_count: int, group_count: int=0):
+    """
+    Writes a SAM file with a header and `read_count` reads (pairs of
+    records if paired-end), with a mix of unmapped reads, secondary
+    alignments, and reads on chromosomes without genes.
+
+    :param group_count: If positive, read names are tagged with random group
+        indices, as for batched alignment; see `fastq_batches`
+    """
+    rng = random.Random(config.seed + read_count)
+    names = [f'chr{name}' for name in chrom_names(config)] + ['chrM', 'chrUn_random']
+    width = group_tag_width(group_count) if group_count else 0
+    with open(path, 'w') as f:
+        f.write('@HD\tVN:1.0\tSO:unsorted\n')
+        for name in names:
+            f.write(f'@SQ\tSN:{name}\tLN:{CHROM_LENGTH + 1000000}\n')
+        f.write('@PG\tID:hisat2\tPN:hisat2\n')
+
+        for i in range(read_count):
+            read_name = f'read{i}'
+            if group_count:
+                read_name += f'{GROUP_TAG_SEPARATOR}{rng.randrange(group_count):0{width}d}'
+            chrom = rng.choice(names)
+            position = rng.randint(1, CHROM_LENGTH)
+            mapped = rng.random() > 0.1
+            flags = (99, 147) if config.paired else (rng.choice([0, 16, 256]),)
+            for flag in flags:
+                read_length = rng.randint(50, 150)
+                sequence = ''.join(rng.choices('ACGT', k=read_length))
+                if mapped:
+                    cigar = random_cigar(rng, read_length, config.spliced)
+                    fields = [read_name, str(flag), chrom, str(position), '60', cigar]
+                else:
+                    fields = [read_name, str(flag | 0x4), '*', '0', '0', '*']
+                fields.extend(['*', '0', '0', sequence, 'I' * read_length, 'NH:i:1'])
+                f.write('\t'.join(fields) + '\n')
+                position += rng.randint(0, 500)
+
+def time_call(func: Callable[[], T], repeat: int) -> Tuple[float, T]:
+    """
+    :return: 2-tuple: fastest wall-clock time of `repeat` calls in seconds,
+        and the return value of the last call
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        best = min(best, perf_counter() - start)
+    return best, result
+
+def timing(seconds: float, items: Optional[int]=None, unit: Optional[str]=None) -> dict:
+    result = {'seconds': seconds}
+    if items is not None:
+        result['items'] = items
+        result['unit'] = unit
+        result['items_per_second'] = items / seconds if seconds else None
+    return result
+
+def results_equal(a: GeneCounts, b: GeneCounts) -> bool:
+    return (
+        a.rpkm.equals(b.rpkm)
+        and a.summary.astype(np.int64).equals(b.summary.astype(np.int64))
+        and a.read_counts.astype(np.int64).equals(b.read_counts.astype(np.int64))
+    )
+
+def split_by_group(sam_path: Path, group_count: int, gene_index: GeneIndex) -> List[GeneCounts]:
+    """
+    Quantifies each group of a tagged SAM file separately, by writing a SAM
+    file per group
+    """
+    header = []
+    records = [[] for _ in range(group_count)]
+    with open(sam_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'@'):
+                header.append(line)
+                continue
+            read_name = line.split(b'\t', 1)[0]
+            group = int(read_name.rsplit(GROUP_TAG_SEPARATOR.encode(), 1)[1])
+            records[group].append(line)
+
+    results = []
+    for group_records in records:
+        group_sam_path = sam_path.with_suffix('.group.sam')
+        group_sam_path.write_bytes(b''.join(header + group_records))
+        with open(group_sam_path, 'rb') as f:
+            results.append(map_sam_file_to_genes(f, gene_index))
+    return results
+
+def run_benchmarks(config: BenchmarkConfig, work_dir: Path) -> Tuple[Dict[str, dict], Dict[str, bool]]:
+    """
+    :return: 2-tuple: timings by benchmark name, and results of equality
+        checks by name
+    """
+    timings = {}
+    checks = {}
+
+    ccds_path = work_dir / 'CCDS.synthetic.txt'
+    generate_ccds(ccds_path, config)
+
+    seconds, tree_data = time_call(lambda: build_tree_data(read_ccds(ccds_path)), config.repeat)
+    timings['build_tree'] = timing(seconds, config.genes, 'genes')
+
+    pickle_path = work_dir / 'trees.pickle'
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(tree_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_pickle():
+        with open(pickle_path, 'rb') as f:
+            return pickle.load(f)
+
+    seconds, _ = time_call(load_pickle, config.repeat)
+    timings['load_tree_pickle'] = timing(seconds)
+
+    seconds, gene_index = time_call(lambda: GeneIndex.from_tree_data(tree_data), config.repeat)
+    timings['build_gene_index'] = timing(seconds, gene_index.gene_count, 'genes')
+
+    index_path = work_dir / 'gene_index'
+    gene_index.save(index_path)
+    seconds, gene_index = time_call(lambda: GeneIndex.load(index_path), config.repeat)
+    timings['load_gene_index'] = timing(seconds)
+
+    records_per_read = 2 if config.paired else 1
+    sam_path = work_dir / 'reads.sam'
+    generate_sam(sam_path, config, config.reads)
+    timings['sam_file_bytes'] = {'bytes': sam_path.stat().st_size}
+
+    def quantify():
+        with open(sam_path, 'rb') as f:
+            return map_sam_file_to_genes(f, gene_index)
+
+    seconds, (rpkm, summary, read_counts) = time_call(quantify, config.repeat)
+    timings['quantify'] = timing(seconds, config.reads * records_per_read, 'records')
+
+    # The reference implementation is much slower, so is checked on fewer reads
+    reference_sam_path = work_dir / 'reference_reads.sam'
+    generate_sam(reference_sam_path, config, config.reference_reads)
+    with open(reference_sam_path) as f:
+        start = perf_counter()
+        reference_result = map_sam_file_to_genes_interval_tree(f, tree_data)
+        seconds = perf_counter() - start
+    timings['quantify_interval_tree'] = timing(seconds, config.reference_reads * records_per_read, 'records')
+    with open(reference_sam_path, 'rb') as f:
+        checks['gene_index_matches_interval_tree'] = results_equal(map_sam_file_to_genes(f, gene_index), reference_result)
+
+    group_count = max(config.samples, 2)
+    batch_sam_path = work_dir / 'batch_reads.sam'
+    generate_sam(batch_sam_path, config, config.reference_reads, group_count)
+    with open(batch_sam_path, 'rb') as f:
+        start = perf_counter()
+        group_results = map_sam_file_to_groups(f, group_count, gene_index)
+        seconds = perf_counter() - start
+    timings['quantify_batch'] = timing(seconds, config.reference_reads * records_per_read, 'records')
+    checks['batch_groups_match_single_groups'] = all(
+        results_equal(group_result, single_result)
+        for group_result, single_result in zip(group_results, split_by_group(batch_sam_path, group_count, gene_index))
+    )
+
+    sample_names = [f'sample{i}' for i in range(config.samples)]
+    for sparse in [False, True]:
+        output_path = work_dir / f'expr_{"sparse" if sparse else "dense"}.hdf5'
+
+        def write_store():
+            with ExpressionStore(output_path, sparse=sparse) as store:
+                for sample_name in sample_names:
+                    store.save_sample(sample_name, rpkm, summary)
+                store.finalize(sample_names)
+
+        seconds, _ = time_call(write_store, config.repeat)
+        name = 'write_hdf5_sparse' if sparse else 'write_hdf5_dense'
+        timings[name] = timing(seconds, config.samples, 'samples')
+        timings[f'{name}_bytes'] = {'bytes': output_path.stat().st_size}
+
+    csv_dir = work_dir / 'csv'
+    csv_dir.mkdir()
+
+    def write_csv():
+        for sample_name in sample_names:
+            rpkm.to_csv(csv_dir / f'{sample_name}_rpkm.csv')
+            summary.to_csv(csv_dir / f'{sample_name}_summary.csv')
+
+    seconds, _ = time_call(write_csv, config.repeat)
+    timings['write_csv'] = timing(seconds, config.samples, 'samples')
+
+    binary_dir = work_dir / 'expr'
+    binary_dir.mkdir()
+    gene_length = gene_index.gene_length_series
+    hash_value = save_annotation(binary_dir, gene_length)
+
+    def write_binary():
+        for sample_name in sample_names:
+            data = encode_sample(sample_name, read_counts, summary, hash_value, gene_length)
+            write_atomic(binary_dir / f'{sample_name}.expr', data)
+
+    seconds, _ = time_call(write_binary, config.repeat)
+    timings['write_binary'] = timing(seconds, config.samples, 'samples')
+    sample = read_binary_sample(binary_dir / f'{sample_names[0]}.expr')
+    checks['binary_output_round_trip'] = np.array_equal(
+        sample_rpkm(sample, gene_length),
+        rpkm.to_numpy(),
+        equal_nan=True,
+    )
+
+    return timings, checks
+
+def compare_results(results: dict, previous: dict, tolerance: float) -> List[str]:
+    """
+    :return: Descriptions of benchmarks that are slower than in `previous`
+        by more than `tolerance`, as a fraction of the earlier time
+    """
+    regressions = []
+    if previous.get('config') != results['config']:
+        print('Warning: comparing against results with a different configuration')
+    for name, current in results['timings'].items():
+        earlier = previous.get('timings', {}).get(name)
+        if earlier is None or 'seconds' not in current or 'seconds' not in earlier:
+            continue
+        if current['seconds'] > earlier['seconds'] * (1 + tolerance):
+            change = current['seconds'] / earlier['seconds'] - 1
+            regressions.append(
+                f'{name}: {earlier["seconds"]:.4f}s -> {current["seconds"]:.4f}s ({change:+.0%})'
+            )
+    return regressions
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument('--genes', type=int, default=20000)
+    p.add_argument('--chromosomes', type=int, default=20)
+    p.add_argument('--reads', type=int, default=1000000)
+    p.add_argument('--paired', action='store_true', help='Generate paired-end reads')
+    p.add_argument('--spliced', action='store_true', help='Generate spliced CIGAR strings for some reads')
+    p.add_argument(
+        '--reference-reads',
+        type=int,
+        default=20000,
+        help=normalize_whitespace(
+            """
+            Number of reads used to check quantification against the IntervalTree
+            implementation, which is much slower
+            """
+        ),
+    )
+    p.add_argument('--samples', type=int, default=100, help='Number of samples written to output files')
+    p.add_argument('--repeat', type=int, default=3, help='Keep the fastest of this many runs')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument(
+        '--output-file',
+        type=Path,
+        default=Path(DEFAULT_RESULTS_FILENAME),
+        help=f'JSON file for results. Default: {DEFAULT_RESULTS_FILENAME}',
+    )
+    p.add_argument(
+        '--compare',
+        type=Path,
+        help=normalize_whitespace(
+            """
+            Results file from an earlier run. Benchmarks that are slower than in
+            this file by more than the tolerance are reported, and make this
+            script exit with an error.
+            """
+        ),
+    )
+    p.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    p.add_argument('--work-dir', type=Path, help='Directory for generated data. Default: a temporary directory.')
+    args = p.parse_args()
+
+    config = BenchmarkConfig(
+        genes=args.genes,
+        chromosomes=args.chromosomes,
+        reads=args.reads,
+        paired=args.paired,
+        spliced=args.spliced,
+        reference_reads=args.reference_reads,
+        samples=args.samples,
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+
+    with TemporaryDirectory(prefix='benchmark_', dir=args.work_dir) as work_dir:
+        timings, checks = run_benchmarks(config, Path(work_dir))
+
+    results = {
+        'date': datetime.now().isoformat(),
+        'config': config._asdict(),
+        'environment': environment(),
+        'timings': timings,
+        'checks': checks,
+    }
+    print(json.dumps(results, indent=2))
+    print('Saving results to', args.output_file)
+    with open(args.output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    failed_checks = [name for name, passed in checks.items() if not passed]
+    regressions = []
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+    if failed_checks:
+        print('Failed checks:', ', '.join(failed_checks))
+    if failed_checks or regressions:
+        sys.exit(1)
+
+del T
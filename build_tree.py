@@ -5,21 +5,26 @@ import csv
 from pathlib import Path
 import pickle
 import re
+from typing import Dict, Set, Tuple
 
 from data_path_utils import create_data_path
 from intervaltree import IntervalTree
 import pandas as pd
 
+from gene_index import GENE_INDEX_DIRECTORY_NAME, TREE_PICKLE_FILENAME, GeneIndex
+
 DEFAULT_CCDS_PATH = Path('~/data/ccds/current_mouse/CCDS.current.txt').expanduser()
 
-def main(ccds_path: Path):
-    gene_set = set()
+def read_ccds(ccds_path: Path) -> Dict[str, Set[Tuple[str, str]]]:
+    """
+    :return: Dict mapping gene IDs to sets of (chromosome name, interval)
+        pairs, with intervals in string format, e.g. '129415220-129415360'.
+        Used to consolidate isoforms that are each listed separately.
+    """
     interval_separator = re.compile(r'\s*,\s*')
 
     print('Reading CCDS data from', ccds_path)
     with open(ccds_path) as f:
-        # Maps gene IDs to sets of intervals in string format, e.g. '129415220-129415360'.
-        # Used to consolidate isoforms that are each listed separately.
         intervals_by_gene = defaultdict(set)
 
         r = csv.DictReader(f, delimiter='\t')
@@ -28,10 +33,17 @@ def main(ccds_path: Path):
             chrom_name = 'chr{}'.format(line['#chromosome'])
             intervals = interval_separator.split(line['cds_locations'].strip('[]'))
             gene_id = line['gene_id']
-            gene_set.add(gene_id)
             for interval in intervals:
                 intervals_by_gene[gene_id].add((chrom_name, interval))
 
+    return intervals_by_gene
+
+def build_tree_data(intervals_by_gene: Dict[str, Set[Tuple[str, str]]]) -> dict:
+    """
+    :param intervals_by_gene: Output of `read_ccds`
+    :return: Dict with interval trees, gene lengths and `intervals_by_gene`,
+        as saved in `trees.pickle`
+    """
     trees = defaultdict(IntervalTree)
     gene_length = pd.Series(0.0, index=sorted(intervals_by_gene))
     print('Read data for', len(intervals_by_gene), 'genes')
@@ -57,19 +69,26 @@ def main(ccds_path: Path):
             # Kilobases, so divide by 1000
             gene_length.loc[gene] = (chrom_dict[chrom][1] - chrom_dict[chrom][0]) / 1000
 
-    data_path = create_data_path('build_tree')
-    pickle_file = data_path / 'trees.pickle'
-    print('Saving interval trees to', pickle_file)
-
-    data_to_save = {
+    return {
         'trees': trees,
         'gene_length': gene_length,
         'intervals_by_gene': intervals_by_gene,
     }
 
+def main(ccds_path: Path):
+    data_to_save = build_tree_data(read_ccds(ccds_path))
+
+    data_path = create_data_path('build_tree')
+    pickle_file = data_path / TREE_PICKLE_FILENAME
+    print('Saving interval trees to', pickle_file)
+
     with open(pickle_file, 'wb') as f:
         pickle.dump(data_to_save, f, protocol=pickle.HIGHEST_PROTOCOL)
 
+    gene_index_path = data_path / GENE_INDEX_DIRECTORY_NAME
+    print('Saving gene index to', gene_index_path)
+    GeneIndex.from_tree_data(data_to_save).save(gene_index_path)
+
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('ccds_file', type=Path, default=DEFAULT_CCDS_PATH)
@@ -1,87 +1,462 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
+import heapq
 from math import ceil
-from subprocess import check_call
 from pathlib import Path
+import sys
+from typing import Dict, List, NamedTuple, Optional
 
 from data_path_utils import create_data_path, create_slurm_path
+import pandas as pd
 
+from executors import Executor, LocalExecutor, SlurmExecutor, TaskArray
 from ncbi_sra_toolkit_config import check_ncbi_prefetch_location
-from utils import digits, grouper
+from run_history import (
+    DEFAULT_HISTORY_PATH,
+    FEATURE_COLUMNS,
+    ResourceModel,
+    RunHistory,
+    add_history_command_line_argument,
+    estimate_task_resources,
+    round_up,
+)
+from run_state import DEFAULT_STATE_PATH, RunState, add_state_command_line_argument, print_state_report
+from sra_conversion import LIBRARY_LAYOUT_COLUMN, SRR_ID_COLUMN
+from utils import digits, grouper, normalize_whitespace
 
-script_template = """
-#!/bin/bash
-
-#SBATCH -p {pool}
-#SBATCH --mem=8192
-#SBATCH --mincpus={subprocesses}
-#SBATCH -o {stdout_path}
-
-python3 process_sra_from_srr_list.py -s {subprocesses} {srr_list_file}
-""".strip()
-
-SBATCH_COMMAND_TEMPLATE = [
-    'sbatch',
-    '--array={array_index_spec}',
-    '{script_filename}',
-]
-
-SCRIPT_FILENAME_TEMPLATE = 'bulk_download_{:0{}}.sh'
 SRR_LIST_FILENAME_TEMPLATE = 'srr_ids_{:0{}}.txt'
 SCRIPT_LABEL = 'cluster_scheduling'
 
 # Could also get this from `scontrol show config`, but hardcoding isn't too bad
 SLURM_ARRAY_MAX = 1000
 
-def queue_jobs(srr_list_file: Path, pool: str, subprocesses: int):
-    data_path = create_data_path(SCRIPT_LABEL)
-    slurm_path = create_slurm_path(SCRIPT_LABEL)
+# Measures of expected work, in order of preference
+WEIGHT_COLUMNS = ['size_MB', 'Bytes', 'bases', 'Bases', 'spots']
+# Metadata columns giving the features in `run_history.FEATURE_COLUMNS`,
+# with the factor to convert each to the same units
+FEATURE_METADATA_COLUMNS = {
+    'input_bytes': [('Bytes', 1), ('size_MB', 2 ** 20)],
+    'read_count': [('spots', 1)],
+}
+
+# Used for every task if there isn't enough history to estimate resources
+DEFAULT_MEMORY_MB = 8192
+# Estimates are rounded up to these steps, so that tasks with similar
+# estimates can share a job array (SLURM sets resources per array)
+MEMORY_STEP_MB = 512
+TIME_STEP_MINUTES = 15
+DEFAULT_SAFETY_MARGIN = 0.25
+
+class JobArray(NamedTuple):
+    memory_mb: int
+    # None for no time limit
+    time_minutes: Optional[int]
+    srr_groups: List[List[str]]
+
+def read_srr_weights(metadata_file: Path, srr_ids: List[str], weight_column: Optional[str]=None) -> pd.Series:
+    """
+    Reads the expected amount of work for each SRR ID, e.g. SRA file size,
+    from a CSV or tab-separated metadata table.
+
+    :param weight_column: Column to use; if omitted, the first column in
+        `WEIGHT_COLUMNS` that exists in the table
+    :return: Weight of each SRR ID, indexed by SRR ID, in the same order
+        as `srr_ids`. SRR IDs missing from the table are given the median
+        weight of the others.
+    """
+    metadata = pd.read_csv(metadata_file, sep=None, engine='python')
+    if SRR_ID_COLUMN not in metadata.columns:
+        raise ValueError(f'No {SRR_ID_COLUMN!r} column in {metadata_file}')
+    if weight_column is None:
+        for column in WEIGHT_COLUMNS:
+            if column in metadata.columns:
+                weight_column = column
+                break
+        else:
+            raise ValueError(f'None of the columns {WEIGHT_COLUMNS} found in {metadata_file}')
+    elif weight_column not in metadata.columns:
+        raise ValueError(f'No {weight_column!r} column in {metadata_file}')
+
+    all_weights = pd.to_numeric(metadata[weight_column], errors='coerce')
+    all_weights.index = metadata[SRR_ID_COLUMN]
+    all_weights = all_weights[~all_weights.index.duplicated()].dropna()
+    weights = all_weights.reindex(srr_ids)
+    missing = weights.isnull()
+    if missing.any():
+        print(f'{missing.sum()} SRR IDs have no {weight_column!r} value in {metadata_file}; using the median')
+        fill_value = weights.median() if not missing.all() else 1
+        weights[missing] = fill_value
+    print(f'Balancing tasks by {weight_column!r} from {metadata_file}')
+    return weights
+
+def pack_srr_ids(weights: pd.Series, task_count: int) -> List[List[str]]:
+    """
+    Splits SRR IDs into `task_count` groups of roughly equal total weight,
+    by assigning each SRR ID, heaviest first, to the group with the least
+    total weight so far (longest processing time first scheduling).
+
+    :param weights: Expected work of each SRR ID, indexed by SRR ID
+    :return: Non-empty groups of SRR IDs, each heaviest first
+    """
+    groups: List[List[str]] = [[] for _ in range(task_count)]
+    # (total weight, group index)
+    loads = [(0.0, i) for i in range(task_count)]
+    # Stable sort, so ties keep the order of the SRR list
+    for srr_id, weight in weights.sort_values(ascending=False, kind='mergesort').items():
+        load, i = heapq.heappop(loads)
+        groups[i].append(srr_id)
+        heapq.heappush(loads, (load + weight, i))
+    return [group for group in groups if group]
+
+def group_srr_ids(
+        srr_ids: List[str],
+        srrs_per_task: int=1,
+        metadata_file: Optional[Path]=None,
+        weight_column: Optional[str]=None,
+) -> List[List[str]]:
+    """
+    :param srrs_per_task: Average number of SRR IDs per array task
+    :param metadata_file: Table of expected work per SRR ID, to balance
+        groups by; if omitted, groups have equal numbers of SRR IDs
+    :return: Groups of SRR IDs, one per array task
+    """
+    if srrs_per_task <= 1:
+        return [[srr_id] for srr_id in srr_ids]
+    if metadata_file is None:
+        weights = pd.Series(1.0, index=srr_ids)
+    else:
+        weights = read_srr_weights(metadata_file, srr_ids, weight_column)
+    task_count = ceil(len(srr_ids) / srrs_per_task)
+    groups = pack_srr_ids(weights, task_count)
 
+    group_weights = [weights[group].sum() for group in groups]
+    print(
+        f'Packed {len(srr_ids)} SRR IDs into {len(groups)} tasks; total weight per task: '
+        f'min {min(group_weights):g}, mean {sum(group_weights) / len(groups):g}, max {max(group_weights):g}'
+    )
+    return groups
+
+def read_srr_features(metadata_file: Path, srr_ids: List[str]) -> pd.DataFrame:
+    """
+    :return: Data frame indexed by SRR ID, in the same order as `srr_ids`,
+        with any columns of `run_history.FEATURE_COLUMNS` that can be read
+        from the metadata table; NaN for SRR IDs missing from the table
+    """
+    metadata = pd.read_csv(metadata_file, sep=None, engine='python')
+    if SRR_ID_COLUMN not in metadata.columns:
+        raise ValueError(f'No {SRR_ID_COLUMN!r} column in {metadata_file}')
+    metadata = metadata.drop_duplicates(SRR_ID_COLUMN).set_index(SRR_ID_COLUMN)
+
+    features = pd.DataFrame(index=pd.Index(srr_ids))
+    for feature in FEATURE_COLUMNS:
+        for column, factor in FEATURE_METADATA_COLUMNS[feature]:
+            if column in metadata.columns:
+                values = pd.to_numeric(metadata[column], errors='coerce') * factor
+                if feature == 'read_count' and LIBRARY_LAYOUT_COLUMN in metadata.columns:
+                    # Each spot of a paired-end run is counted as two reads
+                    paired = metadata[LIBRARY_LAYOUT_COLUMN].astype(str).str.upper() == 'PAIRED'
+                    values[paired] *= 2
+                features[feature] = values.reindex(srr_ids).to_numpy()
+                break
+    return features
+
+def plan_job_arrays(
+        srr_groups: List[List[str]],
+        model: Optional[ResourceModel],
+        features: Optional[pd.DataFrame],
+        safety_margin: float=DEFAULT_SAFETY_MARGIN,
+) -> List[JobArray]:
+    """
+    Estimates memory and time of each task from `model`, and puts tasks with
+    the same (rounded) estimates into the same job array, largest first.
+
+    :param model: If None, every task gets `DEFAULT_MEMORY_MB` and no time
+        limit, in a single job array
+    :param features: Input size and/or read count of each SRR ID; see
+        `read_srr_features`
+    """
+    if model is None:
+        return [JobArray(DEFAULT_MEMORY_MB, None, srr_groups)]
+
+    predictions = model.predict(features)
+    groups_by_resources: Dict[tuple, List[List[str]]] = {}
+    for srr_group in srr_groups:
+        estimate = estimate_task_resources(predictions, srr_group, safety_margin)
+        resources = (
+            round_up(estimate.memory_bytes / 2 ** 20, MEMORY_STEP_MB),
+            round_up(estimate.seconds / 60, TIME_STEP_MINUTES),
+        )
+        groups_by_resources.setdefault(resources, []).append(srr_group)
+    return [
+        JobArray(memory_mb, time_minutes, groups_by_resources[memory_mb, time_minutes])
+        for memory_mb, time_minutes in sorted(groups_by_resources, reverse=True)
+    ]
+
+def print_job_array_report(job_arrays: List[JobArray]):
+    """
+    Prints the resources requested for each job array, and totals, compared
+    to requesting `DEFAULT_MEMORY_MB` for every task.
+    """
+    print('Job arrays:')
+    print(f'\t{"tasks":>6}  {"SRR IDs":>7}  {"memory":>9}  {"time":>9}')
+    task_count = srr_count = 0
+    task_hours = memory_gb_hours = default_memory_gb_hours = 0.0
+    for job_array in job_arrays:
+        tasks = len(job_array.srr_groups)
+        srrs = sum(len(srr_group) for srr_group in job_array.srr_groups)
+        time_text = 'no limit' if job_array.time_minutes is None else f'{job_array.time_minutes} min'
+        print(f'\t{tasks:>6}  {srrs:>7}  {job_array.memory_mb:>6} MB  {time_text:>9}')
+        task_count += tasks
+        srr_count += srrs
+        if job_array.time_minutes is not None:
+            hours = tasks * job_array.time_minutes / 60
+            task_hours += hours
+            memory_gb_hours += hours * job_array.memory_mb / 1024
+            default_memory_gb_hours += hours * DEFAULT_MEMORY_MB / 1024
+    print(f'Total: {task_count} tasks, {srr_count} SRR IDs, in {len(job_arrays)} job arrays')
+    if task_hours:
+        print(f'Time limits: {task_hours:.1f} task-hours in total')
+        print(
+            f'Reserved memory: {memory_gb_hours:.1f} GB-hours, '
+            f'vs. {default_memory_gb_hours:.1f} GB-hours at {DEFAULT_MEMORY_MB} MB per task'
+        )
+    else:
+        print('Not enough run history to estimate resources; using defaults')
+
+def queue_jobs(
+        srr_list_file: Path,
+        pool: str,
+        subprocesses: int,
+        srrs_per_task: int=1,
+        metadata_file: Optional[Path]=None,
+        weight_column: Optional[str]=None,
+        history_file: Path=DEFAULT_HISTORY_PATH,
+        state_file: Path=DEFAULT_STATE_PATH,
+        resubmit: bool=False,
+        safety_margin: float=DEFAULT_SAFETY_MARGIN,
+        dry_run: bool=False,
+        executor: Optional[Executor]=None,
+) -> bool:
+    """
+    Each line of the SRR sublist files holds the SRR IDs of one array task,
+    separated by spaces; see `process_sra_from_srr_list.get_srr_ids`.
+
+    :param history_file: Resource usage of past runs (see `run_history`),
+        to set memory and time limits of each task, if it exists. Tasks are
+        submitted in one job array for each combination of limits. Each task
+        records its own runs in this file.
+    :param state_file: State of each SRR ID (see `run_state`). Submitted SRR
+        IDs are marked as queued, and each task updates their state.
+    :param resubmit: Only submit SRR IDs that aren't done according to
+        `state_file`
+    :param dry_run: Only print the job arrays that would be submitted
+    :param executor: Runs the tasks of each job array; defaults to
+        submitting them to SLURM in node pool `pool`
+    :return: Whether every task succeeded, as far as `executor` knows
+    """
     with open(srr_list_file) as f:
-        srr_ids = [line.strip() for line in f]
+        srr_ids = [line.strip() for line in f if line.strip()]
+    if resubmit:
+        with RunState(state_file) as state:
+            print_state_report(state, srr_ids)
+            srr_ids = state.incomplete(srr_ids)
+        print(f'Resubmitting {len(srr_ids)} SRR IDs that are not done')
+        if not srr_ids:
+            return True
+    srr_groups = group_srr_ids(srr_ids, srrs_per_task, metadata_file, weight_column)
+
+    model = None
+    features = None
+    if history_file.is_file():
+        with RunHistory(history_file) as history:
+            runs = history.runs()
+        if metadata_file is None:
+            features = pd.DataFrame(index=pd.Index(srr_ids))
+        else:
+            features = read_srr_features(metadata_file, srr_ids)
+        known_features = [feature for feature in features.columns if features[feature].notnull().any()]
+        model = ResourceModel.fit(runs, subprocesses, known_features)
+        if model is not None:
+            basis = model.feature or 'the largest past run'
+            print(f'Estimating task resources from {model.run_count} past runs, by {basis}')
+    job_arrays = plan_job_arrays(srr_groups, model, features, safety_margin)
+    print_job_array_report(job_arrays)
+    if dry_run:
+        return True
 
-    srr_sublist_count = ceil(len(srr_ids) / SLURM_ARRAY_MAX)
-    srr_filename_digits = digits(srr_sublist_count)
+    data_path = create_data_path(SCRIPT_LABEL)
+    if executor is None:
+        executor = SlurmExecutor(pool, subprocesses, history_file, state_file, create_slurm_path(SCRIPT_LABEL))
+
+    array_chunks = [
+        (job_array, srr_sublist_raw)
+        for job_array in job_arrays
+        for srr_sublist_raw in grouper(job_array.srr_groups, SLURM_ARRAY_MAX)
+    ]
+    srr_filename_digits = digits(len(array_chunks))
 
-    for i, srr_sublist_raw in enumerate(grouper(srr_ids, SLURM_ARRAY_MAX)):
+    for i, (job_array, srr_sublist_raw) in enumerate(array_chunks):
         srr_sublist_path = data_path / SRR_LIST_FILENAME_TEMPLATE.format(i, srr_filename_digits)
         print(f'{i:0{srr_filename_digits}} Saving SRR sublist to {srr_sublist_path}')
 
         srr_sublist = list(filter(None, srr_sublist_raw))
 
         with open(srr_sublist_path, 'w') as f:
-            for srr_id in srr_sublist:
-                print(srr_id, file=f)
-
-        array_index_spec = f'0-{len(srr_sublist) - 1}'
-
-        script_file = slurm_path / SCRIPT_FILENAME_TEMPLATE.format(i, srr_filename_digits)
-        print(f'{i:0{srr_filename_digits}} Saving script to {script_file}')
-        with open(script_file, 'w') as f:
-            script_content = script_template.format(
-                srr_list_file=srr_sublist_path.absolute(),
-                pool=pool,
-                subprocesses=subprocesses,
-                stdout_path=script_file.with_suffix('.out')
-            )
-            print(script_content, file=f)
+            for srr_group in srr_sublist:
+                print(' '.join(srr_group), file=f)
 
-        slurm_command = [
-            piece.format(
-                array_index_spec=array_index_spec,
-                script_filename=script_file,
+        with RunState(state_file) as state:
+            state.queue(srr_id for srr_group in srr_sublist for srr_id in srr_group)
+        executor.submit(
+            TaskArray(
+                name=f'{i:0{srr_filename_digits}}',
+                srr_list_path=srr_sublist_path,
+                srr_groups=srr_sublist,
+                memory_mb=job_array.memory_mb,
+                time_minutes=job_array.time_minutes,
             )
-            for piece in SBATCH_COMMAND_TEMPLATE
-        ]
-        print(f'{i:0{srr_filename_digits}} Running', ' '.join(slurm_command))
-        check_call(slurm_command)
+        )
+    return executor.finish()
 
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('srr_list_file', type=Path)
     p.add_argument('--pool', default='zbj1', help='Node pool')
     p.add_argument('-s', '--subprocesses', type=int, default=1)
+    p.add_argument(
+        '--srrs-per-task',
+        type=int,
+        default=1,
+        help=normalize_whitespace(
+            """
+            Average number of SRR IDs to process in each array task, one after
+            another in the same process, so scheduling, interpreter startup and
+            index loading are paid once per group instead of once per SRR ID.
+            Default: 1.
+            """
+        ),
+    )
+    p.add_argument(
+        '--metadata-file',
+        type=Path,
+        help=normalize_whitespace(
+            f"""
+            CSV or tab-separated table of SRA run metadata, e.g. from the SRA Run
+            Selector, with a '{SRR_ID_COLUMN}' column. With --srrs-per-task, SRR IDs
+            are grouped so that each task has about the same total expected work,
+            from --weight-column, instead of the same number of SRR IDs.
+            """
+        ),
+    )
+    p.add_argument(
+        '--weight-column',
+        help=normalize_whitespace(
+            f"""
+            Column of --metadata-file holding the expected work of each SRR ID.
+            Default: the first of {', '.join(WEIGHT_COLUMNS)} in the table.
+            """
+        ),
+    )
+    add_history_command_line_argument(p)
+    add_state_command_line_argument(p)
+    p.add_argument(
+        '--resubmit',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Only submit SRR IDs from srr_list_file that aren't done according to
+            --state-file: those that failed, were never run, or whose tasks were
+            killed before finishing. Prints the number of SRR IDs in each state
+            first.
+            """
+        ),
+    )
+    p.add_argument(
+        '--safety-margin',
+        type=float,
+        default=DEFAULT_SAFETY_MARGIN,
+        help=normalize_whitespace(
+            f"""
+            Fraction added to the memory and time estimated from the run history
+            for each task. Default: {DEFAULT_SAFETY_MARGIN}
+            """
+        ),
+    )
+    p.add_argument(
+        '--dry-run',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Print the job arrays that would be submitted, with the memory and
+            time limits of each and predicted totals, without writing any files
+            or submitting anything.
+            """
+        ),
+    )
+    p.add_argument(
+        '--executor',
+        choices=['slurm', 'local'],
+        default='slurm',
+        help=normalize_whitespace(
+            """
+            Where to run the tasks: submit job arrays to SLURM, or run tasks on
+            this machine, as many at once as fit in --local-cores and
+            --local-memory-mb, waiting for all of them and reporting the status
+            of each and overall throughput. Default: slurm
+            """
+        ),
+    )
+    p.add_argument(
+        '--local-cores',
+        type=int,
+        help=normalize_whitespace(
+            """
+            Cores available to the local executor; each task uses
+            --subprocesses. Default: all cores of this machine.
+            """
+        ),
+    )
+    p.add_argument(
+        '--local-memory-mb',
+        type=int,
+        help=normalize_whitespace(
+            """
+            Memory available to the local executor, in MB, shared by running
+            tasks according to their estimated memory. Default: all physical
+            memory of this machine.
+            """
+        ),
+    )
     args = p.parse_args()
+    if args.srrs_per_task < 1:
+        p.error('--srrs-per-task must be positive')
+    if args.safety_margin < 0:
+        p.error('--safety-margin must not be negative')
 
-    check_ncbi_prefetch_location()
-    queue_jobs(args.srr_list_file, args.pool, args.subprocesses)
+    executor = None
+    if args.executor == 'local':
+        executor = LocalExecutor(
+            subprocesses=args.subprocesses,
+            history_file=args.history_file,
+            state_file=args.state_file,
+            cores=args.local_cores,
+            memory_mb=args.local_memory_mb,
+        )
+    elif not args.dry_run:
+        check_ncbi_prefetch_location()
+    succeeded = queue_jobs(
+        args.srr_list_file,
+        args.pool,
+        args.subprocesses,
+        srrs_per_task=args.srrs_per_task,
+        metadata_file=args.metadata_file,
+        weight_column=args.weight_column,
+        history_file=args.history_file,
+        state_file=args.state_file,
+        resubmit=args.resubmit,
+        safety_margin=args.safety_margin,
+        dry_run=args.dry_run,
+        executor=executor,
+    )
+    if not succeeded:
+        sys.exit('Some tasks failed')
@@ -0,0 +1,96 @@
+"""
+Support for gzip- and bzip2-compressed FASTQ input.
+
+Compressed files are decompressed by external programs writing into named
+pipes, which HISAT2 reads like ordinary FASTQ files. Multi-threaded
+decompressors (pigz, lbzip2, pbzip2) are used if installed, falling back
+to the standard single-threaded programs otherwise.
+"""
+from pathlib import Path
+from shutil import which
+from typing import List, Optional, Tuple
+
+from named_pipes import ProducerGroup, create_fifos
+
+FASTQ_SUFFIXES = ['.fastq', '.fq']
+COMPRESSION_SUFFIXES = ['.gz', '.bz2']
+
+# Checked in order; the first program found on the PATH is used
+DECOMPRESSION_COMMAND_TEMPLATES = {
+    '.gz': [
+        ['pigz', '-d', '-c', '-p', '{threads}', '{input_path}'],
+        ['gzip', '-d', '-c', '{input_path}'],
+    ],
+    '.bz2': [
+        ['lbzip2', '-d', '-c', '-n', '{threads}', '{input_path}'],
+        ['pbzip2', '-d', '-c', '-p{threads}', '{input_path}'],
+        ['bzip2', '-d', '-c', '{input_path}'],
+    ],
+}
+
+# Decompression doesn't parallelize as well as alignment, so only a few
+# threads are useful
+MAX_DECOMPRESSION_THREADS = 4
+
+def compression_suffix(path: Path) -> Optional[str]:
+    """
+    :return: '.gz' or '.bz2' if `path` names a compressed file, else None
+    """
+    if path.suffix in COMPRESSION_SUFFIXES:
+        return path.suffix
+    return None
+
+def fastq_base_name(path: Path) -> str:
+    """
+    :return: Filename of `path` without compression or FASTQ extensions,
+        e.g. 'SRR1234_1' for 'SRR1234_1.fastq.gz'
+    """
+    name = path.name
+    if compression_suffix(path):
+        name = name[:-len(path.suffix)]
+    for suffix in FASTQ_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return Path(name).stem
+
+def fastq_glob_patterns() -> List[str]:
+    return [
+        f'*{fastq_suffix}{compression}'
+        for fastq_suffix in FASTQ_SUFFIXES
+        for compression in [''] + COMPRESSION_SUFFIXES
+    ]
+
+def decompression_command(path: Path, threads: int) -> List[str]:
+    suffix = compression_suffix(path)
+    for template in DECOMPRESSION_COMMAND_TEMPLATES[suffix]:
+        if which(template[0]):
+            return [piece.format(input_path=path, threads=threads) for piece in template]
+    programs = ', '.join(template[0] for template in DECOMPRESSION_COMMAND_TEMPLATES[suffix])
+    raise EnvironmentError(f'No decompression program found for {path} (tried {programs})')
+
+def start_decompression_fifo(
+        fastq_paths: List[Path],
+        fifo_dir: Path,
+        threads: int,
+) -> Tuple[List[Path], ProducerGroup]:
+    """
+    Starts decompressing each compressed file in `fastq_paths` into a named
+    pipe in `fifo_dir`. Uncompressed files are passed through unchanged.
+
+    :return: 2-tuple: list of paths to give to HISAT2 in place of
+        `fastq_paths`, and the running decompression processes, to be
+        supervised while the FIFOs are read
+    """
+    compressed_paths = [path for path in fastq_paths if compression_suffix(path)]
+    fifo_paths = create_fifos(
+        fifo_dir,
+        (f'{i}_{fastq_base_name(path)}.fastq' for i, path in enumerate(compressed_paths)),
+    )
+    fifos_by_path = dict(zip(compressed_paths, fifo_paths))
+
+    producers = ProducerGroup(fifo_paths)
+    decompression_threads = max(min(threads, MAX_DECOMPRESSION_THREADS), 1)
+    for path, fifo_path in fifos_by_path.items():
+        producers.start(decompression_command(path, decompression_threads), output_path=fifo_path)
+
+    return [fifos_by_path.get(path, path) for path in fastq_paths], producers
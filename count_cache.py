@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Local cache of per-sample alignment results, so that a sample is aligned
+and quantified once for a given set of inputs and parameters, even if its
+results are saved again in another layout or normalized differently.
+
+Each entry holds the read count of every gene and the alignment summary of
+one sample, in the binary per-sample format of `sample_output`. Entries are
+addressed by a hash of everything that determines their contents:
+
+* the input: the SRR ID for downloaded runs, or checksums of the SRA or
+  FASTQ files otherwise
+* the HISAT2 reference index: its path, and the size and modification time
+  of each of its files
+* the `--hisat2-options` string
+* the gene index (annotation) used for quantification, by the hash of its
+  contents
+* for SRA input, the program that converted it to FASTQ, since
+  fasterq-dump's --split-3 drops unmated reads that fastq-dump keeps
+
+Checksums of input files are remembered by path, size and modification
+time, so unchanged files aren't read again. The cache is limited to a
+total size; when storing an entry would exceed it, the least recently used
+entries are removed. The index of entries is an SQLite database in the
+cache directory, shared by all processes using the same cache.
+
+The cache is off unless `--count-cache` is given. The configuration is kept
+in an environment variable, so that it applies in worker processes too.
+Running this file as a script lists the entries of a cache or prunes it.
+"""
+from argparse import ArgumentParser, Namespace
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+from hashlib import sha1
+import json
+import os
+from pathlib import Path
+import sqlite3
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from gene_index import load_gene_index
+from map_reads_to_genes import GeneCounts
+from paths import OUTPUT_PATH, REFERENCE_INDEX_PATH
+from pipeline import Pipeline
+from sample_output import BINARY_SUFFIX, annotation_hash, encode_sample, read_binary_sample, rpkm_from_counts, write_atomic
+import telemetry
+from utils import normalize_whitespace
+
+COUNT_CACHE_ENVIRONMENT_VARIABLE = 'RNA_SEQ_PIPELINE_COUNT_CACHE'
+DEFAULT_COUNT_CACHE_PATH = OUTPUT_PATH / 'count_cache'
+DEFAULT_SIZE_GB = 10
+DATABASE_FILENAME = 'cache.sqlite3'
+# Changing what goes into keys, or how results are computed from the same
+# inputs, must change this, so that old entries are no longer used
+KEY_VERSION = 2
+
+# Seconds to wait for other processes writing to the database
+LOCK_TIMEOUT = 120
+CHECKSUM_CHUNK_SIZE = 2 ** 24
+
+GIGABYTE = 2 ** 30
+
+CREATE_TABLE_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        created TEXT NOT NULL,
+        last_used TEXT NOT NULL,
+        inputs TEXT NOT NULL,
+        reference TEXT NOT NULL,
+        hisat2_options TEXT,
+        annotation TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS checksums (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        sha1 TEXT NOT NULL
+    )
+    """,
+]
+
+def add_count_cache_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--count-cache',
+        type=Path,
+        nargs='?',
+        const=DEFAULT_COUNT_CACHE_PATH,
+        help=normalize_whitespace(
+            f"""
+            Reuse gene counts and alignment summaries of samples that were
+            already aligned with the same inputs, reference index, HISAT2 options
+            and gene annotation, and save new ones, in this directory. Without
+            a directory: {DEFAULT_COUNT_CACHE_PATH}. Default: no cache.
+            """
+        ),
+    )
+    p.add_argument(
+        '--count-cache-size-gb',
+        type=float,
+        default=DEFAULT_SIZE_GB,
+        help=normalize_whitespace(
+            f"""
+            Maximum total size of --count-cache, in GiB. The least recently used
+            entries are removed when it is exceeded. Default: {DEFAULT_SIZE_GB}
+            """
+        ),
+    )
+
+def configure_count_cache(args: Namespace):
+    """
+    Applies the options of `add_count_cache_command_line_arguments` to this
+    process and any processes it starts.
+    """
+    if args.count_cache is None:
+        return
+    configure(args.count_cache, int(args.count_cache_size_gb * GIGABYTE))
+
+def configure(root: Path, max_bytes: int):
+    os.environ[COUNT_CACHE_ENVIRONMENT_VARIABLE] = json.dumps(
+        {
+            'root': str(root.absolute()),
+            'max_bytes': max_bytes,
+        }
+    )
+
+def current() -> Optional['CountCache']:
+    """
+    :return: Count cache configured for this process, or None if disabled
+    """
+    configuration = os.environ.get(COUNT_CACHE_ENVIRONMENT_VARIABLE)
+    if not configuration:
+        return None
+    return _count_cache(configuration)
+
+@lru_cache(maxsize=None)
+def _count_cache(configuration: str) -> 'CountCache':
+    settings = json.loads(configuration)
+    return CountCache(Path(settings['root']), settings['max_bytes'])
+
+def srr_input(srr_id: str) -> str:
+    return f'srr:{srr_id}'
+
+@lru_cache(maxsize=None)
+def reference_signature(reference_path: Optional[Path]=None) -> str:
+    """
+    Identifies a HISAT2 index by its files' names, sizes and modification
+    times; hashing their contents would take about as long as aligning a
+    small sample.
+
+    :param reference_path: Base name of the index, as passed to HISAT2
+    """
+    if reference_path is None:
+        reference_path = REFERENCE_INDEX_PATH
+    reference_path = Path(reference_path).absolute()
+    pieces = [str(reference_path)]
+    for path in sorted(reference_path.parent.glob(f'{reference_path.name}.*.ht2*')):
+        stat = path.stat()
+        pieces.append(f'{path.name}:{stat.st_size}:{stat.st_mtime_ns}')
+    return sha1('\n'.join(pieces).encode('utf-8')).hexdigest()
+
+def file_sha1(path: Path) -> str:
+    h = sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class CacheKey(NamedTuple):
+    digest: str
+    inputs: str
+    reference: str
+    hisat2_options: Optional[str]
+    annotation: str
+
+class CountCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self.database() as connection:
+            for statement in CREATE_TABLE_STATEMENTS:
+                connection.execute(statement)
+
+    @contextmanager
+    def database(self) -> Iterator[sqlite3.Connection]:
+        """
+        Opens a connection for the `with` block, which is one transaction.
+        Connections aren't shared, since results are stored from pipeline
+        threads as well as the main thread.
+        """
+        with closing(sqlite3.connect(str(self.root / DATABASE_FILENAME), timeout=LOCK_TIMEOUT)) as connection:
+            with connection:
+                yield connection
+
+    def entry_path(self, digest: str) -> Path:
+        return self.root / f'{digest}{BINARY_SUFFIX}'
+
+    def checksum(self, path: Path) -> str:
+        path = path.absolute()
+        stat = path.stat()
+        with self.database() as connection:
+            row = connection.execute(
+                'SELECT sha1 FROM checksums WHERE path = ? AND size = ? AND mtime_ns = ?',
+                [str(path), stat.st_size, stat.st_mtime_ns],
+            ).fetchone()
+        if row is not None:
+            return row[0]
+
+        print('Computing checksum of', path)
+        with telemetry.stage('checksum_input'):
+            value = file_sha1(path)
+        with self.database() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO checksums (path, size, mtime_ns, sha1) VALUES (?, ?, ?, ?)',
+                [str(path), stat.st_size, stat.st_mtime_ns, value],
+            )
+        return value
+
+    def file_input(self, paths: List[Path]) -> str:
+        """
+        :param paths: SRA file, or one or two FASTQ files, in order
+        """
+        return 'sha1:' + ','.join(self.checksum(path) for path in paths)
+
+    def key(
+            self,
+            inputs: str,
+            hisat2_options: Optional[str]=None,
+            reference_path: Optional[Path]=None,
+            converter: Optional[str]=None,
+    ) -> CacheKey:
+        """
+        :param inputs: From `srr_input` or `file_input`
+        :param converter: Program that converts SRA input to FASTQ (see
+            `sra_conversion.active_converter`), or None for FASTQ input
+        """
+        # Whitespace in the options string doesn't change how HISAT2 runs
+        options = None if hisat2_options is None else ' '.join(hisat2_options.split())
+        fields = {
+            'version': KEY_VERSION,
+            'inputs': inputs,
+            'reference': reference_signature(reference_path),
+            'hisat2_options': options,
+            'annotation': load_gene_index().content_hash(),
+            'converter': converter,
+        }
+        digest = sha1(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+        return CacheKey(
+            digest=digest,
+            inputs=inputs,
+            reference=fields['reference'],
+            hisat2_options=options,
+            annotation=fields['annotation'],
+        )
+
+    def get(self, key: CacheKey) -> Optional[GeneCounts]:
+        """
+        :return: Result as computed by `map_reads_to_genes`, or None if not
+            cached
+        """
+        path = self.entry_path(key.digest)
+        gene_length = load_gene_index().gene_length_series
+        try:
+            sample = read_binary_sample(path)
+            if sample.annotation_hash != annotation_hash(gene_length):
+                raise ValueError(f'Genes in {path} do not match the gene index')
+            if sample.value_type != 'counts':
+                raise ValueError(f'{path} does not contain read counts')
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f'Ignoring unreadable count cache entry: {e}')
+            self.remove([key.digest])
+            return None
+
+        with self.database() as connection:
+            connection.execute(
+                'UPDATE entries SET last_used = ? WHERE key = ?',
+                [datetime.now().isoformat(), key.digest],
+            )
+        print(f'Using cached counts for {key.inputs} from', path)
+        read_counts = pd.Series(sample.values.astype(np.int64), index=gene_length.index)
+        rpkm = pd.Series(
+            rpkm_from_counts(sample.values, gene_length.to_numpy(), sample.summary['read_count']),
+            index=gene_length.index,
+        )
+        return GeneCounts(rpkm, sample.summary, read_counts)
+
+    def put(self, key: CacheKey, result: GeneCounts):
+        gene_length = load_gene_index().gene_length_series
+        data = encode_sample(key.digest, result.read_counts, result.summary, annotation_hash(gene_length), gene_length)
+        path = self.entry_path(key.digest)
+        write_atomic(path, data)
+        now = datetime.now().isoformat()
+        with self.database() as connection:
+            connection.execute(
+                """
+                INSERT OR REPLACE INTO entries
+                (key, size, created, last_used, inputs, reference, hisat2_options, annotation)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    key.digest,
+                    len(data),
+                    now,
+                    now,
+                    key.inputs,
+                    key.reference,
+                    key.hisat2_options,
+                    key.annotation,
+                ],
+            )
+        self.prune(self.max_bytes)
+
+    def cached(self, key: CacheKey, compute: Callable[[], GeneCounts]) -> GeneCounts:
+        """
+        :return: Cached result for `key`, or the result of `compute`, which
+            is then stored
+        """
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def entries(self) -> pd.DataFrame:
+        """
+        :return: Data frame of the 'entries' table, indexed by key, least
+            recently used first
+        """
+        with self.database() as connection:
+            return pd.read_sql_query(
+                'SELECT * FROM entries ORDER BY last_used',
+                connection,
+                index_col='key',
+            )
+
+    def remove(self, digests: List[str]):
+        with self.database() as connection:
+            connection.executemany('DELETE FROM entries WHERE key = ?', [[digest] for digest in digests])
+        for digest in digests:
+            path = self.entry_path(digest)
+            if path.is_file():
+                path.unlink()
+
+    def prune(self, max_bytes: Optional[int]=None, unused_days: Optional[float]=None) -> List[str]:
+        """
+        Removes the least recently used entries until the total size is at
+        most `max_bytes`, and entries not used in `unused_days` days.
+
+        :return: Keys of removed entries
+        """
+        entries = self.entries()
+        removed = set()
+        if unused_days is not None:
+            cutoff = (datetime.now() - timedelta(days=unused_days)).isoformat()
+            removed.update(entries.index[entries['last_used'] < cutoff])
+        if max_bytes is not None:
+            sizes = entries['size'].loc[~entries.index.isin(removed)]
+            # Keep the most recently used entries that fit
+            kept_bytes = sizes[::-1].cumsum()[::-1]
+            removed.update(sizes.index[kept_bytes > max_bytes])
+        removed = [digest for digest in entries.index if digest in removed]
+        if removed:
+            print(f'Removing {len(removed)} entries from count cache {self.root}')
+            self.remove(removed)
+        return removed
+
+def get_srr(
+        srr_id: str,
+        converter: str,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+) -> Optional[GeneCounts]:
+    """
+    :param converter: Program that would convert the SRA file to FASTQ
+    :return: Cached result for `srr_id` in the configured count cache, if
+        any, so that it doesn't have to be downloaded
+    """
+    cache = current()
+    if cache is None:
+        return None
+    return cache.get(cache.key(srr_input(srr_id), hisat2_options, reference_path, converter))
+
+def run_pipeline(
+        pipeline: Pipeline,
+        items: List[Any],
+        inputs: Callable[[CountCache, Any], str],
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        converter: Optional[str]=None,
+        on_result: Optional[Callable[[int, GeneCounts], None]]=None,
+        on_telemetry: Optional[Callable[[int, List[Dict[str, Any]]], None]]=None,
+        on_error: Optional[Callable[[int, BaseException], None]]=None,
+) -> List[GeneCounts]:
+    """
+    Runs `pipeline` (see `Pipeline.run`) on the items that aren't
+    in the configured count cache, and stores their results. Cached results
+    are passed to `on_result` first, without running any stage.
+
+    :param inputs: Called with the cache and an item, e.g. `file_input` of
+        the item's files, for the `inputs` of its `key`
+    :param converter: For the `key` of each item: the program that converts
+        SRA input to FASTQ, or None for FASTQ input
+    :return: Results of all items, in the same order as `items`, with None
+        for items that failed if `pipeline` doesn't stop on errors
+    """
+    cache = current()
+    if cache is None:
+        return pipeline.run(items, on_result=on_result, on_telemetry=on_telemetry, on_error=on_error)
+
+    keys = [cache.key(inputs(cache, item), hisat2_options, reference_path, converter) for item in items]
+    results: Dict[int, GeneCounts] = {}
+    for i, key in enumerate(keys):
+        result = cache.get(key)
+        if result is not None:
+            results[i] = result
+            if on_result is not None:
+                on_result(i, result)
+    missing = [i for i in range(len(items)) if i not in results]
+
+    def store(j: int, result: GeneCounts):
+        cache.put(keys[missing[j]], result)
+        if on_result is not None:
+            on_result(missing[j], result)
+
+    def add_telemetry(j: int, records: List[Dict[str, Any]]):
+        on_telemetry(missing[j], records)
+
+    def report_error(j: int, e: BaseException):
+        on_error(missing[j], e)
+
+    if missing:
+        computed = pipeline.run(
+            [items[i] for i in missing],
+            on_result=store,
+            on_telemetry=add_telemetry if on_telemetry is not None else None,
+            on_error=report_error if on_error is not None else None,
+        )
+        results.update(zip(missing, computed))
+    return [results[i] for i in range(len(items))]
+
+def print_entries(cache: CountCache):
+    entries = cache.entries()
+    total_bytes = int(entries['size'].sum())
+    print(
+        f'{entries.shape[0]} entries in {cache.root}, '
+        f'{total_bytes / GIGABYTE:.3f} of {cache.max_bytes / GIGABYTE:.3f} GiB'
+    )
+    for digest, row in entries.iloc[::-1].iterrows():
+        print(
+            f'\t{digest[:12]}  {row["size"]:>10}  last used {row["last_used"]}  '
+            f'{row["inputs"]}  options: {row["hisat2_options"]}  reference: {row["reference"][:12]}  '
+            f'annotation: {row["annotation"][:12]}'
+        )
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    add_count_cache_command_line_arguments(p)
+    p.set_defaults(count_cache=DEFAULT_COUNT_CACHE_PATH)
+    subparsers = p.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('inspect', help='List cache entries, most recently used first')
+    prune_parser = subparsers.add_parser(
+        'prune',
+        help='Remove least recently used entries beyond --count-cache-size-gb',
+    )
+    prune_parser.add_argument(
+        '--unused-days',
+        type=float,
+        help='Also remove entries that weren\'t used in this many days',
+    )
+    args = p.parse_args()
+
+    cache = CountCache(args.count_cache, int(args.count_cache_size_gb * GIGABYTE))
+    if args.command == 'inspect':
+        print_entries(cache)
+    elif args.command == 'prune':
+        removed = cache.prune(cache.max_bytes, args.unused_days)
+        print(f'Removed {len(removed)} entries')
+        print_entries(cache)
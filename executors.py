@@ -0,0 +1,307 @@
+"""
+Backends that run the array tasks planned by `cluster_scheduling`.
+
+Each task runs `process_sra_from_srr_list.py` on one line of an SRR list
+file. `SlurmExecutor` submits each list file as a SLURM job array, and
+`LocalExecutor` runs the same tasks on this machine, as many at once as
+fit in a budget of cores and memory, e.g. on a large standalone node or to
+test scheduling without SLURM.
+"""
+from abc import ABC, abstractmethod
+from collections import deque
+import os
+from pathlib import Path
+import signal
+from subprocess import Popen, check_call
+import sys
+from time import perf_counter, sleep
+from typing import Deque, List, NamedTuple, Optional
+
+import pandas as pd
+
+script_template = """
+#!/bin/bash
+
+#SBATCH -p {pool}
+#SBATCH --mem={memory_mb}
+#SBATCH --mincpus={subprocesses}
+#SBATCH -o {stdout_path}
+{time_directive}
+python3 process_sra_from_srr_list.py -s {subprocesses} --history-file {history_file} --state-file {state_file} {srr_list_file}
+""".strip()
+
+TIME_DIRECTIVE_TEMPLATE = '#SBATCH --time={time_minutes}\n'
+
+SBATCH_COMMAND_TEMPLATE = [
+    'sbatch',
+    '--array={array_index_spec}',
+    '{script_filename}',
+]
+
+SCRIPT_FILENAME_TEMPLATE = 'bulk_download_{}.sh'
+
+TASK_SCRIPT_PATH = Path(__file__).parent / 'process_sra_from_srr_list.py'
+
+LOCAL_TASK_COMMAND_TEMPLATE = [
+    '{python}',
+    '{script_path}',
+    '-s',
+    '{subprocesses}',
+    '--history-file',
+    '{history_file}',
+    '--state-file',
+    '{state_file}',
+    '--task-index',
+    '{task_index}',
+    '{srr_list_file}',
+]
+
+LOG_FILENAME_TEMPLATE = 'task_{array_name}_{task_index}.out'
+STATUS_FILENAME = 'task_status.tsv'
+
+# Seconds between checks of running local tasks
+POLL_INTERVAL = 0.5
+
+class TaskArray(NamedTuple):
+    # Used in file names; e.g. the zero-padded position of this array
+    name: str
+    # Each line holds the SRR IDs of one task
+    srr_list_path: Path
+    srr_groups: List[List[str]]
+    memory_mb: int
+    # None for no time limit
+    time_minutes: Optional[int]
+
+class Executor(ABC):
+    """
+    Interface of task backends. `submit` is called with each task array,
+    then `finish` once.
+    """
+    @abstractmethod
+    def submit(self, task_array: TaskArray):
+        pass
+
+    def finish(self) -> bool:
+        """
+        :return: Whether every task succeeded, as far as is known when this
+            returns
+        """
+        return True
+
+class SlurmExecutor(Executor):
+    def __init__(self, pool: str, subprocesses: int, history_file: Path, state_file: Path, slurm_path: Path):
+        self.pool = pool
+        self.subprocesses = subprocesses
+        self.history_file = history_file
+        self.state_file = state_file
+        self.slurm_path = slurm_path
+
+    def submit(self, task_array: TaskArray):
+        i = task_array.name
+        array_index_spec = f'0-{len(task_array.srr_groups) - 1}'
+
+        script_file = self.slurm_path / SCRIPT_FILENAME_TEMPLATE.format(i)
+        print(f'{i} Saving script to {script_file}')
+        with open(script_file, 'w') as f:
+            time_directive = ''
+            if task_array.time_minutes is not None:
+                time_directive = TIME_DIRECTIVE_TEMPLATE.format(time_minutes=task_array.time_minutes)
+            script_content = script_template.format(
+                srr_list_file=task_array.srr_list_path.absolute(),
+                pool=self.pool,
+                subprocesses=self.subprocesses,
+                memory_mb=task_array.memory_mb,
+                time_directive=time_directive,
+                history_file=self.history_file.absolute(),
+                state_file=self.state_file.absolute(),
+                stdout_path=script_file.with_suffix('.out')
+            )
+            print(script_content, file=f)
+
+        slurm_command = [
+            piece.format(
+                array_index_spec=array_index_spec,
+                script_filename=script_file,
+            )
+            for piece in SBATCH_COMMAND_TEMPLATE
+        ]
+        print(f'{i} Running', ' '.join(slurm_command))
+        check_call(slurm_command)
+
+class LocalTask(NamedTuple):
+    array_name: str
+    task_index: int
+    srr_ids: List[str]
+    command: List[str]
+    memory_mb: int
+    time_minutes: Optional[int]
+    log_path: Path
+
+class LocalTaskResult(NamedTuple):
+    task: LocalTask
+    # 'succeeded', 'failed' or 'timed out'
+    status: str
+    returncode: int
+    seconds: float
+
+def physical_memory_mb() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 ** 20
+
+class LocalExecutor(Executor):
+    """
+    Runs tasks as separate processes on this machine, starting tasks in
+    order whenever the cores and memory requested by the next task are
+    free. A task that needs more than the whole budget is run alone.
+    Memory limits are only used to decide when to start tasks, but time
+    limits are enforced as SLURM does, by killing the task.
+    """
+    def __init__(
+            self,
+            subprocesses: int,
+            history_file: Path,
+            state_file: Path,
+            cores: Optional[int]=None,
+            memory_mb: Optional[int]=None,
+    ):
+        """
+        :param cores: Defaults to all cores of this machine
+        :param memory_mb: Defaults to all physical memory of this machine
+        """
+        self.subprocesses = subprocesses
+        self.history_file = history_file
+        self.state_file = state_file
+        # Logs are saved next to the SRR list files
+        self.log_path: Optional[Path] = None
+        self.cores = os.cpu_count() if cores is None else cores
+        self.memory_mb = physical_memory_mb() if memory_mb is None else memory_mb
+        self.pending: Deque[LocalTask] = deque()
+        self.results: List[LocalTaskResult] = []
+
+    def submit(self, task_array: TaskArray):
+        self.log_path = task_array.srr_list_path.parent
+        for task_index, srr_group in enumerate(task_array.srr_groups):
+            command = [
+                piece.format(
+                    python=sys.executable,
+                    script_path=TASK_SCRIPT_PATH,
+                    subprocesses=self.subprocesses,
+                    history_file=self.history_file.absolute(),
+                    state_file=self.state_file.absolute(),
+                    task_index=task_index,
+                    srr_list_file=task_array.srr_list_path.absolute(),
+                )
+                for piece in LOCAL_TASK_COMMAND_TEMPLATE
+            ]
+            log_path = self.log_path / LOG_FILENAME_TEMPLATE.format(
+                array_name=task_array.name,
+                task_index=task_index,
+            )
+            self.pending.append(
+                LocalTask(
+                    array_name=task_array.name,
+                    task_index=task_index,
+                    srr_ids=srr_group,
+                    command=command,
+                    memory_mb=task_array.memory_mb,
+                    time_minutes=task_array.time_minutes,
+                    log_path=log_path,
+                )
+            )
+        print(f'{task_array.name} Queued {len(task_array.srr_groups)} local tasks')
+
+    def finish(self) -> bool:
+        task_count = len(self.pending)
+        print(f'Running {task_count} tasks with {self.cores} cores and {self.memory_mb} MB of memory')
+        # Each entry: task, process, start time, open log file
+        running = []
+        start = perf_counter()
+        try:
+            while self.pending or running:
+                while self.pending and self._fits(self.pending[0], running):
+                    task = self.pending.popleft()
+                    log_file = open(task.log_path, 'w')
+                    print(f'Starting task {task.array_name}/{task.task_index}: {" ".join(task.srr_ids)}')
+                    process = Popen(task.command, stdout=log_file, stderr=log_file, start_new_session=True)
+                    running.append((task, process, perf_counter(), log_file))
+                sleep(POLL_INTERVAL)
+
+                still_running = []
+                for task, process, task_start, log_file in running:
+                    elapsed = perf_counter() - task_start
+                    timed_out = task.time_minutes is not None and elapsed > task.time_minutes * 60
+                    if process.poll() is None and not timed_out:
+                        still_running.append((task, process, task_start, log_file))
+                        continue
+                    if process.returncode is None:
+                        os.killpg(process.pid, signal.SIGKILL)
+                        process.wait()
+                        status = 'timed out'
+                    else:
+                        status = 'failed' if process.returncode else 'succeeded'
+                    log_file.close()
+                    self.results.append(LocalTaskResult(task, status, process.returncode, elapsed))
+                    print(
+                        f'[{len(self.results)}/{task_count}] Task {task.array_name}/{task.task_index} '
+                        f'{status} after {elapsed:.1f}s ({len(task.srr_ids)} SRR IDs); log: {task.log_path}'
+                    )
+                running = still_running
+        finally:
+            # Tasks run in their own sessions, so they aren't interrupted
+            # along with this process, e.g. by Ctrl-C
+            for task, process, task_start, log_file in running:
+                if process.poll() is None:
+                    print(f'Killing task {task.array_name}/{task.task_index}')
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    process.wait()
+                log_file.close()
+
+        if self.results:
+            self.print_report(perf_counter() - start)
+        return all(result.status == 'succeeded' for result in self.results)
+
+    def _fits(self, task: LocalTask, running: list) -> bool:
+        if not running:
+            return True
+        cores_used = len(running) * self.subprocesses
+        memory_used = sum(running_task.memory_mb for running_task, *_ in running)
+        return (
+            cores_used + self.subprocesses <= self.cores and
+            memory_used + task.memory_mb <= self.memory_mb
+        )
+
+    def print_report(self, wall_seconds: float):
+        """
+        Prints totals and throughput, and saves the status of each task to a
+        tab-separated file in the log directory.
+        """
+        status = pd.DataFrame(
+            [
+                {
+                    'array': result.task.array_name,
+                    'task': result.task.task_index,
+                    'status': result.status,
+                    'returncode': result.returncode,
+                    'seconds': result.seconds,
+                    'srr_ids': ' '.join(result.task.srr_ids),
+                    'log': str(result.task.log_path),
+                }
+                for result in self.results
+            ]
+        )
+        status_path = self.log_path / STATUS_FILENAME
+        status.to_csv(status_path, sep='\t', index=False)
+
+        succeeded = [result for result in self.results if result.status == 'succeeded']
+        srr_count = sum(len(result.task.srr_ids) for result in succeeded)
+        rate = srr_count / wall_seconds * 3600 if wall_seconds else 0.0
+        print(
+            f'{len(succeeded)} of {len(self.results)} tasks succeeded ({srr_count} SRR IDs) '
+            f'in {wall_seconds:.1f}s: {rate:.1f} SRR IDs per hour'
+        )
+        for result in self.results:
+            if result.status != 'succeeded':
+                print(f'\tTask {result.task.array_name}/{result.task.task_index} {result.status}: {result.task.log_path}')
+        print('Saved task status to', status_path)
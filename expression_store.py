@@ -0,0 +1,229 @@
+"""
+Incremental, resumable storage of per-sample results in the HDF5 output file.
+
+Each sample's RPKM and alignment metadata are written to the output file as
+soon as that sample finishes, under the 'samples' group. A sample is
+complete once its alignment metadata has been written, which happens after
+its RPKM values, so an interrupted run can be resumed by skipping every
+sample with alignment metadata in the file.
+
+After the last sample, `ExpressionStore.finalize` writes the combined 'rpkm'
+and 'alignment_metadata' data frames to a new file which replaces the
+output file, so that finished output has the same layout as before (and
+doesn't also contain a second copy of all data in the 'samples' group).
+
+With sparse output, RPKM values are instead saved as a sparse matrix in the
+'rpkm_sparse' group (see `sparse_matrix`), rows of which are appended as
+samples finish. The dense matrix is never created.
+"""
+from argparse import ArgumentParser
+from hashlib import sha1
+import os
+from pathlib import Path
+from tempfile import mkstemp
+from threading import Lock
+from typing import Dict, List, Tuple
+
+import pandas as pd
+import tables
+
+from gene_index import load_gene_index
+from sparse_matrix import SparseMatrixReader, SparseMatrixWriter
+from utils import normalize_whitespace
+
+SAMPLE_GROUP = 'samples'
+RPKM_KEY = 'rpkm'
+ALIGNMENT_METADATA_KEY = 'alignment_metadata'
+SPARSE_RPKM_KEY = 'rpkm_sparse'
+
+def add_output_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--resume',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Resume an interrupted run: samples already saved in the output file
+            are skipped. Without this option, results of an earlier run in the
+            output file are discarded.
+            """
+        ),
+    )
+    p.add_argument(
+        '--sparse-output',
+        action='store_true',
+        help=normalize_whitespace(
+            f"""
+            Save RPKM values as a compressed sparse matrix in the
+            '{SPARSE_RPKM_KEY}' group of the output file, instead of a dense
+            'rpkm' data frame. Recommended for large numbers of single cells.
+            Load with sparse_matrix.load_sparse_frame or load_sparse_matrix.
+            """
+        ),
+    )
+
+def sample_key(sample_name: str) -> str:
+    """
+    :param sample_name: Any string identifying a sample, e.g. file names
+    :return: Name usable as a PyTables node name, unique to `sample_name`
+    """
+    return 'sample_' + sha1(sample_name.encode('utf-8')).hexdigest()
+
+class ExpressionStore:
+    def __init__(self, output_path: Path, resume: bool=False, sparse: bool=False):
+        """
+        :param output_path: HDF5 file to write
+        :param resume: Whether to keep samples saved by an earlier run with
+            the same `output_path`. If False, the file is replaced.
+        :param sparse: Whether to save RPKM values as a sparse matrix
+        :raises ValueError: If resuming and `output_path` was already
+            finalized, since per-sample results are no longer in the file
+        """
+        self.output_path = output_path
+        self.sparse = sparse
+        if output_path.is_file() and not resume:
+            print('Removing results of earlier run in', output_path)
+            output_path.unlink()
+        self.store = pd.HDFStore(output_path)
+        self.lock = Lock()
+
+        if resume and self.finalized():
+            self.close()
+            message = (
+                f'{output_path} is the finished output of an earlier run and '
+                f'contains no per-sample results to resume from; run without '
+                f'--resume to recompute all samples, or write to a new file'
+            )
+            raise ValueError(message)
+
+        self.sparse_rpkm_path = f'/{SAMPLE_GROUP}/{SPARSE_RPKM_KEY}'
+        self.sparse_writer = None
+        # Row of each sample in the sparse RPKM matrix
+        self.sparse_rows: Dict[str, int] = {}
+        if sparse and self.sparse_rpkm_path in self.store:
+            reader = SparseMatrixReader(self.h5_file, self.sparse_rpkm_path)
+            # If a sample was saved more than once, its last row is used
+            self.sparse_rows = {name: i for i, name in enumerate(reader.row_names())}
+
+    @property
+    def h5_file(self) -> tables.File:
+        return self.store.root._v_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.store.is_open:
+            self.store.close()
+
+    def finalized(self) -> bool:
+        """
+        :return: Whether the output file was written by `finalize`, which
+            removes the 'samples' group
+        """
+        return (
+            f'/{SAMPLE_GROUP}' not in self.h5_file
+            and f'/{ALIGNMENT_METADATA_KEY}' in self.store
+        )
+
+    def _sample_path(self, key: str, sample_name: str) -> str:
+        return f'/{SAMPLE_GROUP}/{key}/{sample_key(sample_name)}'
+
+    def completed(self, sample_name: str) -> bool:
+        if self.sparse:
+            rpkm_saved = sample_name in self.sparse_rows
+        else:
+            rpkm_saved = self._sample_path(RPKM_KEY, sample_name) in self.store
+        return rpkm_saved and self._sample_path(ALIGNMENT_METADATA_KEY, sample_name) in self.store
+
+    def save_sample(self, sample_name: str, rpkm: pd.Series, alignment_metadata: pd.Series):
+        """
+        Saves one sample's results and flushes them to disk. Safe to call
+        from multiple threads.
+        """
+        with self.lock:
+            print('Saving results for', sample_name, 'to', self.output_path)
+            if self.sparse:
+                if self.sparse_writer is None:
+                    self.sparse_writer = SparseMatrixWriter(self.h5_file, self.sparse_rpkm_path, rpkm.index)
+                self.sparse_rows[sample_name] = self.sparse_writer.row_count
+                self.sparse_writer.append_row(sample_name, rpkm)
+            else:
+                self.store.put(self._sample_path(RPKM_KEY, sample_name), rpkm)
+            # Written last, since this marks the sample as complete
+            self.store.put(self._sample_path(ALIGNMENT_METADATA_KEY, sample_name), alignment_metadata)
+            self.store.flush(fsync=True)
+
+    def load_sample(self, sample_name: str) -> Tuple[pd.Series, pd.Series]:
+        with self.lock:
+            return (
+                self.store[self._sample_path(RPKM_KEY, sample_name)],
+                self.store[self._sample_path(ALIGNMENT_METADATA_KEY, sample_name)],
+            )
+
+    def load_alignment_metadata(self, sample_name: str) -> pd.Series:
+        with self.lock:
+            return self.store[self._sample_path(ALIGNMENT_METADATA_KEY, sample_name)]
+
+    def finalize(self, sample_names: List[str]):
+        """
+        Combines the saved results for `sample_names`, in that order, into
+        'rpkm' (or 'rpkm_sparse') and 'alignment_metadata', and replaces the
+        output file with one containing only these.
+        """
+        print('Saving expression and alignment metadata to', self.output_path)
+        fd, temp_path = mkstemp(
+            dir=self.output_path.parent,
+            prefix=f'.{self.output_path.name}.',
+            suffix='.tmp',
+        )
+        os.close(fd)
+        try:
+            if self.sparse:
+                self._write_sparse_output(sample_names, temp_path)
+            else:
+                self._write_dense_output(sample_names, temp_path)
+            os.replace(temp_path, self.output_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _write_dense_output(self, sample_names: List[str], temp_path: str):
+        all_rpkm = []
+        all_alignment_metadata = []
+        for sample_name in sample_names:
+            rpkm, alignment_metadata = self.load_sample(sample_name)
+            all_rpkm.append(rpkm)
+            all_alignment_metadata.append(alignment_metadata)
+        self.close()
+
+        with pd.HDFStore(temp_path, mode='w') as store:
+            store[RPKM_KEY] = pd.DataFrame(all_rpkm)
+            store[ALIGNMENT_METADATA_KEY] = pd.DataFrame(all_alignment_metadata)
+
+    def _write_sparse_output(self, sample_names: List[str], temp_path: str):
+        alignment_metadata = pd.DataFrame(
+            [self.load_alignment_metadata(sample_name) for sample_name in sample_names]
+        )
+        with pd.HDFStore(temp_path, mode='w') as store:
+            store[ALIGNMENT_METADATA_KEY] = alignment_metadata
+
+        if self.sparse_rpkm_path not in self.h5_file:
+            # No sample was ever saved, so write an empty matrix with the
+            # usual gene columns rather than no matrix at all
+            with tables.open_file(temp_path, mode='a') as h5_file:
+                SparseMatrixWriter(h5_file, f'/{SPARSE_RPKM_KEY}', load_gene_index().gene_length_series.index)
+            self.close()
+            return
+
+        # Rows are copied in the order of `sample_names`, which may differ
+        # from the order in which samples finished
+        reader = SparseMatrixReader(self.h5_file, self.sparse_rpkm_path)
+        with tables.open_file(temp_path, mode='a') as h5_file:
+            writer = SparseMatrixWriter(h5_file, f'/{SPARSE_RPKM_KEY}', reader.column_names())
+            for sample_name in sample_names:
+                indices, values = reader.row(self.sparse_rows[sample_name])
+                writer.append_sparse_row(sample_name, indices, values)
+        self.close()
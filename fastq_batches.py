@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Batched alignment of many small FASTQ groups (e.g. one cell each, from a
+plate-based experiment) with a single run of HISAT2, so the index is only
+loaded once per batch instead of once per group.
+
+Each read name is tagged with the position of its group in the batch, as a
+fixed-width, zero-padded decimal suffix: '{read name}_{group index}'. HISAT2
+copies read names to its output, so the group of each alignment is read
+from the end of QNAME by `SamChunkReader`, and reads are counted per group
+in a single pass. Each group's RPKM values and summary are the same as from
+aligning and quantifying that group alone.
+
+Reads are tagged by awk rather than in Python, after decompression by the
+same external programs used for compressed input to HISAT2 (see
+`compression`); see `start_group_tagging_fifos`.
+"""
+from argparse import ArgumentParser
+from functools import partial
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from alignment import build_hisat2_command, run_hisat2, stream_alignment_compute_expr
+import count_cache
+from compression import MAX_DECOMPRESSION_THREADS, compression_suffix, decompression_command, fastq_base_name
+from gene_index import GeneIndex, load_gene_index
+from map_reads_to_genes import GeneCounts, summarize_counts
+from named_pipes import ProducerGroup, create_fifos
+from sam_reader import SamChunkReader
+import scratch
+from utils import digits, normalize_whitespace
+
+GROUP_TAG_SEPARATOR = '_'
+
+# Appends `suffix`, set before each file, to the read name (without any
+# '/1' or '/2' mate suffix or comment) in the header line of each record,
+# and fails if a file ends with an incomplete record
+TAG_READS_AWK_PROGRAM = r"""
+function truncated() {
+    printf "Truncated FASTQ record at end of %s\n", file > "/dev/stderr"
+    failed = 1
+    exit 1
+}
+FNR == 1 {
+    if (lines % 4) truncated()
+    file = FILENAME
+}
+{ lines = FNR }
+FNR % 4 == 1 {
+    name = $1
+    sub(/\/[12]$/, "", name)
+    print name suffix
+    next
+}
+{ print }
+END {
+    if (!failed && lines % 4) truncated()
+}
+"""
+
+def add_batch_command_line_argument(p: ArgumentParser):
+    p.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help=normalize_whitespace(
+            """
+            Number of single- or paired-end FASTQ groups to align with each run
+            of HISAT2. Reads are tagged with their group, and alignments are split
+            by group when counting, so results are the same as aligning each
+            group separately, but the HISAT2 index is loaded once per batch.
+            Default: 1, which aligns each group separately.
+            """
+        ),
+    )
+
+def group_tag_width(group_count: int) -> int:
+    return max(digits(group_count - 1), 1)
+
+def split_into_batches(fastq_groups: List[List[Path]], batch_size: int) -> List[List[int]]:
+    """
+    Splits groups into batches of at most `batch_size` groups, keeping
+    single- and paired-end groups in separate batches, since HISAT2 aligns
+    all reads in one run in the same mode.
+
+    :return: List of batches, each a list of positions in `fastq_groups`
+    """
+    batches = []
+    current_batches = {}
+    for i, fastq_group in enumerate(fastq_groups):
+        batch = current_batches.setdefault(len(fastq_group), [])
+        if not batch:
+            batches.append(batch)
+        batch.append(i)
+        if len(batch) >= batch_size:
+            current_batches[len(fastq_group)] = []
+    return batches
+
+def tag_reads_command(fastq_paths: List[Path], width: int) -> List[str]:
+    """
+    :return: awk command writing all reads in `fastq_paths` to stdout,
+        appending the position of each file in `fastq_paths` to its read names
+    """
+    command = ['awk', TAG_READS_AWK_PROGRAM]
+    for i, path in enumerate(fastq_paths):
+        # Absolute paths can't be mistaken for awk variable assignments
+        command.extend([f'suffix={GROUP_TAG_SEPARATOR}{i:0{width}d}', str(path.absolute())])
+    return command
+
+def start_group_tagging_fifos(
+        fastq_groups: List[List[Path]],
+        fifo_dir: Path,
+        threads: int=1,
+) -> Tuple[List[Path], ProducerGroup]:
+    """
+    Starts one process per mate, writing the tagged reads of every group
+    into a named pipe in `fifo_dir`. All groups must have the same number
+    of FASTQ files. Compressed files are decompressed into further named
+    pipes in `fifo_dir`, each of which is read in turn.
+
+    :param threads: Number of threads for each decompression process
+
+    :return: 2-tuple: FIFO paths to pass to HISAT2 (one if single-end, two
+        if paired-end), and the running processes, to be supervised while
+        the FIFOs are read
+    """
+    mate_count = len(fastq_groups[0])
+    if any(len(fastq_group) != mate_count for fastq_group in fastq_groups):
+        raise ValueError('Single- and paired-end FASTQ groups must be aligned in separate batches')
+
+    fifo_paths = create_fifos(fifo_dir, [f'batch_{mate + 1}.fastq' for mate in range(mate_count)])
+    mate_paths = [[fastq_group[mate] for fastq_group in fastq_groups] for mate in range(mate_count)]
+    compressed_paths = [path for paths in mate_paths for path in paths if compression_suffix(path)]
+    decompression_fifo_paths = create_fifos(
+        fifo_dir,
+        (f'{i}_{fastq_base_name(path)}.fastq' for i, path in enumerate(compressed_paths)),
+    )
+    fifos_by_path = dict(zip(compressed_paths, decompression_fifo_paths))
+
+    producers = ProducerGroup(fifo_paths + decompression_fifo_paths)
+    decompression_threads = max(min(threads, MAX_DECOMPRESSION_THREADS), 1)
+    for path, fifo_path in fifos_by_path.items():
+        producers.start(decompression_command(path, decompression_threads), output_path=fifo_path)
+
+    width = group_tag_width(len(fastq_groups))
+    # Byte-oriented matching and output, which is much faster in a UTF-8 locale
+    env = {**os.environ, 'LC_ALL': 'C'}
+    for paths, fifo_path in zip(mate_paths, fifo_paths):
+        command = tag_reads_command([fifos_by_path.get(path, path) for path in paths], width)
+        producers.start(command, output_path=fifo_path, name='tag_groups', env=env)
+    return fifo_paths, producers
+
+def parse_group_tags(suffixes: np.ndarray) -> np.ndarray:
+    """
+    :param suffixes: Last bytes of each read name, as a 2-D uint8 array;
+        see `SamChunk.qname_suffixes`
+    :return: Group index of each read
+    """
+    digit_values = suffixes[:, 1:].astype(np.int64) - ord('0')
+    valid = (suffixes[:, 0] == ord(GROUP_TAG_SEPARATOR)) & ((digit_values >= 0) & (digit_values <= 9)).all(axis=1)
+    if not valid.all():
+        raise ValueError('Found read names without group tags in batched alignments')
+    place_values = 10 ** np.arange(digit_values.shape[1] - 1, -1, -1, dtype=np.int64)
+    return digit_values @ place_values
+
+def map_sam_file_to_groups(
+        sam_file: BinaryIO,
+        group_count: int,
+        gene_index: Optional[GeneIndex]=None,
+) -> List[GeneCounts]:
+    """
+    Like `map_sam_file_to_genes`, but for the alignments of a batch of
+    groups with tagged read names.
+
+    :param gene_index: If omitted, uses `load_gene_index()`
+    :return: Result of each group
+    """
+    if gene_index is None:
+        gene_index = load_gene_index()
+    gene_length = gene_index.gene_length_series
+
+    counts = np.zeros((group_count, gene_index.gene_count), dtype=np.int64)
+    reads_mapped_to_genes = np.zeros(group_count, dtype=np.int64)
+    reads_aligned = np.zeros(group_count, dtype=np.int64)
+    reads_total = np.zeros(group_count, dtype=np.int64)
+
+    reader = SamChunkReader(sam_file, qname_suffix_length=len(GROUP_TAG_SEPARATOR) + group_tag_width(group_count))
+    for chunk in reader:
+        groups = parse_group_tags(chunk.qname_suffixes)
+        if (groups >= group_count).any():
+            raise ValueError(f'Found group tags beyond the {group_count} groups in this batch')
+        reads_total += np.bincount(groups, minlength=group_count)
+
+        aligned = np.flatnonzero((chunk.flags & 0x4) == 0)
+        reads_aligned += np.bincount(groups[aligned], minlength=group_count)
+
+        chrom_ids = gene_index.chrom_ids(np.array(reader.reference_names, dtype=str))
+        starts = chunk.positions[aligned]
+        read_indices, gene_indices = gene_index.overlaps(
+            chrom_ids[chunk.reference_ids[aligned]],
+            starts,
+            starts + chunk.lengths[aligned],
+        )
+        group_gene_keys, group_gene_counts = np.unique(
+            groups[aligned[read_indices]] * gene_index.gene_count + gene_indices,
+            return_counts=True,
+        )
+        # Keys are unique, so this adds each count once
+        counts.reshape(-1)[group_gene_keys] += group_gene_counts
+        reads_mapped_to_genes += np.bincount(groups[aligned[np.unique(read_indices)]], minlength=group_count)
+
+    return [
+        summarize_counts(
+            read_counts=pd.Series(counts[i], index=gene_length.index),
+            gene_length=gene_length,
+            reads_total=int(reads_total[i]),
+            reads_aligned=int(reads_aligned[i]),
+            reads_mapped_to_genes=int(reads_mapped_to_genes[i]),
+        )
+        for i in range(group_count)
+    ]
+
+def align_fastq_batch_compute_expr(
+        fastq_groups: List[List[Path]],
+        subprocesses: int,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        stream_alignment: bool=False,
+        sam_dir: Optional[Path]=None,
+        use_cache: bool=True,
+) -> List[GeneCounts]:
+    """
+    Aligns a batch of FASTQ groups with one run of HISAT2, and computes
+    expression for each group.
+
+    :param fastq_groups: Groups of one or two FASTQ files, optionally
+        compressed; all single-end or all paired-end
+    :param stream_alignment: If True, read HISAT2 output from a pipe,
+        instead of writing a SAM file next to the first FASTQ file
+    :param sam_dir: Directory for the SAM file. If omitted, one is allocated
+        from the configured scratch space (see `scratch`), or the SAM file is
+        written next to the first FASTQ file.
+    :param use_cache: Whether to look up and store the result of each group
+        in the configured count cache (see `count_cache`); only groups that
+        aren't cached are aligned
+    :return: Result of each group, as from `map_sam_file_to_genes`
+    """
+    if not fastq_groups:
+        raise ValueError('No FASTQ groups provided')
+    first_path = fastq_groups[0][0]
+
+    cache = count_cache.current()
+    if use_cache and cache is not None:
+        keys = [cache.key(cache.file_input(fastq_group), hisat2_options, reference_path) for fastq_group in fastq_groups]
+        results = [cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            computed = align_fastq_batch_compute_expr(
+                fastq_groups=[fastq_groups[i] for i in missing],
+                subprocesses=subprocesses,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                stream_alignment=stream_alignment,
+                sam_dir=sam_dir,
+                use_cache=False,
+            )
+            for i, result in zip(missing, computed):
+                cache.put(keys[i], result)
+                results[i] = result
+        return results
+
+    space = scratch.current()
+    if sam_dir is None and not stream_alignment and space is not None:
+        fastq_paths = [path for fastq_group in fastq_groups for path in fastq_group]
+        with space.directory(scratch.estimate_sam_bytes(fastq_paths), 'sam_') as sam_dir:
+            return align_fastq_batch_compute_expr(
+                fastq_groups=fastq_groups,
+                subprocesses=subprocesses,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                sam_dir=sam_dir,
+                use_cache=use_cache,
+            )
+
+    with TemporaryDirectory(prefix='fastq_fifo_', dir=first_path.parent) as fifo_dir:
+        fifo_paths, producers = start_group_tagging_fifos(fastq_groups, Path(fifo_dir), subprocesses)
+        try:
+            if stream_alignment:
+                hisat_command = build_hisat2_command(
+                    fastq_paths=fifo_paths,
+                    subprocesses=subprocesses,
+                    sam_path=None,
+                    hisat2_options=hisat2_options,
+                    reference_path=reference_path,
+                )
+                return stream_alignment_compute_expr(
+                    hisat_command,
+                    producers,
+                    quantify=partial(map_sam_file_to_groups, group_count=len(fastq_groups)),
+                )
+
+            sam_path = (sam_dir or Path(fifo_dir)) / 'batch.sam'
+            hisat_command = build_hisat2_command(
+                fastq_paths=fifo_paths,
+                subprocesses=subprocesses,
+                sam_path=sam_path,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+            )
+            run_hisat2(hisat_command, producers)
+            print('Computing RPKM from', sam_path)
+            with open(sam_path, 'rb') as f:
+                return map_sam_file_to_groups(f, len(fastq_groups))
+        except BaseException:
+            producers.kill()
+            raise
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Array-backed gene lookup, replacing per-read IntervalTree queries.
+
+Gene intervals for all chromosomes are stored in flat NumPy arrays, sorted
+by chromosome and then by start position. Each position is offset by
+`chrom_id * CHROM_STRIDE`, so a single `np.searchsorted` call can resolve
+overlaps for a batch of reads spread over any number of chromosomes.
+
+Overlap semantics match `IntervalTree.overlap(begin, end)`: an interval
+[b, e) overlaps a read [start, end) iff b < end and e > start.
+
+The index is saved as a directory of uncompressed .npy files, which are
+memory-mapped on load. Loading is nearly free, and all worker processes on
+a node share the same pages of the OS file cache. Running this file as a
+script converts a `trees.pickle` file from an older `build_tree.py` run to
+this format.
+"""
+from argparse import ArgumentParser
+from functools import lru_cache
+from hashlib import sha1
+import json
+from pathlib import Path
+import pickle
+from typing import Dict, Iterable, Optional, Tuple
+
+from data_path_utils import find_newest_data_path
+import numpy as np
+import pandas as pd
+
+# Larger than any chromosome length, so (chrom_id, position) pairs can be
+# packed into one sortable int64 value
+CHROM_STRIDE = 2 ** 32
+
+GENE_INDEX_DIRECTORY_NAME = 'gene_index'
+TREE_PICKLE_FILENAME = 'trees.pickle'
+INDEX_METADATA_FILENAME = 'index.json'
+INDEX_FORMAT_VERSION = 1
+
+ARRAY_NAMES = [
+    'gene_ids',
+    'gene_length',
+    'chrom_names',
+    'starts',
+    'ends',
+    'max_ends',
+    'gene_indices',
+]
+
+class GeneIndex:
+    def __init__(
+            self,
+            gene_ids: np.ndarray,
+            gene_length: np.ndarray,
+            chrom_names: np.ndarray,
+            starts: np.ndarray,
+            ends: np.ndarray,
+            max_ends: np.ndarray,
+            gene_indices: np.ndarray,
+    ):
+        """
+        :param gene_ids: Gene IDs, in the order used for count vectors
+        :param gene_length: Gene lengths in kilobases, aligned with `gene_ids`
+        :param chrom_names: Chromosome names; position in this array is the
+            chromosome ID used in the packed coordinates below
+        :param starts: Packed interval start coordinates, sorted
+        :param ends: Packed interval end coordinates, aligned with `starts`
+        :param max_ends: Running maximum of `ends`, used to find the first
+            interval that can possibly overlap a given position
+        :param gene_indices: Index into `gene_ids` for each interval
+        """
+        self.gene_ids = gene_ids
+        self.gene_length = gene_length
+        self.chrom_names = chrom_names
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+        self.gene_indices = gene_indices
+
+        self.chrom_ids_by_name: Dict[str, int] = {
+            name: i for i, name in enumerate(chrom_names)
+        }
+        self._content_hash: Optional[str] = None
+
+    @property
+    def gene_count(self) -> int:
+        return len(self.gene_ids)
+
+    @property
+    def gene_length_series(self) -> pd.Series:
+        """
+        :return: Gene lengths in kilobases, indexed by gene ID
+        """
+        return pd.Series(self.gene_length, index=self.gene_ids.tolist())
+
+    def content_hash(self) -> str:
+        """
+        :return: Hash of every array in the index, which changes whenever the
+            annotation it was built from changes; computed once
+        """
+        if self._content_hash is None:
+            h = sha1()
+            for name in ARRAY_NAMES:
+                array = np.ascontiguousarray(getattr(self, name))
+                h.update(f'{name}:{array.dtype.str}:{array.shape}'.encode('utf-8'))
+                h.update(array.tobytes())
+            self._content_hash = h.hexdigest()
+        return self._content_hash
+
+    def save(self, path: Path):
+        """
+        :param path: Directory in which to save the index; created if
+            it doesn't already exist
+        """
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(path / f'{name}.npy', getattr(self, name), allow_pickle=False)
+        metadata = {
+            'format_version': INDEX_FORMAT_VERSION,
+            'gene_count': self.gene_count,
+            'interval_count': len(self.starts),
+        }
+        # Written last, so a partially-written index isn't considered valid
+        with open(path / INDEX_METADATA_FILENAME, 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool=True) -> 'GeneIndex':
+        """
+        :param path: Directory containing an index saved by `save`
+        :param mmap: Whether to memory-map the arrays instead of reading
+            them into memory
+        """
+        with open(path / INDEX_METADATA_FILENAME) as f:
+            metadata = json.load(f)
+        if metadata['format_version'] != INDEX_FORMAT_VERSION:
+            message = (
+                f'Unsupported gene index format version {metadata["format_version"]} '
+                f'in {path} (expected {INDEX_FORMAT_VERSION})'
+            )
+            raise ValueError(message)
+
+        mmap_mode = 'r' if mmap else None
+        arrays = {
+            name: np.load(path / f'{name}.npy', mmap_mode=mmap_mode, allow_pickle=False)
+            for name in ARRAY_NAMES
+        }
+        return cls(**arrays)
+
+    @classmethod
+    def from_intervals(
+            cls,
+            intervals: Iterable[Tuple[str, int, int, str]],
+            gene_length: pd.Series,
+    ) -> 'GeneIndex':
+        """
+        :param intervals: Iterable of (chromosome, start, end, gene ID) tuples
+        :param gene_length: Gene lengths in kilobases; the index of this
+            Series defines the gene order used in count vectors
+        """
+        gene_ids = np.array(gene_length.index, dtype=str)
+        gene_positions = {gene_id: i for i, gene_id in enumerate(gene_ids)}
+
+        interval_list = sorted(intervals)
+        chrom_names = np.array(sorted({chrom for chrom, *_ in interval_list}), dtype=str)
+        chrom_ids = {name: i for i, name in enumerate(chrom_names)}
+
+        starts = np.array(
+            [chrom_ids[chrom] * CHROM_STRIDE + start for chrom, start, _, _ in interval_list],
+            dtype=np.int64,
+        )
+        ends = np.array(
+            [chrom_ids[chrom] * CHROM_STRIDE + end for chrom, _, end, _ in interval_list],
+            dtype=np.int64,
+        )
+        gene_indices = np.array(
+            [gene_positions[gene_id] for *_, gene_id in interval_list],
+            dtype=np.int32,
+        )
+        order = np.argsort(starts, kind='stable')
+        starts = starts[order]
+        ends = ends[order]
+        gene_indices = gene_indices[order]
+        # Packed coordinates for later chromosomes are always larger, so the
+        # running maximum never carries over from one chromosome to the next
+        max_ends = np.maximum.accumulate(ends) if len(ends) else ends
+
+        return cls(
+            gene_ids=gene_ids,
+            gene_length=gene_length.values.astype(np.float64),
+            chrom_names=chrom_names,
+            starts=starts,
+            ends=ends,
+            max_ends=max_ends,
+            gene_indices=gene_indices,
+        )
+
+    @classmethod
+    def from_tree_data(cls, tree_data: dict) -> 'GeneIndex':
+        """
+        :param tree_data: Contents of a `trees.pickle` file saved by
+            `build_tree.py`
+        """
+        intervals = (
+            (chrom, interval.begin, interval.end, interval.data)
+            for chrom, tree in tree_data['trees'].items()
+            for interval in tree
+        )
+        return cls.from_intervals(intervals, tree_data['gene_length'])
+
+    def chrom_ids(self, chrom_names: np.ndarray) -> np.ndarray:
+        """
+        :param chrom_names: Array of chromosome names, one per read
+        :return: Array of chromosome IDs, with -1 for chromosomes that
+            contain no genes (or for unmapped reads, with name '*')
+        """
+        unique_names, inverse = np.unique(chrom_names, return_inverse=True)
+        unique_ids = np.array(
+            [self.chrom_ids_by_name.get(name, -1) for name in unique_names],
+            dtype=np.int64,
+        )
+        return unique_ids[inverse.reshape(-1)]
+
+    def overlaps(
+            self,
+            chrom_ids: np.ndarray,
+            starts: np.ndarray,
+            ends: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds all (read, gene) overlaps for a batch of reads.
+
+        :param chrom_ids: Chromosome ID for each read, from `chrom_ids`
+        :param starts: Start position of each read
+        :param ends: End position of each read (exclusive)
+        :return: 2-tuple of equal-length arrays: read indices into the input
+            arrays, and gene indices into `gene_ids`. A read appears once for
+            each gene it overlaps.
+        """
+        known = np.flatnonzero(chrom_ids >= 0)
+        offsets = chrom_ids[known].astype(np.int64) * CHROM_STRIDE
+        query_starts = offsets + starts[known]
+        query_ends = offsets + ends[known]
+
+        # Intervals before `lo` end at or before the read start, and those
+        # at or after `hi` begin at or after the read end
+        lo = np.searchsorted(self.max_ends, query_starts, side='right')
+        hi = np.searchsorted(self.starts, query_ends, side='left')
+        candidate_counts = np.maximum(hi - lo, 0)
+
+        read_positions = np.repeat(np.arange(len(known)), candidate_counts)
+        # Position of each candidate within its read's [lo, hi) range
+        within = np.arange(len(read_positions)) - np.repeat(
+            np.cumsum(candidate_counts) - candidate_counts,
+            candidate_counts,
+        )
+        candidates = lo[read_positions] + within
+
+        hit = self.ends[candidates] > query_starts[read_positions]
+        return known[read_positions[hit]], self.gene_indices[candidates[hit]]
+
+    def count_reads(
+            self,
+            chrom_ids: np.ndarray,
+            starts: np.ndarray,
+            ends: np.ndarray,
+    ) -> Tuple[np.ndarray, int]:
+        """
+        :return: 2-tuple: array of read counts per gene, and number of reads
+            that overlapped at least one gene
+        """
+        read_indices, gene_indices = self.overlaps(chrom_ids, starts, ends)
+        counts = np.bincount(gene_indices, minlength=self.gene_count)
+        reads_mapped_to_genes = len(np.unique(read_indices))
+        return counts, reads_mapped_to_genes
+
+def convert_tree_pickle(pickle_path: Path, output_path: Optional[Path]=None) -> Path:
+    """
+    :param pickle_path: `trees.pickle` file saved by `build_tree.py`
+    :param output_path: Directory in which to save the index. If omitted,
+        the index is saved next to `pickle_path`.
+    :return: Path to the saved index
+    """
+    if output_path is None:
+        output_path = pickle_path.parent / GENE_INDEX_DIRECTORY_NAME
+
+    print('Reading interval trees from', pickle_path)
+    with open(pickle_path, 'rb') as f:
+        tree_data = pickle.load(f)
+
+    gene_index = GeneIndex.from_tree_data(tree_data)
+    print('Saving gene index to', output_path)
+    gene_index.save(output_path)
+    return output_path
+
+@lru_cache(maxsize=None)
+def load_gene_index(path: Optional[Path]=None) -> GeneIndex:
+    """
+    Loads the gene index once per process; later calls return the same
+    memory-mapped object without searching the data directory again.
+
+    :param path: Gene index directory. If omitted, uses the index in the
+        newest `build_tree` data directory, converting its `trees.pickle`
+        in memory if that run predates the array-based index.
+    """
+    if path is None:
+        tree_path = find_newest_data_path('build_tree')
+        path = tree_path / GENE_INDEX_DIRECTORY_NAME
+        if not (path / INDEX_METADATA_FILENAME).is_file():
+            pickle_path = tree_path / TREE_PICKLE_FILENAME
+            print(f'No gene index in {tree_path}; building from {pickle_path}')
+            print(f'(Run `gene_index.py {pickle_path}` to save a gene index for faster loading.)')
+            with open(pickle_path, 'rb') as f:
+                return GeneIndex.from_tree_data(pickle.load(f))
+
+    return GeneIndex.load(path)
+
+if __name__ == '__main__':
+    p = ArgumentParser(
+        description='Convert a trees.pickle file saved by build_tree.py to a memory-mappable gene index',
+    )
+    p.add_argument(
+        'pickle_path',
+        type=Path,
+        nargs='?',
+        help='Path to trees.pickle. If omitted, uses the newest build_tree data directory.',
+    )
+    p.add_argument(
+        '--output-path',
+        type=Path,
+        help='Directory in which to save the index. If omitted, saved next to the pickle file.',
+    )
+    args = p.parse_args()
+
+    if args.pickle_path is None:
+        args.pickle_path = find_newest_data_path('build_tree') / TREE_PICKLE_FILENAME
+
+    convert_tree_pickle(args.pickle_path, args.output_path)
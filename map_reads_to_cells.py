@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+Per-cell quantification of pooled single-cell libraries, whose reads carry
+cell barcodes (and optionally UMIs) in their names; see `barcodes`.
+
+Alignments are read in a single streaming pass. Read counts are kept as
+sorted arrays of packed (barcode, gene) integer keys rather than a dense
+cells-by-genes matrix, so memory use is proportional to the number of
+nonzero counts, even with tens of thousands of cells and many more
+barcodes from empty droplets.
+
+If reads have UMIs, PCR duplicates can be collapsed in the same pass:
+each distinct (cell, gene, UMI) is counted once, as one molecule. These
+are kept as packed integer keys too, with barcodes replaced by small
+integer IDs in order of first appearance so that keys fit in 64 bits.
+Optionally, UMIs one mismatch away from a UMI with at least about twice
+as many reads are merged into it, as sequencing errors (the "directional"
+method of UMI-tools).
+"""
+from argparse import ArgumentParser
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tables
+
+from barcodes import ReadTagLayout, add_barcode_command_line_arguments, unpack_sequences
+from expression_store import ALIGNMENT_METADATA_KEY, SPARSE_RPKM_KEY
+from gene_index import GeneIndex, load_gene_index
+from sam_reader import SamChunkReader
+from sparse_matrix import SparseMatrixWriter
+from utils import normalize_whitespace
+
+SPARSE_COUNTS_KEY = 'counts_sparse'
+RUN_SUMMARY_KEY = 'run_summary'
+
+# Keys added to a `KeyCounter` are merged into its sorted arrays once there
+# are at least as many pending keys as merged keys, and at least this many
+MIN_MERGE_SIZE = 2 ** 22
+
+def add_cell_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--min-reads',
+        type=int,
+        default=1,
+        help=normalize_whitespace(
+            """
+            Minimum number of reads mapped to genes for a barcode to be reported
+            as a cell. Default: 1.
+            """
+        ),
+    )
+    p.add_argument(
+        '--deduplicate-umis',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Count molecules instead of reads: reads from the same cell with the
+            same UMI that map to the same gene are counted once. Requires
+            --umi-length.
+            """
+        ),
+    )
+    p.add_argument(
+        '--merge-umi-mismatches',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            With --deduplicate-umis, also merge UMIs that differ by one base from
+            a UMI with at least about twice as many reads, as sequencing errors.
+            """
+        ),
+    )
+
+def sum_by_key(keys: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: 2-tuple: sorted unique keys, and the sum of `counts` for each
+    """
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    counts = counts[order]
+    if not len(keys):
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+def lookup_counts(keys: np.ndarray, counts: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    :param keys: Sorted unique keys, with counts in `counts`
+    :return: Count of each key in `query`, or 0 if not present in `keys`
+    """
+    if not len(keys):
+        return np.zeros(len(query), dtype=np.int64)
+    positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[positions] == query, counts[positions], 0)
+
+class KeyCounter:
+    """
+    Counts occurrences of uint64 keys. Keys from each batch are counted
+    immediately, and merged into the sorted `keys` and `counts` arrays in
+    amortized O(n log n) total time, like a log-structured merge tree.
+    """
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending: List[Tuple[np.ndarray, np.ndarray]] = []
+        self.pending_size = 0
+
+    def add(self, keys: np.ndarray, counts: Optional[np.ndarray]=None):
+        if not len(keys):
+            return
+        if counts is None:
+            unique_keys, key_counts = np.unique(keys, return_counts=True)
+        else:
+            unique_keys, key_counts = sum_by_key(keys, counts)
+        self.pending.append((unique_keys.astype(np.uint64), key_counts.astype(np.int64)))
+        self.pending_size += len(unique_keys)
+        if self.pending_size >= max(len(self.keys), MIN_MERGE_SIZE):
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        keys, counts = zip(*self.pending)
+        self.keys, self.counts = sum_by_key(
+            np.concatenate([self.keys, *keys]),
+            np.concatenate([self.counts, *counts]),
+        )
+        self.pending = []
+        self.pending_size = 0
+
+    def items(self) -> Tuple[np.ndarray, np.ndarray]:
+        self.merge()
+        return self.keys, self.counts
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.counts.nbytes + sum(
+            keys.nbytes + counts.nbytes for keys, counts in self.pending
+        )
+
+class BarcodeIds:
+    """
+    Assigns consecutive integer IDs to packed barcodes, in order of first
+    appearance.
+    """
+    def __init__(self):
+        # Sorted, with the ID of each barcode in `ids`
+        self.barcodes = np.zeros(0, dtype=np.uint64)
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.barcodes)
+
+    def encode(self, barcodes: np.ndarray) -> np.ndarray:
+        unique_barcodes, inverse = np.unique(barcodes, return_inverse=True)
+        known = lookup_counts(self.barcodes, np.ones(len(self.barcodes), dtype=np.int64), unique_barcodes)
+        new_barcodes = unique_barcodes[known == 0]
+        if len(new_barcodes):
+            new_ids = np.arange(len(self), len(self) + len(new_barcodes), dtype=np.int64)
+            barcodes_by_id = np.concatenate([self.barcodes, new_barcodes])
+            order = np.argsort(barcodes_by_id, kind='stable')
+            self.barcodes = barcodes_by_id[order]
+            self.ids = np.concatenate([self.ids, new_ids])[order]
+        positions = np.searchsorted(self.barcodes, unique_barcodes)
+        return self.ids[positions][inverse]
+
+    def decode(self, ids: np.ndarray) -> np.ndarray:
+        barcodes_by_id = np.empty(len(self), dtype=np.uint64)
+        barcodes_by_id[self.ids] = self.barcodes
+        return barcodes_by_id[ids]
+
+    @property
+    def nbytes(self) -> int:
+        return self.barcodes.nbytes + self.ids.nbytes
+
+def umi_neighbor_pairs(keys: np.ndarray, umi_length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param keys: Sorted unique keys, with packed UMIs in the lowest bits
+    :return: 2-tuple of index arrays: for each pair of keys whose UMIs
+        differ in exactly one base (with all other bits equal), the indices
+        of both keys. Each pair is listed in both orders.
+    """
+    sources = []
+    targets = []
+    for position in range(umi_length):
+        for difference in range(1, 4):
+            neighbors = keys ^ np.uint64(difference << (2 * position))
+            found = lookup_counts(keys, np.arange(1, len(keys) + 1), neighbors)
+            source = np.flatnonzero(found)
+            sources.append(source)
+            targets.append(found[source] - 1)
+    return np.concatenate(sources), np.concatenate(targets)
+
+def merge_umi_mismatches(keys: np.ndarray, read_counts: np.ndarray, umi_length: int) -> np.ndarray:
+    """
+    Groups UMIs by the directional method of UMI-tools: there is an edge
+    from UMI `b` to UMI `a` if they differ by one base and `b` has at least
+    `2 * a - 1` reads. Starting from UMIs with the most reads, each UMI not
+    yet in a group starts a new group, containing all UMIs reachable from
+    it along edges that are not in an earlier group. Each group is counted
+    as one molecule.
+
+    Groups are not connected components: with UMIs AAA and ACC (10 reads
+    each) and ACA (1 read), ACA is reachable from both, but AAA and ACC
+    are not reachable from each other, so they are separate molecules.
+
+    :param keys: Sorted unique keys, with packed UMIs in the lowest bits
+    :param read_counts: Number of reads with each key
+    :return: Group label of each key, which is the index of the key that
+        started the group
+    """
+    sources, targets = umi_neighbor_pairs(keys, umi_length)
+    directional = read_counts[targets] >= 2 * read_counts[sources] - 1
+    # Edges from each UMI to the UMIs it absorbs, in CSR form
+    order = np.argsort(targets[directional], kind='stable')
+    heads = targets[directional][order]
+    tails = sources[directional][order]
+    indptr = np.searchsorted(heads, np.arange(len(keys) + 1))
+
+    labels = np.arange(len(keys))
+    assigned = np.zeros(len(keys), dtype=bool)
+    # Keys without edges are groups of their own, with their own labels
+    nodes = np.union1d(heads, tails)
+    for root in nodes[np.argsort(-read_counts[nodes], kind='stable')]:
+        if assigned[root]:
+            continue
+        assigned[root] = True
+        # As in UMI-tools, the search passes through UMIs in earlier
+        # groups, but does not take them into this group
+        visited = {root}
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            for neighbor in tails[indptr[node]:indptr[node + 1]]:
+                if neighbor in visited:
+                    continue
+                visited.add(neighbor)
+                queue.append(neighbor)
+                if not assigned[neighbor]:
+                    assigned[neighbor] = True
+                    labels[neighbor] = root
+    return labels
+
+class MoleculeCounter:
+    """
+    Counts reads per (cell, gene, UMI), as packed keys of barcode ID, gene
+    index and UMI, from most to least significant bits.
+    """
+    def __init__(self, gene_count: int, umi_length: int):
+        self.umi_length = umi_length
+        self.umi_bits = 2 * umi_length
+        self.gene_bits = max((gene_count - 1).bit_length(), 1)
+        self.barcode_id_bits = 64 - self.gene_bits - self.umi_bits
+        if self.barcode_id_bits < 1:
+            raise ValueError(f'UMIs of length {umi_length} are too long to pack with gene indices')
+        self.barcode_ids = BarcodeIds()
+        self.counter = KeyCounter()
+
+    def add(self, barcodes: np.ndarray, gene_indices: np.ndarray, umis: np.ndarray):
+        if not len(barcodes):
+            return
+        ids = self.barcode_ids.encode(barcodes)
+        if len(self.barcode_ids) > 2 ** self.barcode_id_bits:
+            raise ValueError('Too many distinct barcodes to pack with gene indices and UMIs')
+        self.counter.add(
+            (ids.astype(np.uint64) << np.uint64(self.gene_bits + self.umi_bits))
+            | (gene_indices.astype(np.uint64) << np.uint64(self.umi_bits))
+            | umis
+        )
+
+    def molecule_counts(self, merge_mismatches: bool=False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, pd.Series]:
+        """
+        :return: 4-tuple: packed barcodes and gene indices of each (cell, gene)
+            with any molecules, the number of molecules of each, and totals:
+            reads counted, distinct UMIs, and molecules after merging
+        """
+        keys, read_counts = self.counter.items()
+        if merge_mismatches:
+            labels = merge_umi_mismatches(keys, read_counts, self.umi_length)
+            molecule_keys = keys[labels == np.arange(len(keys))]
+        else:
+            molecule_keys = keys
+        cell_gene_keys, molecules = np.unique(molecule_keys >> np.uint64(self.umi_bits), return_counts=True)
+        barcode_ids = (cell_gene_keys >> np.uint64(self.gene_bits)).astype(np.int64)
+        gene_indices = cell_gene_keys & np.uint64((1 << self.gene_bits) - 1)
+        totals = pd.Series(
+            {
+                'umi_reads': int(read_counts.sum()),
+                'distinct_umis': len(keys),
+                'molecules': len(molecule_keys),
+            }
+        )
+        return self.barcode_ids.decode(barcode_ids), gene_indices, molecules, totals
+
+    @property
+    def nbytes(self) -> int:
+        return self.counter.nbytes + self.barcode_ids.nbytes
+
+class CellCounts(NamedTuple):
+    barcodes: List[str]
+    gene_ids: pd.Index
+    # Read counts (or molecule counts, if UMIs were deduplicated) in CSR
+    # form: cell `i` has counts `counts[indptr[i]:indptr[i + 1]]` for genes
+    # `indices[indptr[i]:indptr[i + 1]]`
+    indptr: np.ndarray
+    indices: np.ndarray
+    counts: np.ndarray
+    # Summary values for each cell, indexed by barcode, with the same
+    # columns as the summary from `map_reads_to_genes`
+    cell_summary: pd.DataFrame
+    # Totals for the whole run
+    run_summary: pd.Series
+
+    def rpkm_values(self, gene_length: pd.Series) -> np.ndarray:
+        """
+        :return: RPKM values corresponding to `counts`, computed as in
+            `summarize_counts` with each cell's total read count
+        """
+        reads_total = np.repeat(
+            self.cell_summary['read_count'].to_numpy(),
+            np.diff(self.indptr),
+        )
+        return (self.counts * 1000000) / (reads_total * gene_length.to_numpy()[self.indices])
+
+def map_sam_file_to_cells(
+        sam_file: BinaryIO,
+        layout: ReadTagLayout,
+        min_reads: int=1,
+        deduplicate_umis: bool=False,
+        merge_mismatches: bool=False,
+        gene_index: Optional[GeneIndex]=None,
+) -> CellCounts:
+    """
+    :param sam_file: SAM file opened in binary mode, or a binary pipe
+    :param layout: Barcode and UMI lengths in read names
+    :param min_reads: Barcodes with fewer reads mapped to genes than this
+        are not reported as cells, e.g. empty droplets
+    :param deduplicate_umis: If True, count molecules (distinct UMIs for
+        each cell and gene) instead of reads
+    :param merge_mismatches: If True, merge UMIs one mismatch away
+        from a UMI with more reads before counting molecules
+    :param gene_index: If omitted, uses `load_gene_index()`
+    """
+    layout.validate()
+    if deduplicate_umis and not layout.umi_length:
+        raise ValueError('UMI length is required to deduplicate UMIs')
+    if merge_mismatches and not deduplicate_umis:
+        raise ValueError('Merging UMI mismatches requires deduplicating UMIs')
+    if gene_index is None:
+        gene_index = load_gene_index()
+    gene_bits = max((gene_index.gene_count - 1).bit_length(), 1)
+    if 2 * layout.barcode_length + gene_bits > 64:
+        raise ValueError(f'Barcodes of length {layout.barcode_length} are too long to pack with gene indices')
+    gene_shift = np.uint64(gene_bits)
+
+    if deduplicate_umis:
+        molecule_counter = MoleculeCounter(gene_index.gene_count, layout.umi_length)
+    cell_gene_counter = KeyCounter()
+    reads_total_counter = KeyCounter()
+    reads_aligned_counter = KeyCounter()
+    reads_mapped_counter = KeyCounter()
+    reads_total = 0
+    reads_without_barcode = 0
+
+    reader = SamChunkReader(sam_file, qname_suffix_length=layout.suffix_length)
+    for chunk in reader:
+        reads_total += chunk.record_count
+        barcodes, umis, valid = layout.parse_suffixes(chunk.qname_suffixes)
+        reads_without_barcode += int((~valid).sum())
+        reads_total_counter.add(barcodes[valid])
+
+        aligned = np.flatnonzero(valid & ((chunk.flags & 0x4) == 0))
+        reads_aligned_counter.add(barcodes[aligned])
+
+        chrom_ids = gene_index.chrom_ids(np.array(reader.reference_names, dtype=str))
+        starts = chunk.positions[aligned]
+        read_indices, gene_indices = gene_index.overlaps(
+            chrom_ids[chunk.reference_ids[aligned]],
+            starts,
+            starts + chunk.lengths[aligned],
+        )
+        read_barcodes = barcodes[aligned[read_indices]]
+        if deduplicate_umis:
+            molecule_counter.add(read_barcodes, gene_indices, umis[aligned[read_indices]])
+        else:
+            cell_gene_counter.add((read_barcodes << gene_shift) | gene_indices.astype(np.uint64))
+        reads_mapped_counter.add(barcodes[aligned[np.unique(read_indices)]])
+
+    all_barcodes, barcode_reads_total = reads_total_counter.items()
+    barcode_reads_mapped = lookup_counts(*reads_mapped_counter.items(), all_barcodes)
+    cell_mask = barcode_reads_mapped >= min_reads
+    cells = all_barcodes[cell_mask]
+
+    if deduplicate_umis:
+        molecule_barcodes, molecule_genes, counts, molecule_totals = molecule_counter.molecule_counts(
+            merge_mismatches,
+        )
+        keys = (molecule_barcodes << gene_shift) | molecule_genes
+        # Barcode IDs aren't in barcode order
+        order = np.argsort(keys)
+        keys = keys[order]
+        counts = counts[order]
+    else:
+        keys, counts = cell_gene_counter.items()
+    key_barcodes = keys >> gene_shift
+    in_cell = lookup_counts(cells, np.ones(len(cells), dtype=np.int64), key_barcodes).astype(bool)
+    key_barcodes = key_barcodes[in_cell]
+    # Keys are sorted, so are grouped by barcode
+    indptr = np.append(np.searchsorted(key_barcodes, cells), len(key_barcodes))
+    indices = (keys[in_cell] & np.uint64((1 << gene_bits) - 1)).astype(np.int32)
+
+    barcode_strings = unpack_sequences(cells, layout.barcode_length)
+    cell_summary = pd.DataFrame(
+        {
+            'read_count': barcode_reads_total[cell_mask],
+            'reads_aligned': lookup_counts(*reads_aligned_counter.items(), cells),
+            'mapped_to_genes': barcode_reads_mapped[cell_mask],
+            'genes_with_reads': np.diff(indptr),
+        },
+        index=barcode_strings,
+    )
+
+    counters = [cell_gene_counter, reads_total_counter, reads_aligned_counter, reads_mapped_counter]
+    if deduplicate_umis:
+        counters.append(molecule_counter)
+        cell_molecules = np.zeros(len(cells), dtype=np.int64)
+        np.add.at(cell_molecules, np.repeat(np.arange(len(cells)), np.diff(indptr)), counts[in_cell])
+        cell_summary['molecules'] = cell_molecules
+    run_summary = pd.Series(
+        {
+            'read_count': reads_total,
+            'reads_without_barcode': reads_without_barcode,
+            'barcodes': len(all_barcodes),
+            'cells': len(cells),
+            'reads_in_cells': int(cell_summary['read_count'].sum()),
+            'count_table_bytes': sum(counter.nbytes for counter in counters),
+        }
+    )
+    if deduplicate_umis:
+        run_summary = pd.concat([run_summary, molecule_totals])
+
+    return CellCounts(
+        barcodes=barcode_strings,
+        gene_ids=gene_index.gene_length_series.index,
+        indptr=indptr,
+        indices=indices,
+        counts=counts[in_cell],
+        cell_summary=cell_summary,
+        run_summary=run_summary,
+    )
+
+def save_cell_counts(cell_counts: CellCounts, output_path: Path):
+    """
+    Saves per-cell RPKM values and raw read counts as sparse matrices (see
+    `sparse_matrix`) in the 'rpkm_sparse' and 'counts_sparse' groups, and
+    per-cell and whole-run summaries as 'alignment_metadata' and
+    'run_summary'.
+    """
+    gene_length = load_gene_index().gene_length_series
+    print('Saving per-cell expression and alignment metadata to', output_path)
+    with pd.HDFStore(output_path, mode='w') as store:
+        store[ALIGNMENT_METADATA_KEY] = cell_counts.cell_summary
+        store[RUN_SUMMARY_KEY] = cell_counts.run_summary
+
+    with tables.open_file(str(output_path), mode='a') as h5_file:
+        matrices = [
+            (SPARSE_RPKM_KEY, cell_counts.rpkm_values(gene_length), np.float64),
+            (SPARSE_COUNTS_KEY, cell_counts.counts, np.int64),
+        ]
+        for key, values, dtype in matrices:
+            writer = SparseMatrixWriter(h5_file, f'/{key}', cell_counts.gene_ids, dtype=dtype)
+            writer.append_rows(cell_counts.barcodes, cell_counts.indptr, cell_counts.indices, values)
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument('sam_path', type=Path, help='Path to SAM file')
+    add_barcode_command_line_arguments(p)
+    add_cell_command_line_arguments(p)
+    p.add_argument('--output-file', type=Path)
+    args = p.parse_args()
+
+    if args.output_file is None:
+        args.output_file = args.sam_path.with_suffix('.hdf5')
+
+    print('Reading', args.sam_path)
+    with open(args.sam_path, 'rb') as f:
+        cell_counts = map_sam_file_to_cells(
+            f,
+            ReadTagLayout(args.barcode_length, args.umi_length),
+            min_reads=args.min_reads,
+            deduplicate_umis=args.deduplicate_umis,
+            merge_mismatches=args.merge_umi_mismatches,
+        )
+    print(cell_counts.run_summary)
+    save_cell_counts(cell_counts, args.output_file)
@@ -2,74 +2,159 @@
 import argparse
 from pathlib import Path
 import pickle
-from typing import Tuple
+from typing import BinaryIO, NamedTuple, Optional, TextIO
 
+import numpy as np
 import pandas as pd
 
 from data_path_utils import find_newest_data_path
 
-def map_reads_to_genes(sam_path: Path) -> Tuple[pd.Series, pd.Series]:
+from gene_index import TREE_PICKLE_FILENAME, GeneIndex, load_gene_index
+from sam_reader import SamChunkReader
+
+def load_tree_data() -> dict:
     tree_path = find_newest_data_path('build_tree')
-    with open(tree_path / 'trees.pickle', 'rb') as f:
-        tree_data = pickle.load(f)
+    with open(tree_path / TREE_PICKLE_FILENAME, 'rb') as f:
+        return pickle.load(f)
+
+class GeneCounts(NamedTuple):
+    rpkm: pd.Series
+    summary: pd.Series
+    # Integer read count of each gene, from which `rpkm` is computed; saved
+    # instead of `rpkm` where RPKM values can be recomputed when reading
+    read_counts: pd.Series
+
+def summarize_counts(
+        read_counts: pd.Series,
+        gene_length: pd.Series,
+        reads_total: int,
+        reads_aligned: int,
+        reads_mapped_to_genes: int,
+) -> GeneCounts:
+    rpkm = (read_counts * 1000000) / (reads_total * gene_length)
+
+    gene_count = (read_counts > 0).sum()
+
+    summary_data = pd.Series(
+        {
+            'read_count': reads_total,
+            'reads_aligned': reads_aligned,
+            'mapped_to_genes': reads_mapped_to_genes,
+            'genes_with_reads': gene_count,
+        }
+    )
 
-        trees = tree_data['trees']
-        gene_length = tree_data['gene_length']
-        intervals_by_gene = tree_data['intervals_by_gene']
+    return GeneCounts(rpkm, summary_data, read_counts)
+
+def map_sam_file_to_genes_interval_tree(
+        sam_file: TextIO,
+        tree_data: Optional[dict]=None,
+) -> GeneCounts:
+    """
+    Reference implementation, querying one IntervalTree per read. Kept to
+    verify that `map_sam_file_to_genes` produces identical results.
+
+    :param tree_data: Contents of a `trees.pickle` file. If omitted, loaded
+        from the newest `build_tree` data directory.
+    """
+    if tree_data is None:
+        tree_data = load_tree_data()
+    trees = tree_data['trees']
+    gene_length = tree_data['gene_length']
+    intervals_by_gene = tree_data['intervals_by_gene']
 
     read_counts = pd.Series(0, index=sorted(intervals_by_gene))
     reads_mapped_to_genes = 0
     reads_aligned = 0
     reads_total = 0
 
-    print('Reading', sam_path)
-    with open(sam_path) as f:
-        # Read each line of the SAM file.
-        for line in f:
-            # Filter out the line that is not a read.
-            if line.startswith('@'):
-                continue
+    # Read each line of the SAM file.
+    for line in sam_file:
+        # Filter out the line that is not a read.
+        if line.startswith('@'):
+            continue
 
-            reads_total += 1
+        reads_total += 1
 
-            col = line.split('\t')
-            flags = int(col[1])
-            if flags & 0x4:
-                # unmapped
-                continue
+        col = line.split('\t')
+        flags = int(col[1])
+        if flags & 0x4:
+            # unmapped
+            continue
 
-            reads_aligned += 1
+        reads_aligned += 1
 
-            chrom = col[2]
-            start = int(col[3])
-            read_length = len(col[9])
-            end = start + read_length
+        chrom = col[2]
+        start = int(col[3])
+        read_length = len(col[9])
+        end = start + read_length
 
-            # Get the gene id at a certain point if there is any.
-            gene_ids = trees[chrom][start:end]
+        # Get the gene id at a certain point if there is any.
+        gene_ids = trees[chrom][start:end]
 
-            # Reads shouldn't map to multiple genes, but it's still better to be
-            # safe with this and not count reads multiple times if this happens
-            if gene_ids:
-                reads_mapped_to_genes += 1
+        # Reads shouldn't map to multiple genes, but it's still better to be
+        # safe with this and not count reads multiple times if this happens
+        if gene_ids:
+            reads_mapped_to_genes += 1
 
-            for gene_id in gene_ids:
-                read_counts.loc[gene_id.data] += 1
+        for gene_id in gene_ids:
+            read_counts.loc[gene_id.data] += 1
 
-    rpkm = (read_counts * 1000000) / (reads_total * gene_length)
+    return summarize_counts(
+        read_counts=read_counts,
+        gene_length=gene_length,
+        reads_total=reads_total,
+        reads_aligned=reads_aligned,
+        reads_mapped_to_genes=reads_mapped_to_genes,
+    )
 
-    gene_count = (read_counts > 0).sum()
+def map_sam_file_to_genes(sam_file: BinaryIO, gene_index: Optional[GeneIndex]=None) -> GeneCounts:
+    """
+    :param sam_file: SAM file opened in binary mode, or any other binary
+        file-like object, e.g. the stdout pipe of a running HISAT2 process.
+        Records are consumed in fixed-size chunks as they are read, so
+        counting can proceed while the aligner is still writing.
+    :param gene_index: If omitted, uses `load_gene_index()`
+    """
+    if gene_index is None:
+        gene_index = load_gene_index()
+    gene_length = gene_index.gene_length_series
+
+    counts = np.zeros(gene_index.gene_count, dtype=np.int64)
+    reads_mapped_to_genes = 0
+    reads_aligned = 0
+    reads_total = 0
 
-    summary_data = pd.Series(
-        {
-            'read_count': reads_total,
-            'reads_aligned': reads_aligned,
-            'mapped_to_genes': reads_mapped_to_genes,
-            'genes_with_reads': gene_count,
-        }
+    reader = SamChunkReader(sam_file)
+    for chunk in reader:
+        reads_total += chunk.record_count
+
+        aligned = (chunk.flags & 0x4) == 0
+        reads_aligned += int(aligned.sum())
+
+        # Chromosome IDs in the gene index, for each reference name seen so far
+        chrom_ids = gene_index.chrom_ids(np.array(reader.reference_names, dtype=str))
+        starts = chunk.positions[aligned]
+        chunk_counts, chunk_mapped = gene_index.count_reads(
+            chrom_ids[chunk.reference_ids[aligned]],
+            starts,
+            starts + chunk.lengths[aligned],
+        )
+        counts += chunk_counts
+        reads_mapped_to_genes += chunk_mapped
+
+    return summarize_counts(
+        read_counts=pd.Series(counts, index=gene_length.index),
+        gene_length=gene_length,
+        reads_total=reads_total,
+        reads_aligned=reads_aligned,
+        reads_mapped_to_genes=reads_mapped_to_genes,
     )
 
-    return rpkm, summary_data
+def map_reads_to_genes(sam_path: Path) -> GeneCounts:
+    print('Reading', sam_path)
+    with open(sam_path, 'rb') as f:
+        return map_sam_file_to_genes(f)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -0,0 +1,164 @@
+"""
+Support for streaming data between processes through named pipes (FIFOs),
+e.g. from fastq-dump into HISAT2, so that intermediate files never need to
+be written to disk.
+
+Processes connected by FIFOs can block forever if one side fails: a writer
+blocks opening a FIFO that no process will read, and a reader blocks opening
+a FIFO that no process will write. `ProducerGroup` supervises the processes
+on both sides and terminates the others as soon as one fails.
+
+Programs like HISAT2 are wrapper scripts which run the actual aligner as a
+child process, so all processes here are started in a new session and
+killed as a process group.
+"""
+import errno
+import os
+from pathlib import Path
+import signal
+from subprocess import CalledProcessError, Popen
+from threading import Thread
+from time import sleep
+from typing import Iterable, List, Optional
+
+import telemetry
+
+# Seconds between checks of process status
+POLL_INTERVAL = 0.2
+
+SHELL_PATH = '/bin/sh'
+
+def create_fifos(directory: Path, filenames: Iterable[str]) -> List[Path]:
+    fifo_paths = []
+    for filename in filenames:
+        fifo_path = directory / filename
+        os.mkfifo(fifo_path)
+        fifo_paths.append(fifo_path)
+    return fifo_paths
+
+def release_fifo(fifo_path: Path) -> bool:
+    """
+    If a process has `fifo_path` open for reading (or is blocked opening
+    it), briefly opens and closes the write end, so that the reader sees
+    end-of-file instead of waiting for a writer that will never come.
+
+    :return: Whether a reader was present
+    """
+    try:
+        fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # No reader yet
+            return False
+        raise
+    os.close(fd)
+    return True
+
+def kill_process_group(process: Popen):
+    """
+    Kills `process` and all of its descendants. `process` must have been
+    started with `start_new_session=True`.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+class ProducerGroup:
+    """
+    Processes that write into FIFOs, which are read by a single consumer
+    process. Call `start` for each producer, `supervise` once the consumer
+    has been started, and `finish` after the consumer has exited.
+    """
+    def __init__(self, fifo_paths: List[Path]):
+        self.fifo_paths = fifo_paths
+        self.processes: List[Popen] = []
+        self.commands: List[List[str]] = []
+        self.watcher: Optional[Thread] = None
+        # Set by the watcher thread if a producer failed while the consumer
+        # was still running, in which case the consumer was killed
+        self.consumer_killed = False
+
+    def start(
+            self,
+            command: List[str],
+            output_path: Optional[Path]=None,
+            name: Optional[str]=None,
+            **popen_kwargs,
+    ) -> Popen:
+        """
+        Starts a producer process. The consumer process passed to
+        `supervise` must also be started with `start_new_session=True`.
+
+        :param output_path: If given, the process's stdout is redirected to
+            this path. The redirection is done by a shell in the new process,
+            since opening a FIFO for writing blocks until it has a reader.
+        :param name: Name of the process in telemetry records; defaults to
+            the file name of `command[0]`
+        """
+        print('Running', ' '.join(str(piece) for piece in command))
+        command = telemetry.instrument(command, name)
+        if output_path is not None:
+            print(f'\t(writing to {output_path})')
+            # "$0" is the output path and "$@" is the original command
+            command = [SHELL_PATH, '-c', 'exec "$@" > "$0"', str(output_path), *command]
+        process = Popen(command, start_new_session=True, **popen_kwargs)
+        self.processes.append(process)
+        self.commands.append(command)
+        return process
+
+    def kill(self):
+        for process in self.processes:
+            kill_process_group(process)
+
+    def supervise(self, consumer: Popen):
+        """
+        Starts a thread that kills `consumer` if any producer fails, and
+        releases any FIFOs left unopened by producers that exited
+        successfully, so the consumer can't block forever.
+        """
+        self.watcher = Thread(target=self._watch, args=(consumer,), daemon=True)
+        self.watcher.start()
+
+    def _watch(self, consumer: Popen):
+        pending = list(self.processes)
+        while pending and consumer.poll() is None:
+            for process in list(pending):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                pending.remove(process)
+                if returncode:
+                    self.consumer_killed = True
+                    kill_process_group(consumer)
+                    return
+            sleep(POLL_INTERVAL)
+
+        unreleased = list(self.fifo_paths)
+        while unreleased and consumer.poll() is None:
+            unreleased = [path for path in unreleased if not release_fifo(path)]
+            sleep(POLL_INTERVAL)
+
+    def finish(self, consumer: Popen, consumer_command: List[str]):
+        """
+        Waits for all producers, killing them first if the consumer failed.
+        Raises `CalledProcessError` for whichever process failed first: a
+        producer if the consumer was killed because of it, and otherwise the
+        consumer, or any producer that failed after the consumer finished.
+        """
+        if consumer.returncode is None or consumer.returncode:
+            self.kill()
+        for process in self.processes:
+            process.wait()
+        if self.watcher is not None:
+            self.watcher.join()
+
+        failed_producers = [
+            (process.returncode, command)
+            for process, command in zip(self.processes, self.commands)
+            if process.returncode
+        ]
+        if consumer.returncode and not self.consumer_killed:
+            raise CalledProcessError(consumer.returncode, consumer_command)
+        if failed_producers:
+            raise CalledProcessError(*failed_producers[0])
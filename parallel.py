@@ -0,0 +1,141 @@
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from telemetry import call_with_telemetry
+from utils import normalize_whitespace
+
+T = TypeVar('T')
+
+# Used to choose a number of concurrent samples if only a core budget is given
+DEFAULT_THREADS_PER_SAMPLE = 4
+
+def add_parallel_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--cores',
+        type=int,
+        help=normalize_whitespace(
+            """
+            Total number of cores to use. Split evenly between concurrent
+            samples, overriding --subprocesses for each run of HISAT2.
+            """
+        ),
+    )
+    p.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        help=normalize_whitespace(
+            f"""
+            Number of samples to process concurrently. Defaults to 1 if --cores
+            is omitted, otherwise one sample per {DEFAULT_THREADS_PER_SAMPLE} cores.
+            With --pipeline, this is the number of concurrent HISAT2 runs.
+            """
+        ),
+    )
+    p.add_argument(
+        '--pipeline',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Run processing stages (SRA conversion, alignment, quantification) in
+            separate threads connected by bounded queues, so that different
+            samples can be in different stages at the same time. Reports the
+            occupancy of each stage at the end. The first sample that fails stops
+            the run, as without --pipeline; samples that finished before are
+            saved and skipped with --resume. Cannot be combined with
+            --stream-alignment.
+            """
+        ),
+    )
+
+def resolve_parallel_arguments(args: Namespace):
+    """
+    Fills in `args.jobs` and `args.subprocesses` from the core budget in
+    `args.cores`, if one was given.
+    """
+    if args.jobs is None:
+        if args.cores is None:
+            args.jobs = 1
+        else:
+            args.jobs = max(args.cores // DEFAULT_THREADS_PER_SAMPLE, 1)
+    if args.cores is not None:
+        args.subprocesses = max(args.cores // args.jobs, 1)
+
+def run_samples(
+        func: Callable[..., T],
+        kwargs_list: List[dict],
+        jobs: int,
+        on_result: Optional[Callable[[int, T], None]]=None,
+        on_telemetry: Optional[Callable[[int, List[Dict[str, Any]]], None]]=None,
+) -> Iterable[T]:
+    """
+    Calls `func(**kwargs)` for each item of `kwargs_list`, running up to
+    `jobs` calls at once in separate processes.
+
+    :param on_result: Called in this process with the position of each
+        sample in `kwargs_list` and its result, as soon as that sample
+        finishes; e.g. to save results incrementally. If a sample fails,
+        samples that are already running are allowed to finish and are
+        passed to `on_result` before the error is raised.
+    :param on_telemetry: If given, telemetry is recorded for each sample
+        (see `telemetry`), and this is called in this process with the
+        position of each successful sample and its records, just before
+        `on_result`
+    :return: Iterable of results, in the same order as `kwargs_list`
+        regardless of the order in which samples finish
+    """
+    def unpack(i: int, value):
+        if on_telemetry is None:
+            return value
+        result, records = value
+        on_telemetry(i, records)
+        return result
+
+    if jobs <= 1:
+        for i, kwargs in enumerate(kwargs_list):
+            if on_telemetry is None:
+                result = func(**kwargs)
+            else:
+                result = unpack(i, call_with_telemetry(func, kwargs))
+            if on_result is not None:
+                on_result(i, result)
+            yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        if on_telemetry is None:
+            futures = [executor.submit(func, **kwargs) for kwargs in kwargs_list]
+        else:
+            futures = [executor.submit(call_with_telemetry, func, kwargs) for kwargs in kwargs_list]
+        if on_result is None:
+            try:
+                for i, future in enumerate(futures):
+                    yield unpack(i, future.result())
+            except BaseException:
+                # Don't start any more samples after a failure
+                for future in futures:
+                    future.cancel()
+                raise
+            return
+
+        positions = {future: i for i, future in enumerate(futures)}
+        results: Dict[int, T] = {}
+        error: Optional[BaseException] = None
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                results[positions[future]] = unpack(positions[future], future.result())
+                on_result(positions[future], results[positions[future]])
+            except BaseException as e:
+                if error is None:
+                    error = e
+                    for pending_future in futures:
+                        pending_future.cancel()
+        if error is not None:
+            raise error
+        for i in range(len(futures)):
+            yield results[i]
+
+del T
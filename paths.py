@@ -6,6 +6,7 @@ from pathlib import Path as _Path
 # to use `Path` objects in overrides though, for things like `Path.expanduser`.
 
 FASTQ_DUMP_PATH = _Path('fastq-dump')
+FASTERQ_DUMP_PATH = _Path('fasterq-dump')
 HISAT2_PATH = _Path('hisat2')
 # Not an actual file on disk; this is the "base" name
 REFERENCE_INDEX_PATH = _Path('~/data/hisat2-indexes/mm10-splice-sites/mm10').expanduser()
@@ -0,0 +1,225 @@
+"""
+Pipelined execution of per-sample processing stages.
+
+Each stage runs in its own worker thread(s), and stages are connected by
+bounded queues. While one sample is being aligned, the next can be
+converted from SRA and the previous one quantified; the bounded queues
+limit how many intermediate files can exist at once.
+"""
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import telemetry
+
+# Seconds between checks for a failure elsewhere in the pipeline, while
+# waiting for space in a full queue
+POLL_INTERVAL = 0.5
+
+class Stage(NamedTuple):
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    # Called on this stage's output if no later stage will consume it, after
+    # a failure elsewhere in the pipeline; e.g. to delete intermediate files
+    discard: Optional[Callable[[Any], None]] = None
+
+class StageStatistics:
+    def __init__(self, stage: Stage):
+        self.stage = stage
+        self.items = 0
+        self.busy_time = 0.0
+        self.lock = Lock()
+
+    def record(self, elapsed: float):
+        with self.lock:
+            self.items += 1
+            self.busy_time += elapsed
+
+# Sentinel passed through the queues after the last item
+_END = object()
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], queue_size: int=1, stop_on_error: bool=True):
+        """
+        :param stages: Processing stages, in order. The first stage is called
+            with each input item, and each later stage with the output of the
+            previous one.
+        :param queue_size: Maximum number of finished items waiting between
+            two stages. When a queue is full, the stage feeding it blocks.
+        :param stop_on_error: If True, the first failure stops the pipeline
+            and is raised by `run`. If False, a failed item is only passed
+            to `on_error` and dropped, and the other items are still
+            processed, as separate runs would be.
+        """
+        if not stages:
+            raise ValueError('No pipeline stages provided')
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stop_on_error = stop_on_error
+        self.statistics = [StageStatistics(stage) for stage in stages]
+        self.wall_time = 0.0
+
+    def run(
+            self,
+            items: Iterable[Any],
+            on_result: Optional[Callable[[int, Any], None]]=None,
+            on_telemetry: Optional[Callable[[int, List[Dict[str, Any]]], None]]=None,
+            on_error: Optional[Callable[[int, BaseException], None]]=None,
+    ) -> List[Any]:
+        """
+        :param on_result: Called from a worker thread with the position of
+            the input item and the output of the last stage, as soon as each
+            item finishes; e.g. to save results incrementally
+        :param on_telemetry: If given, telemetry is recorded while each stage
+            processes each item (see `telemetry`), and this is called from a
+            worker thread with the position of the input item and the records
+            of that stage, whether or not the stage succeeded
+        :param on_error: Called from a worker thread with the position of the
+            input item and the exception, if a stage or `on_result` fails for
+            that item. Items that were still waiting or in progress when the
+            pipeline stopped aren't reported.
+        :return: Outputs of the last stage, in the same order as `items`,
+            with None for items that failed if not `stop_on_error`
+        """
+        # queues[i] feeds stage i
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        results: Dict[int, Any] = {}
+        failed = Event()
+        errors: List[BaseException] = []
+        remaining_workers = [stage.workers for stage in self.stages]
+        remaining_lock = Lock()
+
+        def put(stage_index: int, item) -> bool:
+            """
+            Passes `item` to stage `stage_index`, unless the pipeline fails
+            while waiting for space in the queue.
+            """
+            while not failed.is_set():
+                try:
+                    queues[stage_index].put(item, timeout=POLL_INTERVAL)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def discard(stage_index: int, value):
+            """
+            :param stage_index: Stage that produced `value`; -1 for input items
+            """
+            if stage_index >= 0 and self.stages[stage_index].discard is not None:
+                try:
+                    self.stages[stage_index].discard(value)
+                except Exception as e:
+                    print(f'Error discarding output of stage {self.stages[stage_index].name}: {e!r}')
+
+        def fail(i: int, e: BaseException):
+            # Interrupts stop the pipeline regardless
+            if self.stop_on_error or not isinstance(e, Exception):
+                errors.append(e)
+                failed.set()
+            else:
+                results[i] = None
+            if on_error is not None:
+                try:
+                    on_error(i, e)
+                except Exception as error_handler_error:
+                    print(f'Error reporting failure of item {i}: {error_handler_error!r}')
+
+        def end_stage(stage_index: int):
+            with remaining_lock:
+                remaining_workers[stage_index] -= 1
+                last_worker = not remaining_workers[stage_index]
+            if last_worker and stage_index + 1 < len(self.stages):
+                for _ in range(self.stages[stage_index + 1].workers):
+                    queues[stage_index + 1].put(_END)
+
+        def feed():
+            try:
+                for i, item in enumerate(items):
+                    if not put(0, (i, item)):
+                        break
+            except BaseException as e:
+                errors.append(e)
+                failed.set()
+            finally:
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_END)
+
+        def work(stage_index: int):
+            stage = self.stages[stage_index]
+            statistics = self.statistics[stage_index]
+            last_stage = stage_index + 1 == len(self.stages)
+            while True:
+                entry = queues[stage_index].get()
+                if entry is _END:
+                    break
+                i, value = entry
+                if failed.is_set():
+                    discard(stage_index - 1, value)
+                    continue
+                start = perf_counter()
+                try:
+                    if on_telemetry is None:
+                        output = stage.func(value)
+                    else:
+                        recorder = telemetry.Telemetry()
+                        try:
+                            with telemetry.recording(recorder):
+                                output = stage.func(value)
+                        finally:
+                            on_telemetry(i, recorder.records)
+                except BaseException as e:
+                    fail(i, e)
+                    discard(stage_index - 1, value)
+                    continue
+                finally:
+                    statistics.record(perf_counter() - start)
+                if last_stage:
+                    results[i] = output
+                    if on_result is not None:
+                        try:
+                            on_result(i, output)
+                        except BaseException as e:
+                            fail(i, e)
+                elif not put(stage_index + 1, (i, output)):
+                    discard(stage_index, output)
+            end_stage(stage_index)
+
+        threads = [Thread(target=feed, name='pipeline-feed')]
+        for stage_index, stage in enumerate(self.stages):
+            threads.extend(
+                Thread(target=work, args=(stage_index,), name=f'pipeline-{stage.name}-{j}')
+                for j in range(stage.workers)
+            )
+
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall_time = perf_counter() - start
+
+        self.print_occupancy_report()
+
+        if errors:
+            raise errors[0]
+        return [results[i] for i in sorted(results)]
+
+    def print_occupancy_report(self):
+        """
+        Prints, for each stage, the fraction of the total wall time that
+        its workers spent processing items rather than waiting.
+        """
+        print(f'Pipeline stage occupancy ({self.wall_time:.1f}s wall time):')
+        name_width = max(len(stage.name) for stage in self.stages)
+        for statistics in self.statistics:
+            stage = statistics.stage
+            capacity = self.wall_time * stage.workers
+            occupancy = statistics.busy_time / capacity if capacity else 0.0
+            print(
+                f'\t{stage.name:<{name_width}}  {statistics.items} items, '
+                f'{statistics.busy_time:.1f}s busy, {stage.workers} worker(s), '
+                f'{occupancy:.1%} occupancy'
+            )
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Quantifies expression per cell for a pooled, barcoded single-cell run:
+
+1. Align all reads with one run of HISAT2, with each read's cell barcode
+   (and UMI) carried in its name
+2. Map reads to genes, and count reads per cell and gene as HISAT2 output
+   is read, without writing a SAM file
+3. Save per-cell read counts, RPKM and summary data
+
+Barcodes are either already at the end of each read name (see `barcodes`),
+or are read from a separate barcode read with --barcode-read, in which case
+they are added to read names as reads are passed to HISAT2.
+"""
+from argparse import ArgumentParser
+from functools import partial
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+from typing import List, Optional
+
+from alignment import build_hisat2_command, decompressed_fastq, is_compressed, stream_alignment_compute_expr
+from barcodes import ReadTagLayout, add_barcode_command_line_arguments, start_barcode_tagging_fifo
+from compression import fastq_base_name
+from map_reads_to_cells import CellCounts, add_cell_command_line_arguments, map_sam_file_to_cells, save_cell_counts
+from named_pipes import ProducerGroup
+from utils import add_common_command_line_arguments, normalize_whitespace
+
+def align_fastq_compute_cell_counts(
+        fastq_paths: List[Path],
+        layout: ReadTagLayout,
+        subprocesses: int,
+        min_reads: int=1,
+        deduplicate_umis: bool=False,
+        merge_umi_mismatches: bool=False,
+        barcode_read_path: Optional[Path]=None,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        producers: Optional[ProducerGroup]=None,
+) -> CellCounts:
+    """
+    :param fastq_paths: One or two FASTQ files, optionally compressed
+    :param barcode_read_path: FASTQ file with barcode and UMI at the start
+        of each read, in the same order as `fastq_paths`. If None, barcodes
+        and UMIs must already be in read names.
+    :param producers: Processes writing FASTQ data into `fastq_paths`, if
+        these are named pipes
+    """
+    layout.validate()
+    if producers is None and barcode_read_path is not None:
+        if len(fastq_paths) != 1:
+            raise ValueError('Barcode reads can only be combined with single-end cDNA reads')
+        with TemporaryDirectory(prefix='fastq_fifo_', dir=fastq_paths[0].parent) as fifo_dir:
+            fifo_paths, producers = start_barcode_tagging_fifo(
+                barcode_read_path,
+                fastq_paths[0],
+                Path(fifo_dir),
+                layout,
+                threads=subprocesses,
+            )
+            try:
+                return align_fastq_compute_cell_counts(
+                    fastq_paths=fifo_paths,
+                    layout=layout,
+                    subprocesses=subprocesses,
+                    min_reads=min_reads,
+                    deduplicate_umis=deduplicate_umis,
+                    merge_umi_mismatches=merge_umi_mismatches,
+                    hisat2_options=hisat2_options,
+                    reference_path=reference_path,
+                    producers=producers,
+                )
+            except BaseException:
+                producers.kill()
+                raise
+
+    if producers is None and is_compressed(fastq_paths):
+        with decompressed_fastq(fastq_paths, subprocesses) as (fifo_paths, producers):
+            return align_fastq_compute_cell_counts(
+                fastq_paths=fifo_paths,
+                layout=layout,
+                subprocesses=subprocesses,
+                min_reads=min_reads,
+                deduplicate_umis=deduplicate_umis,
+                merge_umi_mismatches=merge_umi_mismatches,
+                hisat2_options=hisat2_options,
+                reference_path=reference_path,
+                producers=producers,
+            )
+
+    hisat_command = build_hisat2_command(
+        fastq_paths=fastq_paths,
+        subprocesses=subprocesses,
+        sam_path=None,
+        hisat2_options=hisat2_options,
+        reference_path=reference_path,
+    )
+    return stream_alignment_compute_expr(
+        hisat_command,
+        producers,
+        quantify=partial(
+            map_sam_file_to_cells,
+            layout=layout,
+            min_reads=min_reads,
+            deduplicate_umis=deduplicate_umis,
+            merge_mismatches=merge_umi_mismatches,
+        ),
+    )
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument(
+        'fastq_file',
+        type=Path,
+        nargs='+',
+        help=normalize_whitespace(
+            """
+            One or two paths to FASTQ files with cDNA reads, optionally compressed
+            with gzip or bzip2
+            """
+        ),
+    )
+    p.add_argument(
+        '--barcode-read',
+        type=Path,
+        help=normalize_whitespace(
+            """
+            FASTQ file whose reads start with the cell barcode, followed by the
+            UMI, e.g. read 1 of a 10x Genomics library. If omitted, barcodes and
+            UMIs must be at the end of cDNA read names.
+            """
+        ),
+    )
+    add_barcode_command_line_arguments(p)
+    add_cell_command_line_arguments(p)
+    add_common_command_line_arguments(
+        p,
+        output_file_help=normalize_whitespace(
+            """
+            Output HDF5 file for per-cell expression and alignment metadata. If
+            omitted, saved as '<name>_cells.hdf5' next to the first FASTQ file.
+            """
+        ),
+    )
+    args = p.parse_args()
+
+    if len(args.fastq_file) not in {1, 2}:
+        message = 'One or two FASTQ files must be specified, for single- or paired-end alignment.'
+        sys.exit(message)
+
+    cell_counts = align_fastq_compute_cell_counts(
+        fastq_paths=args.fastq_file,
+        layout=ReadTagLayout(args.barcode_length, args.umi_length),
+        subprocesses=args.subprocesses,
+        min_reads=args.min_reads,
+        deduplicate_umis=args.deduplicate_umis,
+        merge_umi_mismatches=args.merge_umi_mismatches,
+        barcode_read_path=args.barcode_read,
+        hisat2_options=args.hisat2_options,
+        reference_path=args.reference_path,
+    )
+    print('Run summary:')
+    print(cell_counts.run_summary.to_string())
+
+    if args.output_file is None:
+        fastq_path = args.fastq_file[0]
+        args.output_file = fastq_path.parent / f'{fastq_base_name(fastq_path)}_cells.hdf5'
+
+    save_cell_counts(cell_counts, args.output_file)
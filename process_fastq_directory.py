@@ -11,15 +11,24 @@ from argparse import ArgumentParser
 from collections import defaultdict
 from pathlib import Path
 from pprint import pprint
-from typing import Dict, List
+from typing import Any, Dict, List
 
-import pandas as pd
-
-from alignment import align_fastq_compute_expr
+from alignment import align_fastq_compute_expr, alignment_stages
+from compression import fastq_base_name, fastq_glob_patterns
+from count_cache import add_count_cache_command_line_arguments, configure_count_cache, run_pipeline
+from expression_store import ExpressionStore, add_output_command_line_arguments
+from fastq_batches import add_batch_command_line_argument, align_fastq_batch_compute_expr, split_into_batches
+from map_reads_to_genes import GeneCounts
+from parallel import (
+    add_parallel_command_line_arguments,
+    resolve_parallel_arguments,
+    run_samples,
+)
+from pipeline import Pipeline
+from scratch import add_scratch_command_line_arguments, configure_scratch
+from telemetry import RunReport, add_telemetry_command_line_argument, report_path, report_stage
 from utils import add_common_command_line_arguments, normalize_whitespace
 
-FASTQ_PATTERN = '*.fastq'
-
 def group_fastq_files(directory: Path) -> List[List[Path]]:
     """
     :param directory:
@@ -27,14 +36,24 @@ def group_fastq_files(directory: Path) -> List[List[Path]]:
     """
     fastq_groups: Dict[str, List[Path]] = defaultdict(list)
 
-    for fastq_path in directory.glob(FASTQ_PATTERN):
-        filename_pieces = fastq_path.stem.rsplit('_', 1)
+    fastq_paths = [
+        fastq_path
+        for pattern in fastq_glob_patterns()
+        for fastq_path in directory.glob(pattern)
+    ]
+    for fastq_path in fastq_paths:
+        base_name = fastq_base_name(fastq_path)
+        filename_pieces = base_name.rsplit('_', 1)
         if len(filename_pieces) == 2 and filename_pieces[1] in {'1', '2'}:
             key = filename_pieces[0]
         else:
-            key = fastq_path.stem
+            key = base_name
         fastq_groups[key].append(fastq_path)
 
+    # Glob order isn't guaranteed to put '_1' before '_2'
+    for fastq_group in fastq_groups.values():
+        fastq_group.sort(key=fastq_base_name)
+
     return list(fastq_groups.values())
 
 if __name__ == '__main__':
@@ -49,35 +68,127 @@ if __name__ == '__main__':
             these two files will be aligned in paired-end mode. FASTQ files will
             be aligned in single-end mode if 1) they do not match the pattern
             "*_{1,2}.fastq", or 2) one of the expected "paired" files is missing.
+            Files may also use the '.fq' extension, and may be compressed with
+            gzip ('.gz') or bzip2 ('.bz2'), e.g. 'sample_1.fq.gz'.
             """
         )
     )
     add_common_command_line_arguments(p)
+    add_parallel_command_line_arguments(p)
+    add_output_command_line_arguments(p)
+    add_batch_command_line_argument(p)
+    add_scratch_command_line_arguments(p)
+    add_count_cache_command_line_arguments(p)
+    add_telemetry_command_line_argument(p)
     args = p.parse_args()
+    configure_scratch(args)
+    configure_count_cache(args)
+    resolve_parallel_arguments(args)
+    if args.batch_size < 1:
+        p.error('--batch-size must be positive')
+    if args.pipeline and args.batch_size > 1:
+        p.error('--pipeline and --batch-size can not be combined')
+    if args.pipeline and args.stream_alignment:
+        p.error('--stream-alignment cannot be combined with --pipeline, which writes SAM files between stages')
 
-    all_rpkm = []
-    all_alignment_metadata = []
+    if args.output_file is None:
+        args.output_file = args.fastq_directory / 'expr.hdf5'
 
-    for fastq_group in group_fastq_files(args.fastq_directory):
-        rpkm, alignment_metadata = align_fastq_compute_expr(
-            fastq_paths=fastq_group,
-            subprocesses=args.subprocesses,
-            hisat2_options=args.hisat2_options,
-            reference_path=args.reference_path
-        )
-        all_rpkm.append(rpkm)
-        all_alignment_metadata.append(alignment_metadata)
+    fastq_groups = group_fastq_files(args.fastq_directory)
+    sample_names = [','.join(fastq_path.name for fastq_path in fastq_group) for fastq_group in fastq_groups]
+    report = RunReport(report_path(args.output_file)) if args.telemetry else None
 
-        print(f'Alignment metadata for {fastq_group}:')
-        pprint(alignment_metadata)
+    with ExpressionStore(args.output_file, resume=args.resume, sparse=args.sparse_output) as store:
+        pending = [i for i, sample_name in enumerate(sample_names) if not store.completed(sample_name)]
+        if len(pending) < len(sample_names):
+            print(f'Skipping {len(sample_names) - len(pending)} samples saved by an earlier run')
+        pending_groups = [fastq_groups[i] for i in pending]
 
-    rpkm = pd.DataFrame(all_rpkm)
-    alignment_metadata = pd.DataFrame(all_alignment_metadata)
+        def save_result(i: int, result: GeneCounts):
+            rpkm, alignment_metadata, _ = result
+            with report_stage(report, sample_names[pending[i]], 'save'):
+                store.save_sample(sample_names[pending[i]], rpkm, alignment_metadata)
 
-    if args.output_file is None:
-        args.output_file = args.fastq_directory / 'expr.hdf5'
+        def add_telemetry(i: int, records: List[Dict[str, Any]]):
+            report.add(sample_names[pending[i]], records)
+
+        on_telemetry = add_telemetry if report is not None else None
+
+        if args.pipeline:
+            stages = alignment_stages(
+                subprocesses=args.subprocesses,
+                hisat2_options=args.hisat2_options,
+                reference_path=args.reference_path,
+                align_workers=args.jobs,
+            )
+            results = run_pipeline(
+                Pipeline(stages),
+                pending_groups,
+                inputs=lambda cache, fastq_group: cache.file_input(fastq_group),
+                hisat2_options=args.hisat2_options,
+                reference_path=args.reference_path,
+                on_result=save_result,
+                on_telemetry=on_telemetry,
+            )
+        elif args.batch_size > 1:
+            batches = split_into_batches(pending_groups, args.batch_size)
+            batch_kwargs = [
+                {
+                    'fastq_groups': [pending_groups[i] for i in batch],
+                    'subprocesses': args.subprocesses,
+                    'hisat2_options': args.hisat2_options,
+                    'reference_path': args.reference_path,
+                    'stream_alignment': args.stream_alignment,
+                }
+                for batch in batches
+            ]
+
+            def save_batch_results(batch_index: int, batch_results: List[GeneCounts]):
+                for i, result in zip(batches[batch_index], batch_results):
+                    save_result(i, result)
+
+            def add_batch_telemetry(batch_index: int, records: List[Dict[str, Any]]):
+                # Recorded once for the whole batch, which is aligned by one
+                # run of HISAT2
+                batch_name = ';'.join(sample_names[pending[i]] for i in batches[batch_index])
+                report.add(batch_name, records)
+
+            results_by_group = {}
+            batch_results = run_samples(
+                align_fastq_batch_compute_expr,
+                batch_kwargs,
+                args.jobs,
+                on_result=save_batch_results,
+                on_telemetry=add_batch_telemetry if report is not None else None,
+            )
+            for batch, batch_result in zip(batches, batch_results):
+                results_by_group.update(zip(batch, batch_result))
+            results = [results_by_group[i] for i in range(len(pending_groups))]
+        else:
+            sample_kwargs = [
+                {
+                    'fastq_paths': fastq_group,
+                    'subprocesses': args.subprocesses,
+                    'hisat2_options': args.hisat2_options,
+                    'reference_path': args.reference_path,
+                    'stream_alignment': args.stream_alignment,
+                }
+                for fastq_group in pending_groups
+            ]
+            results = run_samples(
+                align_fastq_compute_expr,
+                sample_kwargs,
+                args.jobs,
+                on_result=save_result,
+                on_telemetry=on_telemetry,
+            )
+
+        for fastq_group, (rpkm, alignment_metadata, _) in zip(pending_groups, results):
+            print(f'Alignment metadata for {fastq_group}:')
+            pprint(alignment_metadata)
+
+        store.finalize(sample_names)
 
-    print('Saving expression and alignment metadata to', args.output_file)
-    with pd.HDFStore(args.output_file) as store:
-        store['rpkm'] = pd.DataFrame(rpkm)
-        store['alignment_metadata'] = pd.DataFrame(alignment_metadata)
+    if report is not None:
+        report.save()
+        print('Saved telemetry to', report.path)
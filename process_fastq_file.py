@@ -15,6 +15,10 @@ import sys
 import pandas as pd
 
 from alignment import align_fastq_compute_expr
+from compression import fastq_base_name
+from count_cache import add_count_cache_command_line_arguments, configure_count_cache
+from scratch import add_scratch_command_line_arguments, configure_scratch
+from telemetry import RunReport, add_telemetry_command_line_argument, call_with_telemetry, report_path, report_stage
 from utils import add_common_command_line_arguments
 
 if __name__ == '__main__':
@@ -23,28 +27,48 @@ if __name__ == '__main__':
         'fastq_file',
         type=Path,
         nargs='+',
-        help='One or two paths to FASTQ files'
+        help='One or two paths to FASTQ files, optionally compressed with gzip or bzip2'
     )
     add_common_command_line_arguments(p)
+    add_scratch_command_line_arguments(p)
+    add_count_cache_command_line_arguments(p)
+    add_telemetry_command_line_argument(p)
     args = p.parse_args()
+    configure_scratch(args)
+    configure_count_cache(args)
 
     if len(args.fastq_file) not in {1, 2}:
         message = 'One or two FASTQ files must be specified, for single- or paired-end alignment.'
         sys.exit(message)
 
-    rpkm, alignment_metadata = align_fastq_compute_expr(
-        fastq_paths=args.fastq_file,
-        subprocesses=args.subprocesses,
-        hisat2_options=args.hisat2_options,
-        reference_path=args.reference_path
-    )
+    kwargs = {
+        'fastq_paths': args.fastq_file,
+        'subprocesses': args.subprocesses,
+        'hisat2_options': args.hisat2_options,
+        'reference_path': args.reference_path,
+        'stream_alignment': args.stream_alignment,
+    }
+    if args.telemetry:
+        (rpkm, alignment_metadata, _), records = call_with_telemetry(align_fastq_compute_expr, kwargs)
+    else:
+        rpkm, alignment_metadata, _ = align_fastq_compute_expr(**kwargs)
     print('Alignment metadata:')
     pprint(alignment_metadata)
 
     if args.output_file is None:
-        args.output_file = args.fastq_file[0].with_suffix('.hdf5')
+        fastq_path = args.fastq_file[0]
+        args.output_file = fastq_path.parent / f'{fastq_base_name(fastq_path)}.hdf5'
+
+    report = None
+    sample_name = ','.join(fastq_path.name for fastq_path in args.fastq_file)
+    if args.telemetry:
+        report = RunReport(report_path(args.output_file))
+        report.add(sample_name, records)
 
     print('Saving expression and alignment metadata to', args.output_file)
-    with pd.HDFStore(args.output_file) as store:
-        store['rpkm'] = pd.DataFrame(rpkm)
-        store['alignment_metadata'] = pd.DataFrame(alignment_metadata)
+    with report_stage(report, sample_name, 'save'):
+        with pd.HDFStore(args.output_file) as store:
+            store['rpkm'] = pd.DataFrame(rpkm)
+            store['alignment_metadata'] = pd.DataFrame(alignment_metadata)
+    if report is not None:
+        print('Saved telemetry to', report.path)
@@ -10,11 +10,22 @@ This file performs multiple runs of the following:
 """
 from argparse import ArgumentParser
 from pathlib import Path
+from typing import Any, Dict, List
 
-import pandas as pd
-
-from alignment import process_sra_file
-from utils import add_common_command_line_arguments
+from alignment import alignment_stages, process_sra_file, sra_conversion_stage
+from count_cache import add_count_cache_command_line_arguments, configure_count_cache, run_pipeline
+from expression_store import ExpressionStore, add_output_command_line_arguments
+from map_reads_to_genes import GeneCounts
+from parallel import (
+    add_parallel_command_line_arguments,
+    resolve_parallel_arguments,
+    run_samples,
+)
+from pipeline import Pipeline
+from scratch import add_scratch_command_line_arguments, configure_scratch
+from sra_conversion import active_converter, add_sra_conversion_command_line_arguments, configure_sra_conversion
+from telemetry import RunReport, add_telemetry_command_line_argument, report_path, report_stage
+from utils import add_common_command_line_arguments, add_sra_command_line_arguments
 
 SRA_PATTERN = '*.sra'
 
@@ -26,28 +37,93 @@ if __name__ == '__main__':
         help='Directory containing SRA files',
     )
     add_common_command_line_arguments(p)
+    add_sra_command_line_arguments(p)
+    add_sra_conversion_command_line_arguments(p)
+    add_parallel_command_line_arguments(p)
+    add_output_command_line_arguments(p)
+    add_scratch_command_line_arguments(p)
+    add_count_cache_command_line_arguments(p)
+    add_telemetry_command_line_argument(p)
     args = p.parse_args()
+    configure_scratch(args)
+    configure_count_cache(args)
 
-    all_rpkm = []
-    all_alignment_metadata = []
-
-    for sra_file in args.sra_directory.glob(SRA_PATTERN):
-        rpkm, alignment_metadata = process_sra_file(
-            sra_path=sra_file,
-            subprocesses=args.subprocesses,
-            hisat2_options=args.hisat2_options,
-            reference_path=args.reference_path
-        )
-        all_rpkm.append(rpkm)
-        all_alignment_metadata.append(alignment_metadata)
-
-    rpkm = pd.DataFrame(all_rpkm)
-    alignment_metadata = pd.DataFrame(all_alignment_metadata)
+    if args.pipeline and args.fastq_fifo:
+        p.error('--fastq-fifo cannot be combined with --pipeline, which converts SRA files in a separate stage')
+    if args.pipeline and args.stream_alignment:
+        p.error('--stream-alignment cannot be combined with --pipeline, which writes SAM files between stages')
+    resolve_parallel_arguments(args)
+    configure_sra_conversion(args)
 
     if args.output_file is None:
         args.output_file = args.sra_directory / 'expr.hdf5'
 
-    print('Saving expression and alignment metadata to', args.output_file)
-    with pd.HDFStore(args.output_file) as store:
-        store['rpkm'] = pd.DataFrame(rpkm)
-        store['alignment_metadata'] = pd.DataFrame(alignment_metadata)
+    sra_files = list(args.sra_directory.glob(SRA_PATTERN))
+    sample_names = [sra_file.name for sra_file in sra_files]
+    report = RunReport(report_path(args.output_file)) if args.telemetry else None
+
+    with ExpressionStore(args.output_file, resume=args.resume, sparse=args.sparse_output) as store:
+        pending = [i for i, sample_name in enumerate(sample_names) if not store.completed(sample_name)]
+        if len(pending) < len(sample_names):
+            print(f'Skipping {len(sample_names) - len(pending)} samples saved by an earlier run')
+        pending_files = [sra_files[i] for i in pending]
+
+        def save_result(i: int, result: GeneCounts):
+            rpkm, alignment_metadata, _ = result
+            with report_stage(report, sample_names[pending[i]], 'save'):
+                store.save_sample(sample_names[pending[i]], rpkm, alignment_metadata)
+
+        def add_telemetry(i: int, records: List[Dict[str, Any]]):
+            report.add(sample_names[pending[i]], records)
+
+        on_telemetry = add_telemetry if report is not None else None
+
+        if args.pipeline:
+            stages = [sra_conversion_stage()]
+            stages.extend(
+                alignment_stages(
+                    subprocesses=args.subprocesses,
+                    hisat2_options=args.hisat2_options,
+                    reference_path=args.reference_path,
+                    align_workers=args.jobs,
+                    remove_fastq=True,
+                )
+            )
+            run_pipeline(
+                Pipeline(stages),
+                pending_files,
+                inputs=lambda cache, sra_file: cache.file_input([sra_file]),
+                hisat2_options=args.hisat2_options,
+                reference_path=args.reference_path,
+                converter=active_converter(),
+                on_result=save_result,
+                on_telemetry=on_telemetry,
+            )
+        else:
+            sample_kwargs = [
+                {
+                    'sra_path': sra_file,
+                    'subprocesses': args.subprocesses,
+                    'hisat2_options': args.hisat2_options,
+                    'reference_path': args.reference_path,
+                    'stream_alignment': args.stream_alignment,
+                    'fastq_fifo': args.fastq_fifo,
+                }
+                for sra_file in pending_files
+            ]
+            # Results are saved by save_result as each sample finishes
+            sample_results = run_samples(
+                process_sra_file,
+                sample_kwargs,
+                args.jobs,
+                on_result=save_result,
+                on_telemetry=on_telemetry,
+            )
+            for _ in sample_results:
+                pass
+
+        store.finalize(sample_names)
+
+    if report is not None:
+        report.save()
+        print('Saved telemetry to', report.path)
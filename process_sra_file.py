@@ -16,25 +16,51 @@ from data_path_utils import append_to_filename
 import pandas as pd
 
 from alignment import process_sra_file
-from utils import add_common_command_line_arguments
+from count_cache import add_count_cache_command_line_arguments, configure_count_cache
+from scratch import add_scratch_command_line_arguments, configure_scratch
+from sra_conversion import add_sra_conversion_command_line_arguments, configure_sra_conversion
+from telemetry import RunReport, add_telemetry_command_line_argument, call_with_telemetry, report_path, report_stage
+from utils import add_common_command_line_arguments, add_sra_command_line_arguments
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter)
     p.add_argument('sra_path', type=Path, help='Path to SRA file')
     add_common_command_line_arguments(p)
+    add_sra_command_line_arguments(p)
+    add_sra_conversion_command_line_arguments(p)
+    add_scratch_command_line_arguments(p)
+    add_count_cache_command_line_arguments(p)
+    add_telemetry_command_line_argument(p)
     args = p.parse_args()
+    configure_scratch(args)
+    configure_count_cache(args)
+    configure_sra_conversion(args)
 
-    rpkm, alignment_metadata = process_sra_file(
-        sra_path=args.sra_path,
-        subprocesses=args.subprocesses,
-        hisat2_options=args.hisat2_options,
-        reference_path=args.reference_path,
-    )
+    kwargs = {
+        'sra_path': args.sra_path,
+        'subprocesses': args.subprocesses,
+        'hisat2_options': args.hisat2_options,
+        'reference_path': args.reference_path,
+        'stream_alignment': args.stream_alignment,
+        'fastq_fifo': args.fastq_fifo,
+    }
+    if args.telemetry:
+        (rpkm, alignment_metadata, _), records = call_with_telemetry(process_sra_file, kwargs)
+    else:
+        rpkm, alignment_metadata, _ = process_sra_file(**kwargs)
     print('Alignment metadata:')
     pprint(alignment_metadata)
 
     rpkm_path = append_to_filename(args.sra_path.with_suffix('.hdf5'), '_rpkm')
+    report = None
+    if args.telemetry:
+        report = RunReport(report_path(rpkm_path))
+        report.add(args.sra_path.stem, records)
+
     print('Saving RPKM to', rpkm_path)
-    with pd.HDFStore(rpkm_path) as store:
-        store['rpkm'] = pd.DataFrame({args.sra_path.stem: rpkm})
-        store['alignment_metadata'] = pd.DataFrame({args.sra_path.stem: alignment_metadata})
+    with report_stage(report, args.sra_path.stem, 'save'):
+        with pd.HDFStore(rpkm_path) as store:
+            store['rpkm'] = pd.DataFrame({args.sra_path.stem: rpkm})
+            store['alignment_metadata'] = pd.DataFrame({args.sra_path.stem: alignment_metadata})
+    if report is not None:
+        print('Saved telemetry to', report.path)
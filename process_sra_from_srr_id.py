@@ -12,62 +12,97 @@ This file performs a single run of the following:
 
 from argparse import ArgumentParser
 from pathlib import Path
-from subprocess import check_call
-from typing import Optional
+from typing import Callable, Optional, Tuple
 
 from alignment import process_sra_file
-from ncbi_sra_toolkit_config import get_ncbi_download_path
-from utils import add_common_command_line_arguments
-
+import count_cache
+from map_reads_to_genes import GeneCounts
 from paths import OUTPUT_PATH
-
-def download_sra(srr_id: str) -> Path:
-    command = ['prefetch', srr_id]
-    print('Running', ' '.join(command))
-    check_call(command)
-
-    ncbi_download_path = get_ncbi_download_path()
-    downloaded_path = ncbi_download_path / 'sra' / f'{srr_id}.sra'
-    if not downloaded_path.is_file():
-        raise EnvironmentError(f'Download of {srr_id} seemed to succeed, but no file {downloaded_path} exists')
-
-    return downloaded_path
+from sample_output import add_output_format_command_line_argument, save_sample_output
+from scratch import add_scratch_command_line_arguments, configure_scratch
+from sra_conversion import active_converter, add_sra_conversion_command_line_arguments, configure_sra_conversion
+from sra_download import SraDownloader, add_download_command_line_arguments
+import telemetry
+from utils import add_common_command_line_arguments, add_sra_command_line_arguments
 
 def process_sra_from_srr_id(
         srr_id: str,
         subprocesses: int,
         hisat2_options: Optional[str]=None,
         reference_path: Optional[Path]=None,
-):
-    local_path = download_sra(srr_id)
+        stream_alignment: bool=False,
+        fastq_fifo: bool=False,
+        download: Optional[Callable[[str], Path]]=None,
+        check_cache: bool=True,
+        cached: Optional[GeneCounts]=None,
+) -> Tuple[GeneCounts, Optional[int]]:
+    """
+    :param download: Called with `srr_id` to download its SRA file; by
+        default `SraDownloader().download`. Not called if the result is in
+        the count cache; see `count_cache`.
+    :param check_cache: Whether to look up `srr_id` in the count cache
+        before downloading it. False if the caller already did, e.g. to
+        decide what to download ahead of time, and passes any result as
+        `cached`. The result is stored in the cache either way.
+    :param cached: Result of `srr_id` already read from the count cache
+    :return: 2-tuple: result, and size of the SRA file in bytes, or None if
+        the result was cached
+    """
+    if cached is None and check_cache:
+        cached = count_cache.get_srr(srr_id, active_converter(fastq_fifo), hisat2_options, reference_path)
+    if cached is not None:
+        return cached, None
+
+    if download is None:
+        download = SraDownloader().download
+    local_path = download(srr_id)
+    input_bytes = local_path.stat().st_size
     try:
-        rpkm, summary = process_sra_file(
+        result = process_sra_file(
             sra_path=local_path,
             subprocesses=subprocesses,
             hisat2_options=hisat2_options,
             reference_path=reference_path,
+            stream_alignment=stream_alignment,
+            fastq_fifo=fastq_fifo,
+            srr_id=srr_id,
         )
     finally:
         local_path.unlink()
-    return rpkm, summary
+    return result, input_bytes
 
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('srr_id')
     add_common_command_line_arguments(p)
+    add_sra_command_line_arguments(p)
+    add_sra_conversion_command_line_arguments(p)
+    add_output_format_command_line_argument(p)
+    add_scratch_command_line_arguments(p)
+    count_cache.add_count_cache_command_line_arguments(p)
+    add_download_command_line_arguments(p, lookahead=False)
+    telemetry.add_telemetry_command_line_argument(p)
     args = p.parse_args()
+    configure_scratch(args)
+    count_cache.configure_count_cache(args)
+    configure_sra_conversion(args)
 
-    rpkm, summary = process_sra_from_srr_id(
-        srr_id=args.srr_id,
-        subprocesses=args.subprocesses,
-        hisat2_options=args.hisat2_options,
-        reference_path=args.reference_path,
-    )
-
-    filename = f'{args.SRR_ID}.csv'
-
-    rpkm_dir = OUTPUT_PATH / 'rpkm'
-    summary_dir = OUTPUT_PATH / 'summary'
+    kwargs = {
+        'srr_id': args.srr_id,
+        'subprocesses': args.subprocesses,
+        'hisat2_options': args.hisat2_options,
+        'reference_path': args.reference_path,
+        'stream_alignment': args.stream_alignment,
+        'fastq_fifo': args.fastq_fifo,
+        'download': SraDownloader.from_args(args).download,
+    }
+    report = None
+    if args.telemetry:
+        (result, _), records = telemetry.call_with_telemetry(process_sra_from_srr_id, kwargs)
+        report = telemetry.RunReport(telemetry.sample_report_path(OUTPUT_PATH, args.srr_id))
+        report.add(args.srr_id, records)
+    else:
+        result, _ = process_sra_from_srr_id(**kwargs)
 
-    rpkm.to_csv(rpkm_dir / filename)
-    summary.to_csv(summary_dir / filename)
+    with telemetry.report_stage(report, args.srr_id, 'save'):
+        save_sample_output(args.srr_id, result.rpkm, result.summary, result.read_counts, args.output_format)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """
-This file performs a single run of the following:
+For each SRR ID assigned to this SLURM array task, this file performs the
+following, in one process:
 
 1. Download a .sra file using the NCBI SRA prefetch program
 2. Convert to FASTQ format
@@ -8,84 +9,415 @@ This file performs a single run of the following:
 4. Map reads to genes
 5. Convert counts to RPKM
 6. Save RPKM and summary data to the `data` directory
+
+Each line of the SRR list file holds the SRR IDs of one array task; see
+`cluster_scheduling`, which can pack several SRR IDs into each task.
 """
 
 from argparse import ArgumentParser
+from contextlib import ExitStack
 import os
 from pathlib import Path
-from subprocess import check_call
-from typing import Optional
+import sqlite3
+import sys
+from time import perf_counter
+import traceback
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
 
-from alignment import process_sra_file
-from ncbi_sra_toolkit_config import get_ncbi_download_path
+from alignment import alignment_stages, remove_files, sra_conversion_stage
+import count_cache
+from map_reads_to_genes import GeneCounts
 from paths import OUTPUT_PATH
-from utils import add_common_command_line_arguments
+from pipeline import Pipeline, Stage
+from process_sra_from_srr_id import process_sra_from_srr_id
+from run_history import RunHistory, add_history_command_line_argument, lifetime_peak_memory, peak_memory
+from run_state import ALIGNING, DONE, DOWNLOADING, FAILED, RunState, add_state_command_line_argument
+from sample_output import add_output_format_command_line_argument, save_sample_output
+from scratch import add_scratch_command_line_arguments, configure_scratch
+from sra_conversion import active_converter, add_sra_conversion_command_line_arguments, configure_sra_conversion
+from sra_download import GIGABYTE, Prefetcher, SraDownloader, add_download_command_line_arguments
+import telemetry
+from utils import (
+    add_common_command_line_arguments,
+    add_sra_command_line_arguments,
+    normalize_whitespace,
+)
 
-def download_sra(srr_id: str) -> Path:
-    command = [
-        'prefetch',
-        srr_id,
-    ]
-    print('Running', ' '.join(command))
-    check_call(command)
+def read_cached_results(
+        srr_ids: List[str],
+        converter: str,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+) -> Optional[Dict[str, GeneCounts]]:
+    """
+    :return: Results of each of `srr_ids` in the configured count cache, or
+        None if there is no cache
+    """
+    if count_cache.current() is None:
+        return None
+    cached_results = {}
+    for srr_id in srr_ids:
+        result = count_cache.get_srr(srr_id, converter, hisat2_options, reference_path)
+        if result is not None:
+            cached_results[srr_id] = result
+    return cached_results
+
+def read_srr_groups(srr_list_file: Path) -> List[List[str]]:
+    """
+    :return: SRR IDs on each line of `srr_list_file`, which may hold several
+        SRR IDs separated by whitespace; see `cluster_scheduling.queue_jobs`
+    """
+    with open(srr_list_file) as f:
+        return [line.split() for line in f]
 
-    ncbi_download_path = get_ncbi_download_path()
-    downloaded_path = ncbi_download_path / 'sra' / f'{srr_id}.sra'
-    if not downloaded_path.is_file():
-        raise EnvironmentError(f'NCBI download of {srr_id} reported success, but no file {downloaded_path} exists')
+def read_srr_ids(srr_list_file: Path) -> List[str]:
+    return [srr_id for srr_group in read_srr_groups(srr_list_file) for srr_id in srr_group]
 
-    return downloaded_path
+def get_srr_ids(srr_list_file: Path, task_index: Optional[int]=None) -> List[str]:
+    """
+    Reads `srr_list_file` and returns the line selected by the SLURM_ARRAY_TASK_ID
+    environment variable. This is a separate function so the full list of URLs can
+    be garbage collected afterward -- I don't think this will use much memory at all,
+    but may as well not keep more things alive in memory than we need to.
 
-def process_sra_from_srr_id(
+    :param task_index: Line to select instead, e.g. when run by
+        `executors.LocalExecutor` outside of SLURM
+    """
+    srr_groups = read_srr_groups(srr_list_file)
+
+    if task_index is None:
+        file_index = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    else:
+        file_index = task_index
+
+    return srr_groups[file_index]
+
+def record_run(
+        history: RunHistory,
         srr_id: str,
         subprocesses: int,
-        hisat2_options: Optional[str]=None,
-        reference_path: Optional[Path]=None,
+        wall_seconds: float,
+        peak_rss_bytes: int,
+        input_bytes: int,
+        summary: pd.Series,
 ):
-    local_path = download_sra(srr_id)
     try:
-        rpkm, summary = process_sra_file(
-            sra_path=local_path,
+        history.record(
+            srr_id=srr_id,
             subprocesses=subprocesses,
-            hisat2_options=hisat2_options,
-            reference_path=reference_path,
+            wall_seconds=wall_seconds,
+            peak_rss_bytes=peak_rss_bytes,
+            input_bytes=input_bytes,
+            read_count=int(summary['read_count']),
         )
-    finally:
-        local_path.unlink()
-    return rpkm, summary
+    except sqlite3.Error as e:
+        # Not worth failing the SRR ID for
+        print(f'Failed to record resource usage of {srr_id} in {history.path}: {e}')
 
-def get_srr_id(srr_list_file: Path) -> str:
+def process_srr_ids(
+        srr_ids: List[str],
+        subprocesses: int,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        stream_alignment: bool=False,
+        fastq_fifo: bool=False,
+        output_format: str='csv',
+        record_telemetry: bool=False,
+        history: Optional[RunHistory]=None,
+        download: Optional[Callable[[str], Path]]=None,
+        state: Optional[RunState]=None,
+        cached_results: Optional[Dict[str, GeneCounts]]=None,
+) -> List[str]:
     """
-    Reads `srr_list_file` and returns the item selected by the SLURM_ARRAY_TASK_ID
-    environment variable. This is a separate function so the full list of URLs can
-    be garbage collected afterward -- I don't think this will use much memory at all,
-    but may as well not keep more things alive in memory than we need to.
+    Processes each of `srr_ids` in turn, in this process, so the gene index
+    is loaded once for all of them. A failure is reported and the remaining
+    SRR IDs are still processed, as they would be in separate array tasks.
+
+    :param record_telemetry: Whether to save a telemetry report for each
+        SRR ID; see `telemetry`
+    :param history: If given, the input size, run time and peak memory of
+        each successful SRR ID are recorded here. Peak memory is only exact
+        with `record_telemetry`, and otherwise an upper bound; see
+        `run_history.lifetime_peak_memory`.
+    :param download: Called with each SRR ID to download its SRA file, e.g.
+        `Prefetcher.get`; see `process_sra_from_srr_id`
+    :param state: If given, the state of each SRR ID is updated here as it
+        is processed; see `run_state`
+    :param cached_results: Results of SRR IDs already read from the count
+        cache, e.g. by `read_cached_results`. If given, the cache isn't
+        checked again, so SRR IDs not in this are always downloaded.
+    :return: SRR IDs that failed
     """
-    with open(srr_list_file) as f:
-        srr_ids = [line.strip() for line in f]
+    fetch = download or SraDownloader().download
 
-    file_index = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    # Only called for SRR IDs not in the count cache, which otherwise go
+    # straight to DONE
+    def download_and_update_state(srr_id: str) -> Path:
+        state.update(srr_id, DOWNLOADING)
+        sra_path = fetch(srr_id)
+        state.update(srr_id, ALIGNING)
+        return sra_path
 
-    return srr_ids[file_index]
+    failed = []
+    for srr_id in srr_ids:
+        kwargs = {
+            'srr_id': srr_id,
+            'subprocesses': subprocesses,
+            'hisat2_options': hisat2_options,
+            'reference_path': reference_path,
+            'stream_alignment': stream_alignment,
+            'fastq_fifo': fastq_fifo,
+            'download': fetch if state is None else download_and_update_state,
+        }
+        if cached_results is not None:
+            kwargs['check_cache'] = False
+            kwargs['cached'] = cached_results.get(srr_id)
+        try:
+            start = perf_counter()
+            report = None
+            if record_telemetry:
+                (result, input_bytes), records = telemetry.call_with_telemetry(process_sra_from_srr_id, kwargs)
+            else:
+                result, input_bytes = process_sra_from_srr_id(**kwargs)
+            if record_telemetry:
+                report = telemetry.RunReport(telemetry.sample_report_path(OUTPUT_PATH, srr_id))
+                report.add(srr_id, records)
+
+            with telemetry.report_stage(report, srr_id, 'save'):
+                save_sample_output(srr_id, result.rpkm, result.summary, result.read_counts, output_format)
+        except Exception as e:
+            print(f'Processing {srr_id} failed:')
+            traceback.print_exc()
+            failed.append(srr_id)
+            if state is not None:
+                state.update(srr_id, FAILED, f'{type(e).__name__}: {e}')
+            continue
+
+        if state is not None:
+            state.update(srr_id, DONE)
+
+        # Cached results say nothing about resource usage
+        if history is not None and input_bytes is not None:
+            record_run(
+                history,
+                srr_id=srr_id,
+                subprocesses=subprocesses,
+                wall_seconds=perf_counter() - start,
+                peak_rss_bytes=peak_memory(records) if record_telemetry else lifetime_peak_memory(),
+                input_bytes=input_bytes,
+                summary=result.summary,
+            )
+    return failed
+
+def process_srr_ids_pipelined(
+        srr_ids: List[str],
+        subprocesses: int,
+        hisat2_options: Optional[str]=None,
+        reference_path: Optional[Path]=None,
+        output_format: str='csv',
+        report: Optional[telemetry.RunReport]=None,
+        downloader: Optional[SraDownloader]=None,
+        state: Optional[RunState]=None,
+        history: Optional[RunHistory]=None,
+) -> List[str]:
+    """
+    Processes all of `srr_ids` in this process, downloading, converting,
+    aligning and quantifying different SRR IDs at the same time. Results
+    are saved as soon as each SRR ID finishes. As in `process_srr_ids`, a
+    failure is reported and the remaining SRR IDs are still processed.
+
+    :param report: If given, telemetry for each SRR ID is added to this
+    :param state: If given, the state of each SRR ID is updated here as it
+        moves through the pipeline; see `run_state`
+    :param history: If given, the input size, run time and peak memory of
+        each successful SRR ID are recorded here, as in `process_srr_ids`.
+        Run time is from the start of its download until its results are
+        saved, including time spent waiting for other SRR IDs in the
+        pipeline. Peak memory is of the whole process, so also covers the
+        SRR IDs processed at the same time, and is an upper bound.
+    :return: SRR IDs that failed
+    """
+    if downloader is None:
+        downloader = SraDownloader()
+
+    start_times: Dict[str, float] = {}
+    input_sizes: Dict[str, int] = {}
+    stage_records: Dict[str, List[Dict[str, Any]]] = {}
+
+    def download(srr_id: str) -> Path:
+        start_times[srr_id] = perf_counter()
+        if state is not None:
+            state.update(srr_id, DOWNLOADING)
+        sra_path = downloader.download(srr_id)
+        input_sizes[srr_id] = sra_path.stat().st_size
+        if state is not None:
+            state.update(srr_id, ALIGNING)
+        return sra_path
+
+    stages = [
+        Stage('download', download, discard=lambda sra_path: remove_files([sra_path])),
+        sra_conversion_stage(remove_sra=True),
+    ]
+    stages.extend(
+        alignment_stages(
+            subprocesses=subprocesses,
+            hisat2_options=hisat2_options,
+            reference_path=reference_path,
+            remove_fastq=True,
+        )
+    )
+
+    def save(i: int, result: GeneCounts):
+        with telemetry.report_stage(report, srr_ids[i], 'save'):
+            save_sample_output(srr_ids[i], result.rpkm, result.summary, result.read_counts, output_format)
+        if state is not None:
+            state.update(srr_ids[i], DONE)
+        # Cached results say nothing about resource usage
+        if history is not None and srr_ids[i] in input_sizes:
+            record_run(
+                history,
+                srr_id=srr_ids[i],
+                subprocesses=subprocesses,
+                wall_seconds=perf_counter() - start_times[srr_ids[i]],
+                peak_rss_bytes=(
+                    peak_memory(stage_records[srr_ids[i]]) if report is not None else lifetime_peak_memory()
+                ),
+                input_bytes=input_sizes[srr_ids[i]],
+                summary=result.summary,
+            )
+
+    def add_telemetry(i: int, records: List[Dict[str, Any]]):
+        report.add(srr_ids[i], records)
+        stage_records.setdefault(srr_ids[i], []).extend(records)
+
+    failed = []
+
+    def record_failure(i: int, e: BaseException):
+        print(f'Processing {srr_ids[i]} failed:')
+        traceback.print_exception(type(e), e, e.__traceback__)
+        failed.append(srr_ids[i])
+        if state is not None:
+            state.update(srr_ids[i], FAILED, f'{type(e).__name__}: {e}')
+
+    count_cache.run_pipeline(
+        Pipeline(stages, stop_on_error=False),
+        srr_ids,
+        inputs=lambda cache, srr_id: count_cache.srr_input(srr_id),
+        hisat2_options=hisat2_options,
+        reference_path=reference_path,
+        converter=active_converter(),
+        on_result=save,
+        on_telemetry=add_telemetry if report is not None else None,
+        on_error=record_failure,
+    )
+    return failed
 
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('srr_list_file', type=Path)
+    p.add_argument(
+        '--pipeline',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Process every SRR ID in the list in this process, instead of those
+            selected by SLURM_ARRAY_TASK_ID. Downloading, SRA conversion, alignment
+            and quantification run in separate threads connected by bounded
+            queues, so different SRR IDs can be in different stages at once. As
+            without --pipeline, an SRR ID that fails is reported and the others
+            are still processed. Cannot be combined with --stream-alignment or
+            --fastq-fifo.
+            """
+        ),
+    )
+    p.add_argument(
+        '--task-index',
+        type=int,
+        help=normalize_whitespace(
+            """
+            Line of the SRR list file to process, counting from 0. Default: the
+            SLURM_ARRAY_TASK_ID environment variable.
+            """
+        ),
+    )
     add_common_command_line_arguments(p)
+    add_sra_command_line_arguments(p)
+    add_sra_conversion_command_line_arguments(p)
+    add_output_format_command_line_argument(p)
+    add_scratch_command_line_arguments(p)
+    count_cache.add_count_cache_command_line_arguments(p)
+    add_download_command_line_arguments(p)
+    telemetry.add_telemetry_command_line_argument(p)
+    add_history_command_line_argument(p)
+    add_state_command_line_argument(p)
     args = p.parse_args()
+    configure_scratch(args)
+    count_cache.configure_count_cache(args)
+    configure_sra_conversion(args)
 
-    srr_id = get_srr_id(args.srr_list_file)
-    rpkm, summary = process_sra_from_srr_id(
-        srr_id=srr_id,
-        subprocesses=args.subprocesses,
-        hisat2_options=args.hisat2_options,
-        reference_path=args.reference_path,
-    )
-
-    filename = f'{srr_id}.csv'
-
-    rpkm_dir = OUTPUT_PATH / 'rpkm'
-    summary_dir = OUTPUT_PATH / 'summary'
+    if args.pipeline and args.fastq_fifo:
+        p.error('--fastq-fifo cannot be combined with --pipeline, which converts SRA files in a separate stage')
+    if args.pipeline and args.stream_alignment:
+        p.error('--stream-alignment cannot be combined with --pipeline, which writes SAM files between stages')
 
-    rpkm.to_csv(rpkm_dir / filename)
-    summary.to_csv(summary_dir / filename)
+    if args.pipeline:
+        report = None
+        if args.telemetry:
+            report_path = telemetry.sample_report_path(OUTPUT_PATH, args.srr_list_file.stem)
+            report = telemetry.RunReport(report_path)
+        with RunHistory(args.history_file) as history, RunState(args.state_file) as state:
+            failed = process_srr_ids_pipelined(
+                srr_ids=read_srr_ids(args.srr_list_file),
+                subprocesses=args.subprocesses,
+                hisat2_options=args.hisat2_options,
+                reference_path=args.reference_path,
+                output_format=args.output_format,
+                report=report,
+                downloader=SraDownloader.from_args(args),
+                state=state,
+                history=history,
+            )
+    else:
+        srr_ids = get_srr_ids(args.srr_list_file, args.task_index)
+        downloader = SraDownloader.from_args(args)
+        download = downloader.download
+        with ExitStack() as stack:
+            history = stack.enter_context(RunHistory(args.history_file))
+            state = stack.enter_context(RunState(args.state_file))
+            # SRR IDs in the count cache aren't downloaded at all. Results
+            # are read now, since an entry could be removed before its SRR
+            # ID is processed, which would then need a download that
+            # wasn't started ahead of time.
+            cached_results = read_cached_results(
+                srr_ids,
+                active_converter(args.fastq_fifo),
+                args.hisat2_options,
+                args.reference_path,
+            )
+            download_srr_ids = srr_ids
+            if cached_results is not None:
+                download_srr_ids = [srr_id for srr_id in srr_ids if srr_id not in cached_results]
+            if args.download_lookahead > 0 and len(download_srr_ids) > 1:
+                budget_bytes = None
+                if args.download_budget_gb is not None:
+                    budget_bytes = int(args.download_budget_gb * GIGABYTE)
+                prefetcher = Prefetcher(download_srr_ids, downloader, args.download_lookahead, budget_bytes)
+                download = stack.enter_context(prefetcher).get
+            failed = process_srr_ids(
+                srr_ids=srr_ids,
+                subprocesses=args.subprocesses,
+                hisat2_options=args.hisat2_options,
+                reference_path=args.reference_path,
+                stream_alignment=args.stream_alignment,
+                fastq_fifo=args.fastq_fifo,
+                output_format=args.output_format,
+                record_telemetry=args.telemetry,
+                history=history,
+                download=download,
+                state=state,
+                cached_results=cached_results,
+            )
+    if failed:
+        sys.exit(f'Failed to process {len(failed)} SRR IDs: {" ".join(failed)}')
@@ -0,0 +1,255 @@
+"""
+History of resource usage of past SRR runs, used to size SLURM jobs.
+
+Each array task of `process_sra_from_srr_list.py` adds one row per SRR ID to
+an SQLite database: the size of the SRA file, the number of reads, the
+number of HISAT2 threads (`--subprocesses`), wall time, and peak memory.
+`cluster_scheduling` fits a model to these rows to predict the memory and
+run time of each task before submitting it, so that small jobs don't
+reserve more than they need and large ones aren't killed for running out.
+
+SQLite handles concurrent writers by locking the database file, so many
+array tasks can record their runs in the same file.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from math import ceil
+from pathlib import Path
+import resource
+import socket
+import sqlite3
+from threading import Lock
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from paths import OUTPUT_PATH
+from telemetry import RUSAGE_MAXRSS_UNIT, peak_rss_bytes
+from utils import normalize_whitespace
+
+DEFAULT_HISTORY_PATH = OUTPUT_PATH / 'run_history.sqlite3'
+
+# Seconds to wait for other array tasks writing to the database
+LOCK_TIMEOUT = 120
+
+# Fewer runs than this (with the same number of subprocesses, if possible)
+# aren't enough to predict resource usage
+MIN_HISTORY_RUNS = 3
+
+CREATE_TABLE_STATEMENT = """
+CREATE TABLE IF NOT EXISTS runs (
+    srr_id TEXT NOT NULL,
+    finished TEXT NOT NULL,
+    hostname TEXT NOT NULL,
+    subprocesses INTEGER NOT NULL,
+    input_bytes INTEGER,
+    read_count INTEGER,
+    wall_seconds REAL NOT NULL,
+    peak_rss_bytes INTEGER NOT NULL
+)
+"""
+
+RUN_COLUMNS = [
+    'srr_id',
+    'finished',
+    'hostname',
+    'subprocesses',
+    'input_bytes',
+    'read_count',
+    'wall_seconds',
+    'peak_rss_bytes',
+]
+
+# Inputs to predict resource usage from, in order of preference
+FEATURE_COLUMNS = ['input_bytes', 'read_count']
+RESOURCE_COLUMNS = ['peak_rss_bytes', 'wall_seconds']
+
+def add_history_command_line_argument(p: ArgumentParser):
+    p.add_argument(
+        '--history-file',
+        type=Path,
+        default=DEFAULT_HISTORY_PATH,
+        help=normalize_whitespace(
+            f"""
+            SQLite database of the resource usage of each SRR run, recorded by
+            process_sra_from_srr_list.py and used by cluster_scheduling.py to
+            size jobs. Default: {DEFAULT_HISTORY_PATH}
+            """
+        ),
+    )
+
+def peak_memory(records: List[Dict[str, Any]]) -> int:
+    """
+    :param records: Telemetry records of one sample; see `telemetry`
+    :return: Peak memory of this process, plus that of the largest external
+        program, which is run while this process holds its own memory
+    """
+    own_peak = max((record['peak_rss_bytes'] for record in records if record['type'] == 'stage'), default=0)
+    program_peak = max((record['peak_rss_bytes'] for record in records if record['type'] == 'process'), default=0)
+    return own_peak + program_peak
+
+def lifetime_peak_memory() -> int:
+    """
+    Peak memory without telemetry records, which would require running
+    every external program through `telemetry`.
+
+    :return: Peak memory of this process, plus that of the largest child
+        process that has exited. Both are maxima over the life of this
+        process, so when one process handles several SRR IDs, this is an
+        upper bound for all but the first.
+    """
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RUSAGE_MAXRSS_UNIT
+    return peak_rss_bytes() + children_peak
+
+class RunHistory:
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Recorded from the worker threads of `pipeline`, one at a time
+        self.connection = sqlite3.connect(str(path), timeout=LOCK_TIMEOUT, check_same_thread=False)
+        self.lock = Lock()
+        with self.connection:
+            self.connection.execute(CREATE_TABLE_STATEMENT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def record(
+            self,
+            srr_id: str,
+            subprocesses: int,
+            wall_seconds: float,
+            peak_rss_bytes: int,
+            input_bytes: Optional[int]=None,
+            read_count: Optional[int]=None,
+    ):
+        values = [
+            srr_id,
+            datetime.now().isoformat(),
+            socket.gethostname(),
+            subprocesses,
+            input_bytes,
+            read_count,
+            wall_seconds,
+            peak_rss_bytes,
+        ]
+        placeholders = ', '.join('?' for _ in RUN_COLUMNS)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f'INSERT INTO runs ({", ".join(RUN_COLUMNS)}) VALUES ({placeholders})',
+                values,
+            )
+
+    def runs(self) -> pd.DataFrame:
+        return pd.read_sql_query('SELECT * FROM runs', self.connection)
+
+class ResourceEstimate(NamedTuple):
+    memory_bytes: float
+    seconds: float
+
+class ResourceModel:
+    """
+    Predicts peak memory and wall time of one SRR run as a linear function
+    of its input size (or read count), fit to past runs. The fitted line is
+    raised until no past run is above it, so predictions cover every run
+    seen so far, before any safety margin is added.
+    """
+    def __init__(self, runs: pd.DataFrame, feature: Optional[str]):
+        """
+        :param runs: Past runs, with the columns of the 'runs' table
+        :param feature: Column of `runs` to predict from, or None to always
+            predict the largest values seen
+        """
+        self.feature = feature
+        self.run_count = runs.shape[0]
+        self.maximum = {column: float(runs[column].max()) for column in RESOURCE_COLUMNS}
+        self.coefficients: Dict[str, np.ndarray] = {}
+        if feature is None:
+            return
+        x = runs[feature].to_numpy(dtype=float)
+        for column in RESOURCE_COLUMNS:
+            y = runs[column].to_numpy(dtype=float)
+            if np.ptp(x) > 0:
+                slope, intercept = np.polyfit(x, y, 1)
+            else:
+                slope, intercept = 0.0, y.mean()
+            if slope < 0:
+                slope, intercept = 0.0, y.mean()
+            intercept += max((y - (slope * x + intercept)).max(), 0)
+            self.coefficients[column] = np.array([slope, intercept])
+
+    @classmethod
+    def fit(
+            cls,
+            runs: pd.DataFrame,
+            subprocesses: int,
+            features: List[str]=FEATURE_COLUMNS,
+    ) -> Optional['ResourceModel']:
+        """
+        Fits to past runs with the same number of subprocesses, or to all past
+        runs if there are too few of those.
+
+        :param features: Columns that are known for the SRR IDs to predict,
+            in order of preference
+        :return: Model, or None if there are too few past runs
+        """
+        matching = runs.loc[runs['subprocesses'] == subprocesses]
+        if matching.shape[0] >= MIN_HISTORY_RUNS:
+            runs = matching
+        elif runs.shape[0] >= MIN_HISTORY_RUNS:
+            print(
+                f'Only {matching.shape[0]} past runs with {subprocesses} subprocesses; '
+                f'estimating resources from all {runs.shape[0]} past runs'
+            )
+        else:
+            return None
+
+        for feature in features:
+            known = runs.loc[runs[feature].notnull()]
+            if known.shape[0] >= MIN_HISTORY_RUNS:
+                return cls(known, feature)
+        return cls(runs, None)
+
+    def predict(self, features: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param features: Input size and/or read count of each SRR ID, indexed
+            by SRR ID, NaN if unknown, in which case the largest values seen
+            are predicted
+        :return: Data frame with predicted 'peak_rss_bytes' and
+            'wall_seconds' of each SRR ID
+        """
+        predictions = pd.DataFrame(index=features.index)
+        if self.feature in features.columns:
+            x = features[self.feature].to_numpy(dtype=float)
+        else:
+            x = np.full(features.shape[0], np.nan)
+        for column in RESOURCE_COLUMNS:
+            if column in self.coefficients:
+                slope, intercept = self.coefficients[column]
+                values = slope * x + intercept
+                values[np.isnan(values)] = self.maximum[column]
+            else:
+                values = np.full(x.shape, self.maximum[column])
+            predictions[column] = values
+        return predictions
+
+def estimate_task_resources(predictions: pd.DataFrame, srr_ids: List[str], safety_margin: float) -> ResourceEstimate:
+    """
+    SRR IDs in a task are processed one after another, so the task needs the
+    largest memory of any of them, and the sum of their run times.
+    """
+    task_predictions = predictions.loc[srr_ids]
+    return ResourceEstimate(
+        memory_bytes=task_predictions['peak_rss_bytes'].max() * (1 + safety_margin),
+        seconds=task_predictions['wall_seconds'].sum() * (1 + safety_margin),
+    )
+
+def round_up(value: float, step: int) -> int:
+    return max(ceil(value / step), 1) * step
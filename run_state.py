@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+State of each SRR ID in a processing campaign, so that resubmission can
+skip SRR IDs that are already done.
+
+`cluster_scheduling.py` marks each SRR ID it submits as 'queued', and each
+array task of `process_sra_from_srr_list.py` updates the SRR IDs it
+processes: 'downloading', then 'aligning' (conversion, alignment and
+quantification), then 'done' or 'failed', with the reason for failures.
+SRR IDs whose results are in the count cache go straight to 'done'.
+Tasks that were killed, e.g. preempted or out of time, leave their SRR IDs
+in 'downloading' or 'aligning'. Everything but 'done' is resubmitted by
+`cluster_scheduling.py --resubmit`.
+
+Like `run_history`, this is an SQLite database, which many array tasks can
+update at once. Running this file as a script prints the number of SRR IDs
+in each state and the failures, or lists the SRR IDs that aren't done.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import os
+from pathlib import Path
+import socket
+import sqlite3
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+
+from paths import OUTPUT_PATH
+from utils import normalize_whitespace
+
+DEFAULT_STATE_PATH = OUTPUT_PATH / 'run_state.sqlite3'
+
+# Seconds to wait for other array tasks writing to the database
+LOCK_TIMEOUT = 120
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+ALIGNING = 'aligning'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [QUEUED, DOWNLOADING, ALIGNING, DONE, FAILED]
+
+CREATE_TABLE_STATEMENT = """
+CREATE TABLE IF NOT EXISTS srr_state (
+    srr_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    queued TEXT,
+    started TEXT,
+    finished TEXT,
+    updated TEXT NOT NULL,
+    hostname TEXT,
+    job TEXT,
+    error TEXT
+)
+"""
+
+def add_state_command_line_argument(p: ArgumentParser):
+    p.add_argument(
+        '--state-file',
+        type=Path,
+        default=DEFAULT_STATE_PATH,
+        help=normalize_whitespace(
+            f"""
+            SQLite database of the state of each SRR ID, updated by
+            cluster_scheduling.py and process_sra_from_srr_list.py, and used
+            to resubmit only unfinished SRR IDs. Default: {DEFAULT_STATE_PATH}
+            """
+        ),
+    )
+
+def slurm_job() -> Optional[str]:
+    """
+    :return: SLURM job ID, as '{array job}_{task}' for array tasks, or None
+        outside of SLURM
+    """
+    if 'SLURM_ARRAY_JOB_ID' in os.environ:
+        return f'{os.environ["SLURM_ARRAY_JOB_ID"]}_{os.environ.get("SLURM_ARRAY_TASK_ID")}'
+    return os.environ.get('SLURM_JOB_ID')
+
+class RunState:
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Updated from the worker threads of `pipeline`, one at a time
+        self.connection = sqlite3.connect(str(path), timeout=LOCK_TIMEOUT, check_same_thread=False)
+        self.lock = Lock()
+        with self.connection:
+            self.connection.execute(CREATE_TABLE_STATEMENT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def queue(self, srr_ids: Iterable[str]):
+        now = datetime.now().isoformat()
+        with self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO srr_state (srr_id, state, queued, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(srr_id) DO UPDATE SET
+                    state = excluded.state,
+                    queued = excluded.queued,
+                    updated = excluded.updated
+                """,
+                [(srr_id, QUEUED, now, now) for srr_id in srr_ids],
+            )
+
+    def update(self, srr_id: str, state: str, error: Optional[str]=None):
+        """
+        Sets the state of `srr_id`. Starting to download counts as a new
+        attempt. Failures to write to the database are reported, but not
+        raised: at worst, an SRR ID is processed again on resubmission.
+
+        :param error: Reason for failure, if `state` is `FAILED`
+        """
+        if state not in STATES:
+            raise ValueError(f'Unknown state: {state}')
+        now = datetime.now().isoformat()
+        started = now if state == DOWNLOADING else None
+        finished = now if state in {DONE, FAILED} else None
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    """
+                    INSERT INTO srr_state (srr_id, state, attempts, started, finished, updated, hostname, job, error)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(srr_id) DO UPDATE SET
+                        state = excluded.state,
+                        attempts = attempts + excluded.attempts,
+                        started = COALESCE(excluded.started, started),
+                        finished = excluded.finished,
+                        updated = excluded.updated,
+                        hostname = excluded.hostname,
+                        job = excluded.job,
+                        error = excluded.error
+                    """,
+                    [
+                        srr_id,
+                        state,
+                        int(state == DOWNLOADING),
+                        started,
+                        finished,
+                        now,
+                        socket.gethostname(),
+                        slurm_job(),
+                        error,
+                    ],
+                )
+        except sqlite3.Error as e:
+            print(f'Failed to record state {state!r} of {srr_id} in {self.path}: {e}')
+
+    def states(self) -> pd.DataFrame:
+        """
+        :return: Data frame of the 'srr_state' table, indexed by SRR ID
+        """
+        return pd.read_sql_query('SELECT * FROM srr_state', self.connection, index_col='srr_id')
+
+    def incomplete(self, srr_ids: List[str]) -> List[str]:
+        """
+        :return: SRR IDs from `srr_ids`, in the same order, that aren't done,
+            including those that were never queued
+        """
+        done = set(self.states().query('state == @DONE').index)
+        return [srr_id for srr_id in srr_ids if srr_id not in done]
+
+    def counts(self, srr_ids: Optional[List[str]]=None) -> Dict[str, int]:
+        """
+        :param srr_ids: Count only these SRR IDs; those not in the database
+            are counted as 'unknown'
+        """
+        states = self.states()['state']
+        if srr_ids is not None:
+            states = states.reindex(srr_ids).fillna('unknown')
+        counts = states.value_counts()
+        return {state: int(counts[state]) for state in STATES + ['unknown'] if state in counts}
+
+def print_state_report(state: RunState, srr_ids: Optional[List[str]]=None):
+    counts = state.counts(srr_ids)
+    print('SRR IDs by state:')
+    for name, count in counts.items():
+        print(f'\t{name:>11}  {count}')
+    states = state.states()
+    if srr_ids is not None:
+        states = states.loc[states.index.intersection(srr_ids)]
+    failed = states.loc[states['state'] == FAILED]
+    if failed.shape[0]:
+        print('Failed SRR IDs:')
+        for srr_id, row in failed.iterrows():
+            print(f'\t{srr_id}  attempts: {row["attempts"]}  job: {row["job"]}  {row["error"]}')
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    add_state_command_line_argument(p)
+    p.add_argument(
+        'srr_list_file',
+        type=Path,
+        nargs='?',
+        help='Only report SRR IDs in this file, one or more per line',
+    )
+    p.add_argument(
+        '--incomplete',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Print the SRR IDs in srr_list_file that aren't done, one per line,
+            instead of a report
+            """
+        ),
+    )
+    args = p.parse_args()
+    if args.incomplete and args.srr_list_file is None:
+        p.error('--incomplete requires srr_list_file')
+
+    srr_ids = None
+    if args.srr_list_file is not None:
+        with open(args.srr_list_file) as f:
+            srr_ids = f.read().split()
+    with RunState(args.state_file) as state:
+        if args.incomplete:
+            for srr_id in state.incomplete(srr_ids):
+                print(srr_id)
+        else:
+            print_state_report(state, srr_ids)
@@ -0,0 +1,159 @@
+"""
+Chunked, columnar SAM parsing.
+
+SAM input is read in fixed-size blocks of bytes, and each block is parsed
+with vectorized NumPy operations into typed arrays of the fields used for
+quantification. No per-read Python objects are created, and memory use is
+bounded by the block size regardless of the size of the SAM file.
+"""
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+# Bytes read from the SAM file at once; each block is cut at the last
+# complete line, and the remainder carried over to the next block
+CHUNK_SIZE = 2 ** 26
+
+TAB = ord('\t')
+NEWLINE = ord('\n')
+HEADER_PREFIX = ord('@')
+ZERO = ord('0')
+
+# Mandatory SAM fields, separated by 10 tabs
+SAM_FIELD_COUNT = 11
+
+class SamChunk(NamedTuple):
+    # Number of alignment records in this chunk, including unmapped reads
+    record_count: int
+    flags: np.ndarray
+    # Index into `SamChunkReader.reference_names`
+    reference_ids: np.ndarray
+    # 1-based leftmost position, as in the SAM file
+    positions: np.ndarray
+    # Length of the SEQ field
+    lengths: np.ndarray
+    # Last `qname_suffix_length` bytes of each QNAME, as a 2-D uint8 array,
+    # if requested from the reader; e.g. for cell barcodes and UMIs
+    qname_suffixes: Optional[np.ndarray] = None
+
+def parse_integer_field(buf: np.ndarray, field_starts: np.ndarray, field_ends: np.ndarray) -> np.ndarray:
+    """
+    Parses unsigned decimal integers from `buf[field_starts[i]:field_ends[i]]`
+    for all `i` at once, one digit position at a time.
+    """
+    widths = field_ends - field_starts
+    values = np.zeros(len(field_starts), dtype=np.int64)
+    max_width = int(widths.max()) if len(widths) else 0
+    for digit in range(max_width):
+        present = digit < widths
+        positions = np.minimum(field_starts + digit, len(buf) - 1)
+        digit_values = buf[positions].astype(np.int64) - ZERO
+        values = np.where(present, values * 10 + digit_values, values)
+    return values
+
+def gather_string_field(buf: np.ndarray, field_starts: np.ndarray, field_ends: np.ndarray) -> np.ndarray:
+    """
+    :return: Fixed-width bytes array (dtype 'S{n}') containing the field
+        contents for each record, without creating Python strings
+    """
+    widths = field_ends - field_starts
+    max_width = max(int(widths.max()) if len(widths) else 0, 1)
+    offsets = np.arange(max_width)
+    positions = np.minimum(field_starts[:, np.newaxis] + offsets, len(buf) - 1)
+    chars = buf[positions]
+    chars[offsets >= widths[:, np.newaxis]] = 0
+    return np.ascontiguousarray(chars).view(f'S{max_width}').reshape(-1)
+
+class SamChunkReader:
+    def __init__(self, sam_file: BinaryIO, chunk_size: int=CHUNK_SIZE, qname_suffix_length: int=0):
+        """
+        :param sam_file: SAM file opened in binary mode, or a binary pipe
+        :param chunk_size: Number of bytes to read and parse at once
+        :param qname_suffix_length: If nonzero, this many bytes at the end of
+            each QNAME are returned in `SamChunk.qname_suffixes`
+        """
+        self.sam_file = sam_file
+        self.chunk_size = chunk_size
+        self.qname_suffix_length = qname_suffix_length
+        # Reference names seen so far, in order of first appearance. Each
+        # chunk's `reference_ids` index into this list.
+        self.reference_names: List[str] = []
+        self.reference_ids_by_name: Dict[bytes, int] = {}
+
+    def __iter__(self) -> Iterable[SamChunk]:
+        remainder = b''
+        while True:
+            data = self.sam_file.read(self.chunk_size)
+            if not data:
+                if remainder:
+                    if not remainder.endswith(b'\n'):
+                        remainder += b'\n'
+                    yield self.parse_block(remainder)
+                return
+            block = remainder + data
+            last_newline = block.rfind(b'\n')
+            if last_newline < 0:
+                # Line longer than the chunk size; keep reading
+                remainder = block
+                continue
+            remainder = block[last_newline + 1:]
+            yield self.parse_block(block[:last_newline + 1])
+
+    def reference_ids(self, names: np.ndarray) -> np.ndarray:
+        unique_names, inverse = np.unique(names, return_inverse=True)
+        unique_ids = np.empty(len(unique_names), dtype=np.int32)
+        for i, name in enumerate(unique_names):
+            if name not in self.reference_ids_by_name:
+                self.reference_ids_by_name[name] = len(self.reference_names)
+                self.reference_names.append(name.decode())
+            unique_ids[i] = self.reference_ids_by_name[name]
+        return unique_ids[inverse.reshape(-1)]
+
+    def parse_block(self, block: bytes) -> SamChunk:
+        """
+        :param block: Complete SAM lines, ending with a newline
+        """
+        buf = np.frombuffer(block, dtype=np.uint8)
+
+        line_ends = np.flatnonzero(buf == NEWLINE)
+        line_starts = np.empty_like(line_ends)
+        line_starts[0] = 0
+        line_starts[1:] = line_ends[:-1] + 1
+
+        # Drops header lines, and blank lines
+        nonempty = line_starts < line_ends
+        is_record = nonempty.copy()
+        is_record[nonempty] = buf[line_starts[nonempty]] != HEADER_PREFIX
+        line_starts = line_starts[is_record]
+        line_ends = line_ends[is_record]
+
+        tabs = np.flatnonzero(buf == TAB)
+        first_tabs = np.searchsorted(tabs, line_starts)
+        last_tabs = first_tabs + SAM_FIELD_COUNT - 2
+        if len(line_starts) and (last_tabs[-1] >= len(tabs) or (tabs[last_tabs] > line_ends).any()):
+            raise ValueError(f'SAM record with fewer than {SAM_FIELD_COUNT} fields')
+
+        # Positions of the tab characters ending each of the first 10 fields
+        # (QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, RNEXT, PNEXT, TLEN, SEQ)
+        field_ends = [tabs[first_tabs + i] for i in range(SAM_FIELD_COUNT - 1)]
+
+        flags = parse_integer_field(buf, field_ends[0] + 1, field_ends[1]).astype(np.uint16)
+        reference_names = gather_string_field(buf, field_ends[1] + 1, field_ends[2])
+        positions = parse_integer_field(buf, field_ends[2] + 1, field_ends[3])
+        lengths = (field_ends[9] - field_ends[8] - 1).astype(np.int32)
+
+        qname_suffixes = None
+        if self.qname_suffix_length:
+            if len(line_starts) and (field_ends[0] - line_starts < self.qname_suffix_length).any():
+                raise ValueError(f'SAM record with QNAME shorter than {self.qname_suffix_length} characters')
+            offsets = np.arange(-self.qname_suffix_length, 0)
+            qname_suffixes = buf[field_ends[0][:, np.newaxis] + offsets]
+
+        return SamChunk(
+            record_count=len(line_starts),
+            flags=flags,
+            reference_ids=self.reference_ids(reference_names),
+            positions=positions,
+            lengths=lengths,
+            qname_suffixes=qname_suffixes,
+        )
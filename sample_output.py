@@ -0,0 +1,266 @@
+"""
+Per-sample output files for SRR IDs processed by separate jobs, e.g. one
+SLURM array task per SRR ID. Two formats are supported:
+
+* 'csv': RPKM and summary Series saved as text, in the 'rpkm' and 'summary'
+  subdirectories of the output path
+* 'binary': one '.expr' file per sample in the 'expr' subdirectory, which
+  is several times smaller and much faster to write and read
+
+A binary file contains a short JSON header (sample name, summary values,
+annotation hash) followed by a little-endian array. The array holds the
+read count of each gene as uint32; since RPKM is computed from these counts
+by `summarize_counts`, RPKM values can be recomputed exactly when reading.
+If a count doesn't fit in uint32, float64 RPKM values are saved instead.
+
+Gene IDs and lengths are saved once, in a file named by the hash of the
+annotation, which every sample file refers to. All files are written
+atomically, by renaming a complete temporary file.
+"""
+from argparse import ArgumentParser
+from functools import lru_cache
+from hashlib import sha1
+import json
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Iterable, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+
+from gene_index import load_gene_index
+from paths import OUTPUT_PATH
+from utils import normalize_whitespace
+
+OUTPUT_FORMATS = ['csv', 'binary']
+
+RPKM_DIRECTORY_NAME = 'rpkm'
+SUMMARY_DIRECTORY_NAME = 'summary'
+BINARY_DIRECTORY_NAME = 'expr'
+CSV_SUFFIX = '.csv'
+BINARY_SUFFIX = '.expr'
+ANNOTATION_FILENAME_TEMPLATE = 'genes_{annotation_hash}.npz'
+
+BINARY_MAGIC = b'SCRNAEXP'
+BINARY_FORMAT_VERSION = 1
+# Little-endian uint32 length of the JSON header, after the magic bytes
+HEADER_LENGTH_DTYPE = np.dtype('<u4')
+# Data arrays start at a multiple of this many bytes
+DATA_ALIGNMENT = 8
+VALUE_DTYPES = {
+    'counts': np.dtype('<u4'),
+    'rpkm': np.dtype('<f8'),
+}
+
+def add_output_format_command_line_argument(p: ArgumentParser):
+    p.add_argument(
+        '--output-format',
+        choices=OUTPUT_FORMATS,
+        default='csv',
+        help=normalize_whitespace(
+            f"""
+            Format of per-sample output files. 'csv' saves text files in the
+            '{RPKM_DIRECTORY_NAME}' and '{SUMMARY_DIRECTORY_NAME}' directories;
+            'binary' saves one compact '{BINARY_SUFFIX}' file per sample in the
+            '{BINARY_DIRECTORY_NAME}' directory. Default: csv.
+            """
+        ),
+    )
+
+def annotation_hash(gene_length: pd.Series) -> str:
+    """
+    :param gene_length: Gene lengths in kilobases, indexed by gene ID
+    :return: Hash identifying the gene IDs, their order, and their lengths
+    """
+    h = sha1()
+    h.update('\n'.join(str(gene_id) for gene_id in gene_length.index).encode('utf-8'))
+    h.update(gene_length.to_numpy(dtype='<f8').tobytes())
+    return h.hexdigest()
+
+def write_atomic(path: Path, data: bytes):
+    with NamedTemporaryFile(dir=path.parent, prefix=f'.{path.name}.', delete=False) as f:
+        try:
+            f.write(data)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+def save_annotation(directory: Path, gene_length: pd.Series) -> str:
+    """
+    Saves gene IDs and lengths in `directory`, unless already present.
+
+    :return: Annotation hash
+    """
+    hash_value = annotation_hash(gene_length)
+    path = directory / ANNOTATION_FILENAME_TEMPLATE.format(annotation_hash=hash_value)
+    if not path.is_file():
+        with NamedTemporaryFile(dir=directory, prefix=f'.{path.name}.', suffix='.npz', delete=False) as f:
+            np.savez(
+                f,
+                gene_ids=np.array(gene_length.index, dtype=str),
+                gene_length=gene_length.to_numpy(dtype=np.float64),
+            )
+        os.replace(f.name, path)
+    return hash_value
+
+@lru_cache(maxsize=None)
+def load_annotation(directory: Path, hash_value: str) -> pd.Series:
+    """
+    :return: Gene lengths in kilobases, indexed by gene ID
+    """
+    path = directory / ANNOTATION_FILENAME_TEMPLATE.format(annotation_hash=hash_value)
+    with np.load(path, allow_pickle=False) as data:
+        return pd.Series(data['gene_length'], index=data['gene_ids'].tolist())
+
+def rpkm_from_counts(counts: np.ndarray, gene_length: np.ndarray, reads_total: np.ndarray) -> np.ndarray:
+    """
+    Same computation as `summarize_counts`, for one sample or for a matrix
+    of samples by genes.
+
+    :param reads_total: Total reads in each sample
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (counts * 1000000) / (np.multiply.outer(reads_total, gene_length))
+
+def encode_sample(
+        sample_name: str,
+        read_counts: pd.Series,
+        summary: pd.Series,
+        hash_value: str,
+        gene_length: pd.Series,
+) -> bytes:
+    """
+    :param read_counts: Read count of each gene, from `summarize_counts`
+    """
+    counts = read_counts.to_numpy()
+    if counts.max(initial=0) <= np.iinfo(VALUE_DTYPES['counts']).max:
+        value_type, values = 'counts', counts
+    else:
+        value_type = 'rpkm'
+        values = rpkm_from_counts(counts, gene_length.to_numpy(), int(summary['read_count']))
+
+    header = {
+        'format_version': BINARY_FORMAT_VERSION,
+        'sample_name': sample_name,
+        'annotation_hash': hash_value,
+        'gene_count': len(counts),
+        'values': value_type,
+        'summary': {key: int(value) for key, value in summary.items()},
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix_length = len(BINARY_MAGIC) + HEADER_LENGTH_DTYPE.itemsize + len(header_bytes)
+    padding = -prefix_length % DATA_ALIGNMENT
+    return b''.join(
+        [
+            BINARY_MAGIC,
+            np.array(len(header_bytes) + padding, dtype=HEADER_LENGTH_DTYPE).tobytes(),
+            header_bytes,
+            b' ' * padding,
+            values.astype(VALUE_DTYPES[value_type]).tobytes(),
+        ]
+    )
+
+class SampleOutput(NamedTuple):
+    sample_name: str
+    annotation_hash: str
+    summary: pd.Series
+    # One of the keys of VALUE_DTYPES
+    value_type: str
+    values: np.ndarray
+
+def read_binary_sample(path: Path) -> SampleOutput:
+    data = path.read_bytes()
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError(f'{path} is not a binary sample output file')
+    header_start = len(BINARY_MAGIC) + HEADER_LENGTH_DTYPE.itemsize
+    header_length = int(np.frombuffer(data, dtype=HEADER_LENGTH_DTYPE, count=1, offset=len(BINARY_MAGIC))[0])
+    header = json.loads(data[header_start:header_start + header_length])
+    if header['format_version'] != BINARY_FORMAT_VERSION:
+        raise ValueError(f'Unsupported format version {header["format_version"]} in {path}')
+
+    values = np.frombuffer(
+        data,
+        dtype=VALUE_DTYPES[header['values']],
+        count=header['gene_count'],
+        offset=header_start + header_length,
+    )
+    return SampleOutput(
+        sample_name=header['sample_name'],
+        annotation_hash=header['annotation_hash'],
+        summary=pd.Series(header['summary']),
+        value_type=header['values'],
+        values=values,
+    )
+
+def sample_rpkm(sample: SampleOutput, gene_length: pd.Series) -> np.ndarray:
+    if sample.value_type == 'counts':
+        return rpkm_from_counts(sample.values, gene_length.to_numpy(), sample.summary['read_count'])
+    return sample.values.astype(np.float64)
+
+def load_binary_samples(paths: Iterable[Path]) -> Tuple[np.ndarray, pd.DataFrame, pd.Index]:
+    """
+    Loads binary sample files, which must all use the same annotation. Gene
+    annotations are read from the directory containing each file.
+
+    :return: 3-tuple: RPKM matrix (samples by genes), summary data frame
+        indexed by sample name, and gene IDs
+    :raises ValueError: If files have different annotations
+    """
+    paths = list(paths)
+    if not paths:
+        raise ValueError('No sample files given')
+    samples = [read_binary_sample(path) for path in paths]
+
+    hash_value = samples[0].annotation_hash
+    mismatched = [path for path, sample in zip(paths, samples) if sample.annotation_hash != hash_value]
+    if mismatched:
+        raise ValueError(f'{len(mismatched)} files have a different annotation than {paths[0]}, e.g. {mismatched[0]}')
+    gene_length = load_annotation(paths[0].parent, hash_value)
+
+    rpkm = np.empty((len(samples), len(gene_length)), dtype=np.float64)
+    for i, sample in enumerate(samples):
+        rpkm[i] = sample_rpkm(sample, gene_length)
+    summary = pd.DataFrame(
+        [sample.summary for sample in samples],
+        index=[sample.sample_name for sample in samples],
+    )
+    return rpkm, summary, gene_length.index
+
+def save_sample_output(
+        sample_name: str,
+        rpkm: pd.Series,
+        summary: pd.Series,
+        read_counts: pd.Series,
+        output_format: str='csv',
+        output_path: Path=OUTPUT_PATH,
+):
+    """
+    :param rpkm: RPKM values, indexed by gene ID
+    :param summary: Summary Series from `summarize_counts`
+    :param read_counts: Read counts from which `rpkm` was computed, which
+        are saved instead in the binary format
+    """
+    if output_format == 'csv':
+        filename = f'{sample_name}{CSV_SUFFIX}'
+
+        rpkm_dir = output_path / RPKM_DIRECTORY_NAME
+        summary_dir = output_path / SUMMARY_DIRECTORY_NAME
+
+        rpkm.to_csv(rpkm_dir / filename)
+        summary.to_csv(summary_dir / filename)
+    elif output_format == 'binary':
+        gene_length = load_gene_index().gene_length_series
+        if not rpkm.index.equals(gene_length.index):
+            raise ValueError(f'Genes in RPKM values for {sample_name} do not match the gene index')
+
+        binary_dir = output_path / BINARY_DIRECTORY_NAME
+        binary_dir.mkdir(parents=True, exist_ok=True)
+        hash_value = save_annotation(binary_dir, gene_length)
+        path = binary_dir / f'{sample_name}{BINARY_SUFFIX}'
+        print('Saving results to', path)
+        write_atomic(path, encode_sample(sample_name, read_counts, summary, hash_value, gene_length))
+    else:
+        raise ValueError(f'Unknown output format: {output_format}')
@@ -0,0 +1,361 @@
+"""
+Placement, byte budgets and cleanup of large intermediate files: FASTQ
+files converted from SRA, and SAM files written by HISAT2.
+
+Each intermediate is written to a directory allocated from a `ScratchSpace`
+with an estimate of the bytes it will hold, computed from the size of its
+input. An allocation waits until its estimate fits in the budget and in the
+free space of the scratch root, so concurrent samples are held back instead
+of filling the disk and failing halfway through. Allocations that fit are
+put on a tmpfs root (e.g. /dev/shm), if one is configured with a budget of
+its own, and on the disk root otherwise.
+
+Allocations are recorded in a ledger file in each root, locked with
+`flock`, so that all processes using the same root share its budget: the
+samples of `--jobs`, pipeline stages, and array tasks running on the same
+node. An allocation ends when its directory is released, which removes the
+directory and everything in it, or when the process that made it exits, in
+which case the directory is removed by the next process to read the
+ledger.
+
+The configuration is kept in an environment variable, so that it applies in
+worker processes and scripts run by this one. If no scratch root is
+configured, intermediate files are written where they always were, next to
+their inputs.
+"""
+from argparse import ArgumentParser, Namespace
+import atexit
+from contextlib import contextmanager
+import fcntl
+from functools import lru_cache
+import json
+import os
+from pathlib import Path
+import shutil
+import socket
+from tempfile import mkdtemp
+from time import sleep
+from typing import Dict, Iterable, Iterator, Optional
+
+from compression import compression_suffix
+from sra_conversion import FASTERQ_DUMP, FASTQ_DUMP, current_configuration
+from utils import normalize_whitespace
+
+SCRATCH_ENVIRONMENT_VARIABLE = 'RNA_SEQ_PIPELINE_SCRATCH'
+LEDGER_FILENAME = '.scratch_ledger.json'
+DEFAULT_TMPFS_ROOT = Path('/dev/shm')
+
+# Rough ratios used to estimate the size of intermediate files from the
+# size of their input. Uncompressed FASTQ is usually 3 to 5 times the size
+# of the SRA file; SAM records hold each read's sequence and qualities,
+# plus alignment fields and tags.
+FASTQ_BYTES_PER_SRA_BYTE = 5
+FASTQ_BYTES_PER_COMPRESSED_BYTE = 4
+SAM_BYTES_PER_FASTQ_BYTE = 1.5
+# fasterq-dump writes temporary files about as large as its output to the
+# output directory (see `sra_conversion`), and removes them before it exits
+CONVERSION_TEMP_BYTES_PER_FASTQ_BYTE = {
+    FASTQ_DUMP: 0,
+    FASTERQ_DUMP: 1,
+}
+
+# Seconds between checks while waiting for space
+POLL_INTERVAL = 1
+
+GIGABYTE = 2 ** 30
+
+def add_scratch_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--scratch-root',
+        type=Path,
+        help=normalize_whitespace(
+            """
+            Directory for intermediate FASTQ and SAM files, shared with other
+            processes using the same directory. New work waits until the
+            estimated size of its intermediate files fits in --scratch-budget-gb
+            and in the free space of this directory. If omitted, intermediate
+            files are written next to their inputs, without any limit.
+            """
+        ),
+    )
+    p.add_argument(
+        '--scratch-budget-gb',
+        type=float,
+        help=normalize_whitespace(
+            """
+            Maximum total estimated size of intermediate files in --scratch-root,
+            in GiB. Default: limited only by free space.
+            """
+        ),
+    )
+    p.add_argument(
+        '--scratch-tmpfs-budget-gb',
+        type=float,
+        help=normalize_whitespace(
+            """
+            Put intermediate files in --scratch-tmpfs-root instead, if their
+            estimated size fits in this many GiB. Files in tmpfs are held in
+            memory, which counts against SLURM memory limits. Default: tmpfs
+            is not used.
+            """
+        ),
+    )
+    p.add_argument(
+        '--scratch-tmpfs-root',
+        type=Path,
+        default=DEFAULT_TMPFS_ROOT,
+        help=f'Directory on a tmpfs file system. Default: {DEFAULT_TMPFS_ROOT}',
+    )
+
+def configure_scratch(args: Namespace):
+    """
+    Applies the options of `add_scratch_command_line_arguments` to this
+    process and any processes it starts.
+    """
+    if args.scratch_root is None:
+        return
+    configure(
+        root=args.scratch_root,
+        budget_bytes=None if args.scratch_budget_gb is None else int(args.scratch_budget_gb * GIGABYTE),
+        tmpfs_root=None if args.scratch_tmpfs_budget_gb is None else args.scratch_tmpfs_root,
+        tmpfs_budget_bytes=None if args.scratch_tmpfs_budget_gb is None else int(args.scratch_tmpfs_budget_gb * GIGABYTE),
+    )
+
+def configure(
+        root: Path,
+        budget_bytes: Optional[int]=None,
+        tmpfs_root: Optional[Path]=None,
+        tmpfs_budget_bytes: Optional[int]=None,
+):
+    os.environ[SCRATCH_ENVIRONMENT_VARIABLE] = json.dumps(
+        {
+            'root': str(root.absolute()),
+            'budget_bytes': budget_bytes,
+            'tmpfs_root': None if tmpfs_root is None else str(tmpfs_root.absolute()),
+            'tmpfs_budget_bytes': tmpfs_budget_bytes,
+        }
+    )
+
+def current() -> Optional['ScratchSpace']:
+    """
+    :return: Scratch space configured for this process, or None if
+        intermediate files should be written next to their inputs
+    """
+    configuration = os.environ.get(SCRATCH_ENVIRONMENT_VARIABLE)
+    if not configuration:
+        return None
+    return _scratch_space(configuration)
+
+@lru_cache(maxsize=None)
+def _scratch_space(configuration: str) -> 'ScratchSpace':
+    values = json.loads(configuration)
+    return ScratchSpace(
+        root=Path(values['root']),
+        budget_bytes=values['budget_bytes'],
+        tmpfs_root=None if values['tmpfs_root'] is None else Path(values['tmpfs_root']),
+        tmpfs_budget_bytes=values['tmpfs_budget_bytes'],
+    )
+
+def input_bytes(path: Path) -> int:
+    """
+    :return: Size of `path`, or 0 if it isn't a regular file, e.g. a named
+        pipe
+    """
+    return path.stat().st_size if path.is_file() else 0
+
+def estimate_fastq_bytes(sra_path: Path) -> int:
+    return int(input_bytes(sra_path) * FASTQ_BYTES_PER_SRA_BYTE)
+
+def estimate_sra_bytes(sra_path: Path, fastq: bool=True, sam: bool=True) -> int:
+    """
+    :param fastq: Whether FASTQ files are converted from `sra_path` into the
+        scratch directory, with the configured converter
+    :param sam: Whether the SAM file aligned from these is also written there
+    :return: Peak size of these intermediate files. Temporary files of the
+        converter are removed before alignment starts, so these only add to
+        the estimate if they're larger than the SAM file.
+    """
+    fastq_bytes = estimate_fastq_bytes(sra_path)
+    sam_bytes = int(fastq_bytes * SAM_BYTES_PER_FASTQ_BYTE) if sam else 0
+    if not fastq:
+        return sam_bytes
+    converter = current_configuration()['converter']
+    temp_bytes = int(fastq_bytes * CONVERSION_TEMP_BYTES_PER_FASTQ_BYTE[converter])
+    return fastq_bytes + max(temp_bytes, sam_bytes)
+
+def estimate_sam_bytes(fastq_paths: Iterable[Path]) -> int:
+    """
+    :param fastq_paths: FASTQ files, optionally compressed
+    """
+    fastq_bytes = 0
+    for path in fastq_paths:
+        factor = FASTQ_BYTES_PER_COMPRESSED_BYTE if compression_suffix(path) else 1
+        fastq_bytes += input_bytes(path) * factor
+    return int(fastq_bytes * SAM_BYTES_PER_FASTQ_BYTE)
+
+def release_directories(paths: Iterable[Path]):
+    """
+    Releases the scratch directories containing any of `paths`, if these
+    were allocated by this process; e.g. after removing the files in them.
+    """
+    space = current()
+    if space is None:
+        return
+    for directory in {path.parent for path in paths}:
+        if directory in space.allocated:
+            space.release(directory)
+
+def directory_bytes(directory: Path) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class ScratchRoot:
+    """
+    One directory with a byte budget, and a ledger of the allocations made
+    in it by all processes.
+    """
+    def __init__(self, path: Path, budget_bytes: Optional[int]):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ledger_path = self.path / LEDGER_FILENAME
+        self.hostname = socket.gethostname()
+
+    @contextmanager
+    def ledger(self) -> Iterator[Dict[str, Dict]]:
+        """
+        Yields the allocations in this root, by directory, without those of
+        processes on this host that have exited (whose directories are
+        removed). Changes made in the `with` block are saved.
+        """
+        with open(self.ledger_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            contents = f.read()
+            allocations = json.loads(contents) if contents else {}
+            for directory, allocation in list(allocations.items()):
+                if allocation['hostname'] == self.hostname and not process_exists(allocation['pid']):
+                    print('Removing scratch directory of exited process', allocation['pid'], directory)
+                    shutil.rmtree(directory, ignore_errors=True)
+                    del allocations[directory]
+                elif not Path(directory).is_dir():
+                    del allocations[directory]
+            yield allocations
+            f.seek(0)
+            f.truncate()
+            json.dump(allocations, f)
+
+    def try_allocate(self, estimated_bytes: int, prefix: str, fit_alone: bool) -> Optional[Path]:
+        """
+        :param fit_alone: Whether to allocate regardless of space if there are
+            no other allocations in this root, which nothing would free
+        :return: New directory, or None if `estimated_bytes` doesn't fit now
+        """
+        with self.ledger() as allocations:
+            reserved = sum(allocation['bytes'] for allocation in allocations.values())
+            # Bytes that have been reserved but not written yet
+            unwritten = sum(
+                max(allocation['bytes'] - directory_bytes(Path(directory)), 0)
+                for directory, allocation in allocations.items()
+            )
+            available = shutil.disk_usage(self.path).free - unwritten
+            if self.budget_bytes is not None:
+                available = min(available, self.budget_bytes - reserved)
+            if estimated_bytes > available and not (fit_alone and not allocations):
+                return None
+            directory = Path(mkdtemp(prefix=prefix, dir=self.path))
+            allocations[str(directory)] = {
+                'hostname': self.hostname,
+                'pid': os.getpid(),
+                'bytes': estimated_bytes,
+            }
+            return directory
+
+    def release(self, directory: Path):
+        shutil.rmtree(directory, ignore_errors=True)
+        with self.ledger() as allocations:
+            allocations.pop(str(directory), None)
+
+class ScratchSpace:
+    def __init__(
+            self,
+            root: Path,
+            budget_bytes: Optional[int]=None,
+            tmpfs_root: Optional[Path]=None,
+            tmpfs_budget_bytes: Optional[int]=None,
+    ):
+        """
+        :param budget_bytes: Maximum total of the estimates of all allocations
+            in `root`; if None, only limited by free space
+        :param tmpfs_root: Used instead of `root` for allocations that fit in
+            `tmpfs_budget_bytes`
+        """
+        self.root = ScratchRoot(root, budget_bytes)
+        self.tmpfs_root = None
+        if tmpfs_root is not None and tmpfs_budget_bytes:
+            self.tmpfs_root = ScratchRoot(tmpfs_root, tmpfs_budget_bytes)
+        # Directories allocated by this process, and the root of each
+        self.allocated: Dict[Path, ScratchRoot] = {}
+        atexit.register(self.release_all)
+
+    def allocate(self, estimated_bytes: int, prefix: str='scratch_') -> Path:
+        """
+        Waits until `estimated_bytes` fit in a scratch root, then creates a
+        directory there. Release it with `release` when its contents are no
+        longer needed.
+        """
+        waiting = False
+        while True:
+            directory = None
+            scratch_root = self.tmpfs_root
+            if scratch_root is not None:
+                directory = scratch_root.try_allocate(estimated_bytes, prefix, fit_alone=False)
+            if directory is None:
+                scratch_root = self.root
+                directory = scratch_root.try_allocate(estimated_bytes, prefix, fit_alone=True)
+            if directory is not None:
+                self.allocated[directory] = scratch_root
+                return directory
+            if not waiting:
+                print(f'Waiting for {estimated_bytes / GIGABYTE:.2f} GiB of scratch space in {self.root.path}')
+                waiting = True
+            sleep(POLL_INTERVAL)
+
+    def release(self, directory: Path):
+        """
+        Removes `directory` and its contents, and frees its allocation.
+        """
+        scratch_root = self.allocated.pop(directory, None)
+        if scratch_root is not None:
+            scratch_root.release(directory)
+
+    def release_all(self):
+        for directory in list(self.allocated):
+            self.release(directory)
+
+    @contextmanager
+    def directory(self, estimated_bytes: int, prefix: str='scratch_') -> Iterator[Path]:
+        """
+        Allocates a directory for the duration of the `with` block, removing
+        it afterward even if the block raises an exception.
+        """
+        directory = self.allocate(estimated_bytes, prefix)
+        try:
+            yield directory
+        finally:
+            self.release(directory)
@@ -0,0 +1,235 @@
+"""
+Sparse expression matrices in HDF5 files.
+
+Most genes have no reads in any single cell, so a dense samples-by-genes
+matrix is almost entirely zeros. This module stores a matrix in compressed
+sparse row (CSR) form, one row per sample, as a group of PyTables arrays:
+
+* `data`: nonzero values, row by row
+* `indices`: column (gene) index of each value in `data`
+* `indptr`: row `i` is stored in `data[indptr[i]:indptr[i + 1]]`
+* `row_names`, `row_name_indptr`: UTF-8 encoded sample names, concatenated;
+  name `i` is `row_names[row_name_indptr[i]:row_name_indptr[i + 1]]`
+* `column_names`: gene IDs
+
+All arrays except `column_names` are extendable, chunked and compressed,
+so rows can be appended one at a time, without ever holding the dense
+matrix in memory. NaN values (e.g. RPKM of a sample with no reads) are
+stored explicitly, so a loaded matrix is identical to the dense one.
+
+These groups can live in the same file as data frames written by
+`pd.HDFStore`, which ignores them.
+"""
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import tables
+
+SPARSE_FORMAT = 'csr'
+
+COMPRESSION_FILTERS = tables.Filters(complevel=5, complib='zlib', shuffle=True)
+
+# Hint for PyTables' choice of chunk size
+EXPECTED_NONZERO_VALUES = 10 ** 8
+EXPECTED_ROWS = 10 ** 5
+
+class SparseMatrixWriter:
+    def __init__(
+            self,
+            h5_file: tables.File,
+            group_path: str,
+            column_names: pd.Index,
+            dtype=np.float64,
+    ):
+        """
+        Creates an empty sparse matrix in `group_path`, or opens an existing
+        one to append more rows.
+
+        :param column_names: Column labels, which each appended row must match
+        :raises ValueError: If `group_path` already contains a matrix with
+            different columns
+        """
+        self.h5_file = h5_file
+        self.group_path = group_path
+        self.column_names = pd.Index(column_names)
+
+        if group_path in h5_file:
+            self.group = h5_file.get_node(group_path)
+            existing_columns = pd.Index(self.group.column_names.read().astype(str))
+            if not existing_columns.equals(self.column_names.astype(str)):
+                raise ValueError(f'Columns of sparse matrix in {group_path} do not match new rows')
+        else:
+            parent, name = group_path.rstrip('/').rsplit('/', 1)
+            self.group = h5_file.create_group(parent or '/', name, createparents=True)
+            self.group._v_attrs.format = SPARSE_FORMAT
+            h5_file.create_array(
+                self.group,
+                'column_names',
+                np.array(self.column_names.astype(str), dtype=bytes),
+            )
+            h5_file.create_earray(
+                self.group,
+                'data',
+                atom=tables.Atom.from_dtype(np.dtype(dtype)),
+                shape=(0,),
+                filters=COMPRESSION_FILTERS,
+                expectedrows=EXPECTED_NONZERO_VALUES,
+            )
+            h5_file.create_earray(
+                self.group,
+                'indices',
+                atom=tables.Int32Atom(),
+                shape=(0,),
+                filters=COMPRESSION_FILTERS,
+                expectedrows=EXPECTED_NONZERO_VALUES,
+            )
+            indptr = h5_file.create_earray(
+                self.group,
+                'indptr',
+                atom=tables.Int64Atom(),
+                shape=(0,),
+                filters=COMPRESSION_FILTERS,
+                expectedrows=EXPECTED_ROWS,
+            )
+            indptr.append(np.zeros(1, dtype=np.int64))
+            h5_file.create_earray(
+                self.group,
+                'row_names',
+                atom=tables.UInt8Atom(),
+                shape=(0,),
+                filters=COMPRESSION_FILTERS,
+                expectedrows=EXPECTED_ROWS,
+            )
+            row_name_indptr = h5_file.create_earray(
+                self.group,
+                'row_name_indptr',
+                atom=tables.Int64Atom(),
+                shape=(0,),
+                filters=COMPRESSION_FILTERS,
+                expectedrows=EXPECTED_ROWS,
+            )
+            row_name_indptr.append(np.zeros(1, dtype=np.int64))
+
+        self.row_count = len(self.group.indptr) - 1
+        self.nonzero_count = int(self.group.indptr[-1])
+        # Discard anything appended after the last complete row, e.g. if
+        # the writing process was killed
+        self.group.data.truncate(self.nonzero_count)
+        self.group.indices.truncate(self.nonzero_count)
+        self.group.row_name_indptr.truncate(self.row_count + 1)
+        self.group.row_names.truncate(self.group.row_name_indptr[-1])
+
+    def append_sparse_row(self, row_name: str, indices: np.ndarray, values: np.ndarray):
+        """
+        :param indices: Column indices of `values`, in increasing order
+        """
+        self.group.data.append(values)
+        self.group.indices.append(indices.astype(np.int32))
+        encoded_name = np.frombuffer(row_name.encode('utf-8'), dtype=np.uint8)
+        self.group.row_names.append(encoded_name)
+        self.group.row_name_indptr.append(
+            np.array([self.group.row_names.nrows], dtype=np.int64)
+        )
+        self.nonzero_count += len(values)
+        self.row_count += 1
+        # Appended last, since this marks the row as complete
+        self.group.indptr.append(np.array([self.nonzero_count], dtype=np.int64))
+
+    def append_rows(self, row_names: List[str], indptr: np.ndarray, indices: np.ndarray, values: np.ndarray):
+        """
+        Appends many rows at once, given in CSR form.
+
+        :param indptr: Row `i` is `values[indptr[i]:indptr[i + 1]]`; starts
+            with 0
+        """
+        encoded_names = [row_name.encode('utf-8') for row_name in row_names]
+        name_ends = np.cumsum([len(name) for name in encoded_names], dtype=np.int64)
+        self.group.data.append(values)
+        self.group.indices.append(indices.astype(np.int32))
+        self.group.row_names.append(np.frombuffer(b''.join(encoded_names), dtype=np.uint8))
+        self.group.row_name_indptr.append(name_ends + self.group.row_name_indptr[-1])
+        self.group.indptr.append(np.asarray(indptr[1:], dtype=np.int64) + self.nonzero_count)
+        self.nonzero_count += int(indptr[-1])
+        self.row_count += len(row_names)
+
+    def append_row(self, row_name: str, row: pd.Series):
+        """
+        :raises ValueError: If the index of `row` doesn't match the columns
+            of the matrix
+        """
+        if not row.index.equals(self.column_names):
+            raise ValueError(f'Index of row {row_name} does not match columns of sparse matrix')
+        values = row.to_numpy(dtype=self.group.data.dtype)
+        # NaN != 0, so NaN values are kept
+        indices = np.flatnonzero(values != 0)
+        self.append_sparse_row(row_name, indices, values[indices])
+
+class SparseMatrixReader:
+    def __init__(self, h5_file: tables.File, group_path: str):
+        self.group = h5_file.get_node(group_path)
+        if self.group._v_attrs.format != SPARSE_FORMAT:
+            raise ValueError(f'Unsupported sparse matrix format {self.group._v_attrs.format!r}')
+        self.indptr = self.group.indptr.read()
+        # Rows are complete once their end is appended to `indptr`; anything
+        # after that was left by an interrupted write
+        self.row_count = len(self.indptr) - 1
+
+    def row_names(self) -> List[str]:
+        row_name_indptr = self.group.row_name_indptr.read(0, self.row_count + 1)
+        encoded_names = self.group.row_names.read(0, row_name_indptr[-1]).tobytes()
+        return [
+            encoded_names[start:stop].decode('utf-8')
+            for start, stop in zip(row_name_indptr[:-1], row_name_indptr[1:])
+        ]
+
+    def column_names(self) -> pd.Index:
+        return pd.Index(self.group.column_names.read().astype(str))
+
+    def row(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: 2-tuple: column indices and values of nonzero entries in row `i`
+        """
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return self.group.indices.read(start, stop), self.group.data.read(start, stop)
+
+    def to_csr(self):
+        """
+        :return: `scipy.sparse.csr_matrix`
+        """
+        # SciPy is only needed to load sparse matrices, not to write them
+        from scipy.sparse import csr_matrix
+
+        stop = self.indptr[-1]
+        return csr_matrix(
+            (
+                self.group.data.read(0, stop),
+                self.group.indices.read(0, stop),
+                self.indptr,
+            ),
+            shape=(self.row_count, len(self.group.column_names)),
+        )
+
+def load_sparse_matrix(path: Path, group_path: str):
+    """
+    :return: 3-tuple: `scipy.sparse.csr_matrix`, list of row names, and
+        Index of column names
+    """
+    with tables.open_file(str(path), mode='r') as h5_file:
+        reader = SparseMatrixReader(h5_file, group_path)
+        return reader.to_csr(), reader.row_names(), reader.column_names()
+
+def load_sparse_frame(path: Path, group_path: str) -> pd.DataFrame:
+    """
+    :return: DataFrame with sparse columns, indexed by row name
+    """
+    matrix, row_names, column_names = load_sparse_matrix(path, group_path)
+    # Not DataFrame.sparse.from_spmatrix, which uses NaN as the fill value
+    # for floating point data, turning every missing value into NaN
+    matrix = matrix.tocsc()
+    columns = {
+        column_name: pd.arrays.SparseArray.from_spmatrix(matrix[:, [i]])
+        for i, column_name in enumerate(column_names)
+    }
+    return pd.DataFrame(columns, index=row_names)
@@ -0,0 +1,274 @@
+"""
+Conversion of SRA files to FASTQ.
+
+Two converters are available:
+
+* 'fastq-dump' (default): single-threaded. Whether a run is paired-end has
+  to be known before converting it, to pass `--split-files`; this is read
+  from run metadata if available, otherwise from a probe that converts one
+  spot.
+* 'fasterq-dump': multi-threaded, with `--threads` taken from the number of
+  cores for each sample (`--subprocesses`). Paired-end runs are split into
+  '_1' and '_2' files, so the layout is read from the files it creates and
+  no probe is needed. Reads without a mate in paired-end runs are
+  discarded.
+
+Run metadata is a CSV or tab-separated table with 'Run' and 'LibraryLayout'
+columns, e.g. from the SRA Run Selector; the same table can be used for
+`cluster_scheduling.py --metadata-file`.
+
+The converter is configured once per process, with `configure_sra_conversion`,
+and is kept in an environment variable so it applies in worker processes
+too.
+"""
+from argparse import ArgumentParser, Namespace
+from functools import lru_cache
+import json
+import os
+from pathlib import Path
+from subprocess import check_call, check_output
+from typing import Dict, List, Optional
+
+from data_path_utils import append_to_filename
+import pandas as pd
+
+from paths import FASTERQ_DUMP_PATH, FASTQ_DUMP_PATH
+import telemetry
+from utils import normalize_whitespace
+
+SRA_CONVERSION_ENVIRONMENT_VARIABLE = 'RNA_SEQ_PIPELINE_SRA_CONVERSION'
+
+FASTQ_DUMP = 'fastq-dump'
+FASTERQ_DUMP = 'fasterq-dump'
+CONVERTERS = [FASTQ_DUMP, FASTERQ_DUMP]
+
+# Column names in SRA run metadata tables, from the Run Selector
+# ('SraRunTable.txt') or the RunInfo CSV
+SRR_ID_COLUMN = 'Run'
+LIBRARY_LAYOUT_COLUMN = 'LibraryLayout'
+
+# Bytes read at a time when counting reads in a FASTQ file
+READ_CHUNK_SIZE = 2 ** 24
+
+FASTQ_TEST_COMMAND_TEMPLATE = [
+    '{fastq_dump_command}',
+    '-X',
+    '1',
+    '-Z',
+    '--split-spot',
+    '{input_path}'
+]
+
+FASTQ_CONVERT_COMMAND_TEMPLATE = [
+    '{fastq_dump_command}',
+    '{input_path}',
+    '-O',
+    '{output_path}',
+]
+
+FASTERQ_CONVERT_COMMAND_TEMPLATE = [
+    '{fasterq_dump_command}',
+    '{input_path}',
+    '--outdir',
+    '{output_path}',
+    # Temporary files are about as large as the output; keep them with it
+    '--temp',
+    '{output_path}',
+    '--threads',
+    '{threads}',
+    '--split-3',
+]
+
+def add_sra_conversion_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--sra-converter',
+        choices=CONVERTERS,
+        default=FASTQ_DUMP,
+        help=normalize_whitespace(
+            f"""
+            Program to convert SRA files to FASTQ. {FASTERQ_DUMP} uses --subprocesses
+            threads, and doesn't need a separate process to detect paired-end runs.
+            --fastq-fifo always uses {FASTQ_DUMP}, which can write to named pipes.
+            Default: {FASTQ_DUMP}
+            """
+        ),
+    )
+    p.add_argument(
+        '--sra-metadata-file',
+        type=Path,
+        help=normalize_whitespace(
+            f"""
+            CSV or tab-separated table of SRA run metadata with '{SRR_ID_COLUMN}' and
+            '{LIBRARY_LAYOUT_COLUMN}' columns, e.g. from the SRA Run Selector. For
+            SRR IDs in the table, paired-end runs are recognized without running
+            {FASTQ_DUMP} on one spot first.
+            """
+        ),
+    )
+
+def configure_sra_conversion(args: Namespace):
+    """
+    Applies the options of `add_sra_conversion_command_line_arguments` to this
+    process and any processes it starts. Call after
+    `parallel.resolve_parallel_arguments`, if used, so that fasterq-dump
+    gets the number of cores for each sample.
+    """
+    os.environ[SRA_CONVERSION_ENVIRONMENT_VARIABLE] = json.dumps(
+        {
+            'converter': args.sra_converter,
+            'threads': args.subprocesses,
+            'metadata_file': None if args.sra_metadata_file is None else str(args.sra_metadata_file.absolute()),
+        }
+    )
+
+def current_configuration() -> Dict:
+    configuration = os.environ.get(SRA_CONVERSION_ENVIRONMENT_VARIABLE)
+    if not configuration:
+        return {'converter': FASTQ_DUMP, 'threads': 1, 'metadata_file': None}
+    return json.loads(configuration)
+
+def active_converter(fastq_fifo: bool=False) -> str:
+    """
+    :param fastq_fifo: Whether FASTQ data is streamed through named pipes,
+        which only fastq-dump can write to
+    :return: Program that converts SRA files to FASTQ
+    """
+    if fastq_fifo:
+        return FASTQ_DUMP
+    return current_configuration()['converter']
+
+@lru_cache(maxsize=None)
+def read_library_layouts(metadata_file: Path) -> Dict[str, bool]:
+    """
+    :return: Whether each SRR ID in the table is paired-end
+    """
+    metadata = pd.read_csv(metadata_file, sep=None, engine='python')
+    for column in [SRR_ID_COLUMN, LIBRARY_LAYOUT_COLUMN]:
+        if column not in metadata.columns:
+            raise ValueError(f'No {column!r} column in {metadata_file}')
+    paired = metadata[LIBRARY_LAYOUT_COLUMN].astype(str).str.upper() == 'PAIRED'
+    return dict(zip(metadata[SRR_ID_COLUMN], paired))
+
+def known_layout(sra_path: Path) -> Optional[bool]:
+    """
+    :return: Whether `sra_path` is paired-end according to the configured
+        run metadata, or None if unknown
+    """
+    metadata_file = current_configuration()['metadata_file']
+    if metadata_file is None:
+        return None
+    return read_library_layouts(Path(metadata_file)).get(sra_path.stem)
+
+def is_paired_sra(sra_path: Path) -> bool:
+    paired = known_layout(sra_path)
+    if paired is not None:
+        return paired
+
+    try:
+        fastq_command = [
+            piece.format(
+                fastq_dump_command=FASTQ_DUMP_PATH,
+                input_path=sra_path
+            )
+            for piece in FASTQ_TEST_COMMAND_TEMPLATE
+        ]
+        print('Running', ' '.join(fastq_command))
+        with telemetry.stage('detect_sra_layout'):
+            contents = check_output(telemetry.instrument(fastq_command, 'fastq-dump')).decode('utf-8')
+    except Exception as e:
+        raise Exception(f"Error running fastq-dump on {sra_path}") from e
+    newline = '\n'
+    if contents.count(newline) == 4:
+        return False
+    elif contents.count(newline) == 8:
+        return True
+    else:
+        raise ValueError(f'Unexpected output from {FASTQ_DUMP_PATH.name} on {sra_path}:\n{contents!r}')
+
+def convert_with_fastq_dump(sra_path: Path, scratch_dir: Path) -> List[Path]:
+    fastq_command = [
+            piece.format(
+                fastq_dump_command=FASTQ_DUMP_PATH,
+                input_path=sra_path,
+                output_path=scratch_dir,
+            )
+            for piece in FASTQ_CONVERT_COMMAND_TEMPLATE
+        ]
+
+    paired_end = is_paired_sra(sra_path)
+
+    if paired_end:
+        fastq_command.append('--split-files')
+
+    print('Running', ' '.join(fastq_command))
+    with telemetry.stage('convert_sra_to_fastq'):
+        check_call(telemetry.instrument(fastq_command, 'fastq-dump'))
+
+    if paired_end:
+        fastq_path_1 = append_to_filename(scratch_dir / sra_path.with_suffix('.fastq').name, '_1')
+        fastq_path_2 = append_to_filename(scratch_dir / sra_path.with_suffix('.fastq').name, '_2')
+        fastq_paths = [fastq_path_1, fastq_path_2]
+    else:
+        fastq_paths = [scratch_dir / sra_path.with_suffix('.fastq').name]
+
+    return fastq_paths
+
+def count_fastq_reads(fastq_path: Path) -> int:
+    lines = 0
+    with open(fastq_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            lines += chunk.count(b'\n')
+    return lines // 4
+
+def convert_with_fasterq_dump(sra_path: Path, scratch_dir: Path, threads: int) -> List[Path]:
+    """
+    With `--split-3`, fasterq-dump writes both reads of each paired spot to
+    '_1' and '_2' files, and reads without a mate to a file without a
+    suffix, which is the only file for single-end runs. Reads without a mate
+    in paired-end runs are discarded, and their number is reported, since
+    HISAT2 aligns all reads of one run in the same mode. This differs from
+    `fastq-dump --split-files`, which writes the read of each single-read
+    spot to the '_1' file, along with the first reads of paired spots.
+    """
+    fastq_command = [
+        piece.format(
+            fasterq_dump_command=FASTERQ_DUMP_PATH,
+            input_path=sra_path,
+            output_path=scratch_dir,
+            threads=threads,
+        )
+        for piece in FASTERQ_CONVERT_COMMAND_TEMPLATE
+    ]
+    print('Running', ' '.join(fastq_command))
+    with telemetry.stage('convert_sra_to_fastq'):
+        check_call(telemetry.instrument(fastq_command, 'fasterq-dump'))
+
+    unpaired_path = scratch_dir / sra_path.with_suffix('.fastq').name
+    paired_paths = [append_to_filename(unpaired_path, suffix) for suffix in ['_1', '_2']]
+    if all(path.is_file() for path in paired_paths):
+        if unpaired_path.is_file():
+            print(f'Discarding {count_fastq_reads(unpaired_path)} reads without a mate in', unpaired_path)
+            unpaired_path.unlink()
+        return paired_paths
+    if unpaired_path.is_file():
+        return [unpaired_path]
+    if paired_paths[0].is_file():
+        return paired_paths[:1]
+    raise ValueError(f'No FASTQ files from {FASTERQ_DUMP_PATH.name} for {sra_path} in {scratch_dir}')
+
+def convert_sra_to_fastq(sra_path: Path, scratch_dir: Optional[Path]=None) -> List[Path]:
+    """
+    :param sra_path:
+    :param scratch_dir: Directory where the FASTQ file will be stored, with
+        the same name as the SRA file. If omitted, the FASTQ file will be
+        written to the same directory as the SRA file.
+    :return: A List of fastq Paths. Contains one Path if single-end,
+        two if paired-end.
+    """
+    if scratch_dir is None:
+        scratch_dir = sra_path.parent
+
+    configuration = current_configuration()
+    if configuration['converter'] == FASTERQ_DUMP:
+        return convert_with_fasterq_dump(sra_path, scratch_dir, configuration['threads'])
+    return convert_with_fastq_dump(sra_path, scratch_dir)
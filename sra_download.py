@@ -0,0 +1,232 @@
+"""
+Downloading SRA files, with retries, and ahead of time for runs that
+process several SRR IDs one after another.
+
+The fetch command is a template, `prefetch {srr_id}` by default, so that
+any program that leaves `{srr_id}.sra` in the `sra` subdirectory of the
+NCBI download location (see `ncbi_sra_toolkit_config`) can be used instead,
+e.g. `cp /archive/{srr_id}.sra {output_path}` to test without network
+access.
+
+`Prefetcher` downloads the next few SRR IDs in a background thread while
+the current one is converted and aligned, so the transfer time of each SRR
+ID after the first overlaps with computation.
+"""
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+import shlex
+from subprocess import CalledProcessError, check_call
+from threading import Condition, Thread
+from time import sleep
+from typing import Dict, List, Optional
+
+from ncbi_sra_toolkit_config import get_ncbi_download_path
+import telemetry
+from utils import normalize_whitespace
+
+DEFAULT_FETCH_COMMAND = 'prefetch {srr_id}'
+DEFAULT_RETRIES = 3
+# Seconds before the first retry, doubled before each later one
+RETRY_DELAY = 10
+DEFAULT_LOOKAHEAD = 1
+
+GIGABYTE = 2 ** 30
+
+def add_download_command_line_arguments(p: ArgumentParser, lookahead: bool=True):
+    """
+    :param lookahead: Whether to add options for downloading ahead, for
+        scripts that process several SRR IDs
+    """
+    p.add_argument(
+        '--fetch-command',
+        default=DEFAULT_FETCH_COMMAND,
+        help=normalize_whitespace(
+            f"""
+            Command to download one SRR ID, with '{{srr_id}}' replaced by the SRR
+            ID, '{{output_path}}' by the path of the SRA file it must create, and
+            '{{download_dir}}' by the directory containing that file.
+            Default: '{DEFAULT_FETCH_COMMAND}'
+            """
+        ),
+    )
+    p.add_argument(
+        '--download-retries',
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=normalize_whitespace(
+            f"""
+            Number of times to retry a failed download, waiting {RETRY_DELAY}
+            seconds before the first retry and twice as long before each later
+            one. Default: {DEFAULT_RETRIES}
+            """
+        ),
+    )
+    if not lookahead:
+        return
+    p.add_argument(
+        '--download-lookahead',
+        type=int,
+        default=DEFAULT_LOOKAHEAD,
+        help=normalize_whitespace(
+            f"""
+            Number of SRR IDs to download in the background, ahead of the one
+            being processed. 0 downloads each SRR ID just before processing it.
+            Default: {DEFAULT_LOOKAHEAD}
+            """
+        ),
+    )
+    p.add_argument(
+        '--download-budget-gb',
+        type=float,
+        help=normalize_whitespace(
+            """
+            Don't start downloading ahead while SRA files totaling at least this
+            many GiB are waiting to be processed, including the current one.
+            Default: no limit besides --download-lookahead.
+            """
+        ),
+    )
+
+class SraDownloader:
+    def __init__(self, fetch_command: str=DEFAULT_FETCH_COMMAND, retries: int=DEFAULT_RETRIES):
+        self.fetch_command = shlex.split(fetch_command)
+        self.retries = retries
+        self._download_dir: Optional[Path] = None
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> 'SraDownloader':
+        return cls(args.fetch_command, args.download_retries)
+
+    @property
+    def download_dir(self) -> Path:
+        # Read once, not for every SRR ID
+        if self._download_dir is None:
+            self._download_dir = get_ncbi_download_path() / 'sra'
+        return self._download_dir
+
+    def download(self, srr_id: str) -> Path:
+        """
+        Runs the fetch command, retrying if it fails or doesn't create the
+        expected file.
+
+        :return: Path to the downloaded SRA file
+        """
+        downloaded_path = self.download_dir / f'{srr_id}.sra'
+        command = [
+            piece.format(
+                srr_id=srr_id,
+                output_path=downloaded_path,
+                download_dir=self.download_dir,
+            )
+            for piece in self.fetch_command
+        ]
+        for attempt in range(self.retries + 1):
+            try:
+                print('Running', ' '.join(command))
+                with telemetry.stage('download'):
+                    check_call(telemetry.instrument(command))
+                if not downloaded_path.is_file():
+                    raise EnvironmentError(
+                        f'Download of {srr_id} reported success, but no file {downloaded_path} exists'
+                    )
+                return downloaded_path
+            except (CalledProcessError, EnvironmentError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = RETRY_DELAY * 2 ** attempt
+                print(f'Download of {srr_id} failed ({e}); retrying in {delay} seconds')
+                sleep(delay)
+
+class Prefetcher:
+    """
+    Downloads SRR IDs in order in a background thread, at most `lookahead`
+    ahead of the SRR ID being processed. Each SRR ID must be requested with
+    `get`, in order; requesting one means that earlier ones are finished,
+    and their SRA files deleted.
+
+    Use as a context manager; leaving the `with` block stops downloading and
+    deletes any SRA files that were downloaded but not requested.
+    """
+    def __init__(
+            self,
+            srr_ids: List[str],
+            downloader: SraDownloader,
+            lookahead: int=DEFAULT_LOOKAHEAD,
+            budget_bytes: Optional[int]=None,
+    ):
+        self.srr_ids = srr_ids
+        self.downloader = downloader
+        self.lookahead = lookahead
+        self.budget_bytes = budget_bytes
+        # Position of the SRR ID being processed
+        self.current = -1
+        # Outcome of each finished download, by position: path or exception
+        self.results: Dict[int, object] = {}
+        # Sizes of downloaded files that haven't been processed yet
+        self.held_bytes: Dict[int, int] = {}
+        self.stopped = False
+        self.condition = Condition()
+        self.thread = Thread(target=self._download_all, name='prefetch', daemon=True)
+
+    def __enter__(self):
+        # Fail early in the calling thread if the download location is unknown
+        self.downloader.download_dir
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _may_start(self, i: int) -> bool:
+        if i > self.current + self.lookahead:
+            return False
+        if self.budget_bytes is None or not self.held_bytes:
+            return True
+        return sum(self.held_bytes.values()) < self.budget_bytes
+
+    def _download_all(self):
+        for i, srr_id in enumerate(self.srr_ids):
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self._may_start(i))
+                if self.stopped:
+                    return
+            try:
+                result = self.downloader.download(srr_id)
+            except Exception as e:
+                result = e
+            with self.condition:
+                self.results[i] = result
+                if isinstance(result, Path):
+                    self.held_bytes[i] = result.stat().st_size
+                self.condition.notify_all()
+
+    def get(self, srr_id: str) -> Path:
+        """
+        Waits for the download of `srr_id`, the next SRR ID in the list.
+
+        :return: Path to the downloaded SRA file
+        """
+        with self.condition:
+            self.current += 1
+            if self.srr_ids[self.current] != srr_id:
+                raise ValueError(f'Expected SRR ID {self.srr_ids[self.current]}, not {srr_id}')
+            for i in list(self.held_bytes):
+                if i < self.current:
+                    del self.held_bytes[i]
+            self.condition.notify_all()
+            with telemetry.stage('wait_for_download'):
+                self.condition.wait_for(lambda: self.current in self.results)
+            result = self.results.pop(self.current)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        # Let a download in progress finish, so its file can be removed
+        self.thread.join()
+        for result in self.results.values():
+            if isinstance(result, Path) and result.is_file():
+                result.unlink()
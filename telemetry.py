@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing and resource usage for each sample, to find where time
+goes across many samples.
+
+Two kinds of records are collected while a sample is processed:
+
+* 'stage': a step run in this process, e.g. quantification. Records wall
+  time, CPU time of the calling thread, bytes read and written by this
+  process during the stage (including by external programs that finished
+  during the stage), and the peak RSS of this process so far. Bytes and
+  peak RSS are for the whole process, so overlap between stages that run
+  concurrently in different threads, e.g. with `--pipeline`.
+* 'process': an external program, e.g. HISAT2 or fastq-dump. Commands are
+  run through this file as a wrapper script, which waits for the program
+  with `wait4` and saves its wall time, user and system CPU time, peak RSS
+  and bytes read and written, including those of any child processes it
+  waited for (HISAT2 runs the actual aligner as a child process).
+
+Telemetry is only collected inside `recording()`. Otherwise `stage` and
+`instrument` do nothing, so instrumented code behaves exactly as before.
+Records for each sample are saved in a JSON run report, with totals for
+each stage across all samples.
+
+No third-party packages are imported here, so the wrapper script starts
+quickly.
+"""
+from argparse import ArgumentParser, REMAINDER
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+from tempfile import mkdtemp
+import threading
+from time import perf_counter, thread_time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from utils import normalize_whitespace
+
+T = TypeVar('T')
+
+REPORT_SUFFIX = '.telemetry.json'
+# Subdirectory of the output path for scripts that save per-sample files
+TELEMETRY_DIRECTORY_NAME = 'telemetry'
+
+PROC_SELF = Path('/proc/self')
+# Fields of /proc/<pid>/io: bytes passed to read/write system calls, and
+# bytes actually read from or written to storage
+IO_FIELDS = {
+    'rchar': 'read_bytes',
+    'wchar': 'write_bytes',
+    'read_bytes': 'storage_read_bytes',
+    'write_bytes': 'storage_write_bytes',
+}
+# Units of `ru_inblock` and `ru_oublock`, used if /proc is unavailable
+RUSAGE_BLOCK_SIZE = 512
+# `ru_maxrss` is in kilobytes on Linux
+RUSAGE_MAXRSS_UNIT = 1024
+
+FORWARDED_SIGNALS = [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]
+
+NUMERIC_TOTAL_FIELDS = [
+    'wall_seconds',
+    'cpu_seconds',
+    'user_cpu_seconds',
+    'system_cpu_seconds',
+    'read_bytes',
+    'write_bytes',
+    'storage_read_bytes',
+    'storage_write_bytes',
+]
+
+_local = threading.local()
+
+def add_telemetry_command_line_argument(p: ArgumentParser):
+    p.add_argument(
+        '--telemetry',
+        action='store_true',
+        help=normalize_whitespace(
+            f"""
+            Record wall time, CPU time, peak memory and bytes read and written
+            for each processing stage and external program, for each sample,
+            and save them to a JSON report ('*{REPORT_SUFFIX}') next to the
+            output file, or in the '{TELEMETRY_DIRECTORY_NAME}' directory for
+            scripts that save per-sample files.
+            """
+        ),
+    )
+
+def report_path(output_path: Path) -> Path:
+    return output_path.with_suffix(REPORT_SUFFIX)
+
+def sample_report_path(output_path: Path, name: str) -> Path:
+    report_dir = output_path / TELEMETRY_DIRECTORY_NAME
+    report_dir.mkdir(parents=True, exist_ok=True)
+    return report_dir / f'{name}{REPORT_SUFFIX}'
+
+def read_io_counters(pid: str='self') -> Dict[str, int]:
+    """
+    :return: Bytes read and written by a process, from /proc/<pid>/io, or
+        an empty dict if unavailable
+    """
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            fields = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return {}
+    return {name: int(fields[field]) for field, name in IO_FIELDS.items() if field in fields}
+
+def peak_rss_bytes() -> int:
+    """
+    :return: Peak resident set size of this process so far
+    """
+    try:
+        with open(PROC_SELF / 'status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    # Value is in kB
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RUSAGE_MAXRSS_UNIT
+
+class Telemetry:
+    """
+    Records for one sample. Use `recording()` to create one, which makes it
+    available to `stage` and `instrument` in the same thread.
+    """
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        # Reports written by the wrapper script for each external program,
+        # in the order the programs were started
+        self.report_dir: Optional[Path] = None
+        self.process_reports: List[Path] = []
+
+    def add(self, record: Dict[str, Any]):
+        with self.lock:
+            self.records.append(record)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        io_before = read_io_counters()
+        cpu_before = thread_time()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            record = {
+                'type': 'stage',
+                'name': name,
+                'wall_seconds': perf_counter() - start,
+                'cpu_seconds': thread_time() - cpu_before,
+                'peak_rss_bytes': peak_rss_bytes(),
+            }
+            io_after = read_io_counters()
+            record.update((key, io_after[key] - io_before[key]) for key in io_after if key in io_before)
+            self.add(record)
+
+    def command(self, command: List[str], name: Optional[str]=None) -> List[str]:
+        """
+        :return: `command`, run through the wrapper script in this file
+        """
+        with self.lock:
+            if self.report_dir is None:
+                self.report_dir = Path(mkdtemp(prefix='telemetry_'))
+            report = self.report_dir / f'{len(self.process_reports)}.json'
+            self.process_reports.append(report)
+        if name is None:
+            name = Path(str(command[0])).name
+        return [
+            sys.executable,
+            str(Path(__file__).absolute()),
+            '--report',
+            str(report),
+            '--name',
+            name,
+            '--',
+            *(str(piece) for piece in command),
+        ]
+
+    def finish(self):
+        """
+        Reads the records saved by the wrapper script for each external
+        program. Programs that were killed along with the wrapper have no
+        record.
+        """
+        for report in self.process_reports:
+            try:
+                with open(report) as f:
+                    self.add(json.load(f))
+            except (OSError, ValueError):
+                pass
+        self.process_reports = []
+        if self.report_dir is not None:
+            shutil.rmtree(self.report_dir, ignore_errors=True)
+            self.report_dir = None
+
+def current() -> Optional[Telemetry]:
+    return getattr(_local, 'telemetry', None)
+
+@contextmanager
+def recording(telemetry: Optional[Telemetry]=None) -> Iterator[Telemetry]:
+    """
+    Makes `telemetry` (by default, a new `Telemetry` object) current in
+    this thread for the duration of the `with` block.
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+    previous = current()
+    _local.telemetry = telemetry
+    try:
+        yield telemetry
+    finally:
+        _local.telemetry = previous
+        telemetry.finish()
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Records the `with` block as a stage, if telemetry is being recorded
+    in this thread.
+    """
+    telemetry = current()
+    if telemetry is None:
+        yield
+        return
+    with telemetry.stage(name):
+        yield
+
+def instrument(command: List[str], name: Optional[str]=None) -> List[str]:
+    """
+    :param name: Name of the program in records; defaults to the file name
+        of `command[0]`
+    :return: `command`, run through the wrapper script if telemetry is being
+        recorded in this thread, otherwise unchanged
+    """
+    telemetry = current()
+    if telemetry is None:
+        return command
+    return telemetry.command(command, name)
+
+def call_with_telemetry(func: Callable[..., T], kwargs: dict) -> Tuple[T, List[Dict[str, Any]]]:
+    """
+    Calls `func(**kwargs)`, e.g. in a worker process.
+
+    :return: 2-tuple: return value of `func`, and telemetry records
+    """
+    with recording() as telemetry:
+        result = func(**kwargs)
+    return result, telemetry.records
+
+def stage_totals(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    :return: For each stage or program name: number of records, sums of
+        times and bytes, and maximum peak RSS
+    """
+    totals: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        total = totals.setdefault(record['name'], {'count': 0, 'max_peak_rss_bytes': 0})
+        total['count'] += 1
+        for field in NUMERIC_TOTAL_FIELDS:
+            if field in record:
+                total[field] = total.get(field, 0) + record[field]
+        total['max_peak_rss_bytes'] = max(total['max_peak_rss_bytes'], record.get('peak_rss_bytes', 0))
+    return totals
+
+class RunReport:
+    """
+    Telemetry records for each sample in a run, saved as JSON after each
+    sample is added, so the report is current if the run is interrupted.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.start_time = datetime.now()
+        self.start = perf_counter()
+        self.samples: Dict[str, List[Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, sample_name: str, records: List[Dict[str, Any]]):
+        with self.lock:
+            self.samples.setdefault(sample_name, []).extend(records)
+        self.save()
+
+    @contextmanager
+    def stage(self, sample_name: str, name: str) -> Iterator[None]:
+        """
+        Records the `with` block as a stage of `sample_name`, e.g. saving
+        results in the main process
+        """
+        telemetry = Telemetry()
+        with telemetry.stage(name):
+            yield
+        self.add(sample_name, telemetry.records)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            samples = [
+                {'sample_name': sample_name, 'records': list(records)}
+                for sample_name, records in self.samples.items()
+            ]
+        return {
+            'command': sys.argv,
+            'hostname': socket.gethostname(),
+            'start_time': self.start_time.isoformat(),
+            'wall_seconds': perf_counter() - self.start,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stage_totals': stage_totals([record for sample in samples for record in sample['records']]),
+            'samples': samples,
+        }
+
+    def save(self):
+        data = self.to_dict()
+        temp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.{threading.get_ident()}')
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, self.path)
+
+@contextmanager
+def report_stage(report: Optional[RunReport], sample_name: str, name: str) -> Iterator[None]:
+    """
+    Like `RunReport.stage`, but does nothing if `report` is None, e.g. if
+    telemetry wasn't requested
+    """
+    if report is None:
+        yield
+        return
+    with report.stage(sample_name, name):
+        yield
+
+def run_and_report(command: List[str], report: Path, name: str) -> int:
+    """
+    Runs `command` and saves its resource usage to `report`.
+
+    :return: Exit status of `command`, in the form used by `Popen.returncode`
+    """
+    start = perf_counter()
+    process = subprocess.Popen(command)
+
+    # Signals sent to this process alone (not its process group) are
+    # passed on to the command
+    def forward_signal(signal_number, frame):
+        process.send_signal(signal_number)
+
+    for signal_number in FORWARDED_SIGNALS:
+        signal.signal(signal_number, forward_signal)
+    # Wait without reaping, so /proc/<pid>/io is still readable; it then
+    # includes the I/O of all child processes that the command waited for
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    io_counters = read_io_counters(str(process.pid))
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_seconds = perf_counter() - start
+
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # Popen must not try to reap the process again
+    process.returncode = returncode
+
+    if not io_counters:
+        io_counters = {
+            'storage_read_bytes': usage.ru_inblock * RUSAGE_BLOCK_SIZE,
+            'storage_write_bytes': usage.ru_oublock * RUSAGE_BLOCK_SIZE,
+        }
+    record = {
+        'type': 'process',
+        'name': name,
+        'command': command,
+        'returncode': returncode,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'user_cpu_seconds': usage.ru_utime,
+        'system_cpu_seconds': usage.ru_stime,
+        'peak_rss_bytes': usage.ru_maxrss * RUSAGE_MAXRSS_UNIT,
+        **io_counters,
+    }
+    with open(report, 'w') as f:
+        json.dump(record, f)
+    return returncode
+
+if __name__ == '__main__':
+    p = ArgumentParser(description='Run a command and save its resource usage as JSON')
+    p.add_argument('--report', type=Path, required=True)
+    p.add_argument('--name', required=True)
+    p.add_argument('command', nargs=REMAINDER)
+    args = p.parse_args()
+
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    returncode = run_and_report(command, args.report, args.name)
+    if returncode < 0:
+        # Exit the same way as the command did
+        signal.signal(-returncode, signal.SIG_DFL)
+        os.kill(os.getpid(), -returncode)
+    sys.exit(returncode)
+
+del T
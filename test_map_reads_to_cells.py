@@ -0,0 +1,43 @@
+import numpy as np
+
+from barcodes import pack_sequences
+from map_reads_to_cells import MoleculeCounter, merge_umi_mismatches
+
+UMI_LENGTH = 3
+
+def pack_umis(umis):
+    packed, valid = pack_sequences(np.array([list(umi.encode('ascii')) for umi in umis], dtype=np.uint8))
+    assert valid.all()
+    return packed
+
+def test_merge_umi_mismatches_follows_edge_directions():
+    """
+    ACA is one mismatch away from both AAA and ACC, which have enough reads
+    to absorb it, but AAA and ACC are two mismatches apart, so they are
+    separate molecules rather than one connected component.
+    """
+    umis = ['AAA', 'ACA', 'ACC']
+    keys = pack_umis(umis)
+    assert np.array_equal(keys, np.sort(keys))
+    read_counts = np.array([10, 1, 10])
+
+    labels = merge_umi_mismatches(keys, read_counts, UMI_LENGTH)
+
+    assert len(np.unique(labels)) == 2
+    assert labels[0] != labels[2]
+    assert labels[1] in (labels[0], labels[2])
+
+def test_molecule_counts_with_merged_mismatches():
+    umis = ['AAA'] * 10 + ['ACC'] * 10 + ['ACA']
+    counter = MoleculeCounter(gene_count=1, umi_length=UMI_LENGTH)
+    counter.add(
+        np.zeros(len(umis), dtype=np.uint64),
+        np.zeros(len(umis), dtype=np.int64),
+        pack_umis(umis),
+    )
+
+    _, _, molecules, totals = counter.molecule_counts(merge_mismatches=True)
+
+    assert list(molecules) == [2]
+    assert totals['distinct_umis'] == 3
+    assert totals['molecules'] == 2
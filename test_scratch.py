@@ -0,0 +1,71 @@
+from pathlib import Path
+from threading import Thread
+from time import sleep
+from typing import List
+
+import pandas as pd
+
+import alignment
+from pipeline import Pipeline
+import scratch
+
+BUDGET_BYTES = 12000
+SRA_BYTES = 600
+# Estimated from SRA_BYTES: FASTQ_BYTES_PER_SRA_BYTE times as many
+FASTQ_BYTES = 3000
+# Estimated from FASTQ_BYTES: SAM_BYTES_PER_FASTQ_BYTE times as many
+SAM_BYTES = 4500
+INPUT_COUNT = 8
+# Quantification is slow enough that later items are converted meanwhile
+QUANTIFY_SECONDS = 0.2
+
+def test_pipeline_with_scratch_budget_finishes(tmp_path: Path, monkeypatch):
+    """
+    The FASTQ and SAM files of one item fit in the budget, but not those of
+    two, so the align stage must not need a second allocation while the
+    convert stage holds space for the next item.
+    """
+    assert SRA_BYTES * scratch.FASTQ_BYTES_PER_SRA_BYTE == FASTQ_BYTES
+    assert FASTQ_BYTES * scratch.SAM_BYTES_PER_FASTQ_BYTE == SAM_BYTES
+
+    monkeypatch.setenv(scratch.SCRATCH_ENVIRONMENT_VARIABLE, '')
+    monkeypatch.setattr(scratch, 'POLL_INTERVAL', 0.01)
+    scratch.configure(tmp_path / 'scratch', budget_bytes=BUDGET_BYTES)
+
+    def convert_sra_to_fastq(sra_path: Path, scratch_dir: Path) -> List[Path]:
+        fastq_path = scratch_dir / sra_path.with_suffix('.fastq').name
+        fastq_path.write_bytes(b'@' * FASTQ_BYTES)
+        return [fastq_path]
+
+    def align_fastq(fastq_paths: List[Path], sam_path: Path, **kwargs) -> Path:
+        sam_path.write_bytes(b'@' * SAM_BYTES)
+        return sam_path
+
+    def map_reads_to_genes(sam_path: Path):
+        sleep(QUANTIFY_SECONDS)
+        return pd.Series([1.0]), pd.Series({'read_count': 1})
+
+    monkeypatch.setattr(alignment, 'convert_sra_to_fastq', convert_sra_to_fastq)
+    monkeypatch.setattr(alignment, 'align_fastq', align_fastq)
+    monkeypatch.setattr(alignment, 'map_reads_to_genes', map_reads_to_genes)
+
+    sra_paths = []
+    for i in range(INPUT_COUNT):
+        sra_path = tmp_path / f'SRR{i}.sra'
+        sra_path.write_bytes(b'\0' * SRA_BYTES)
+        sra_paths.append(sra_path)
+
+    stages = [alignment.sra_conversion_stage(remove_sra=True)]
+    stages.extend(alignment.alignment_stages(subprocesses=1, remove_fastq=True))
+    results = []
+    thread = Thread(
+        target=lambda: results.extend(Pipeline(stages).run(sra_paths)),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(timeout=60)
+
+    assert not thread.is_alive(), 'Pipeline is waiting for scratch space that is never released'
+    assert len(results) == INPUT_COUNT
+    assert not scratch.current().allocated
+    assert not any(path.is_file() for path in sra_paths)
@@ -4,7 +4,7 @@ from math import ceil, log10
 from os import getuid
 from pathlib import Path
 import pwd
-from typing import Iterable, List, TypeVar
+from typing import Iterable, List, Optional, TypeVar
 
 DOWNLOAD_PATH = Path('download')
 
@@ -75,7 +75,19 @@ def normalize_whitespace(string: str) -> str:
     """
     return ' '.join(string.split())
 
-def add_common_command_line_arguments(p: ArgumentParser):
+def add_common_command_line_arguments(p: ArgumentParser, output_file_help: Optional[str]=None):
+    """
+    :param output_file_help: Help text for --output-file, if the default
+        (gene expression saved to 'expr.hdf5') doesn't apply
+    """
+    if output_file_help is None:
+        output_file_help = normalize_whitespace(
+            """
+            Output file for gene expression and alignment metadata, saved in HDF5
+            format (.hdf5 or .h5 file extension recommended). If omitted, data will
+            be saved to 'expr.hdf5' inside the directory containing the FASTQ files.
+            """
+        )
     p.add_argument(
         '-s',
         '--subprocesses',
@@ -87,13 +99,7 @@ def add_common_command_line_arguments(p: ArgumentParser):
     p.add_argument(
         '--output-file',
         type=Path,
-        help=normalize_whitespace(
-            """
-            Output file for gene expression and alignment metadata, saved in HDF5
-            format (.hdf5 or .h5 file extension recommended). If omitted, data will
-            be saved to 'expr.hdf5' inside the directory containing the FASTQ files.
-            """
-        ),
+        help=output_file_help,
     )
     p.add_argument(
         '--hisat2-options',
@@ -105,5 +111,29 @@ def add_common_command_line_arguments(p: ArgumentParser):
             """
         ),
     )
+    p.add_argument(
+        '--stream-alignment',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Pipe HISAT2 output directly into gene quantification instead of
+            writing a SAM file to disk. Alignment and counting run concurrently,
+            and no SAM file is created.
+            """
+        ),
+    )
+
+def add_sra_command_line_arguments(p: ArgumentParser):
+    p.add_argument(
+        '--fastq-fifo',
+        action='store_true',
+        help=normalize_whitespace(
+            """
+            Stream fastq-dump output into HISAT2 through named pipes, instead of
+            writing FASTQ files to disk and reading them back. If either program
+            fails, the other is terminated.
+            """
+        ),
+    )
 
 del T